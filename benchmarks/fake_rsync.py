@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+""" stand-in for rsync used by benchmarks
+
+copy files on local machine like rsync does. remote paths (user@host:path
+and rsync://host/module/path) mapped to $SYNCME_FAKE_ROOT/host/path, so
+syncme can be measured on a machine without network.
+
+environment:
+    SYNCME_FAKE_ROOT: directory of remote hosts (default /tmp/syncme-fake)
+    SYNCME_FAKE_LATENCY: seconds to sleep before transfer, like a ssh handshake
+    SYNCME_FAKE_BANDWIDTH: bytes per second of simulated link (default unlimited)
+    SYNCME_FAKE_HOST: set by fake_ssh.py when rsync runs on a fake host, local
+        paths mapped to directory of that host
+
+supported options: -r, -a, -R, --stats, --dry-run/-n, --itemize-changes/-i,
+--files-from, --from0, --delete-missing-args (a non-empty directory deleted
+only with --force or a --delete option, like rsync), -e (ignored), other
+options ignored.
+"""
+
+import os
+import re
+import shutil
+import sys
+import time
+
+ROOT = os.environ.get('SYNCME_FAKE_ROOT', '/tmp/syncme-fake')
+# options that delete extraneous files, --force is not needed with them
+DELETE_OPTIONS = ('--del', '--delete', '--delete-before', '--delete-during', '--delete-delay',
+                  '--delete-after', '--delete-excluded')
+REMOTE = re.compile(r'^(?:rsync://(?:[^@/]+@)?([^/:]+)(?::\d+)?/|(?:[^@:/]+@)?([^:/]+):)(.*)$')
+
+
+class Transfer:
+
+    def __init__(self, options):
+        self.options = options
+        self.files = 0
+        self.transferred = 0
+        self.total_size = 0
+        self.transferred_size = 0
+
+    @property
+    def dry_run(self):
+        return '--dry-run' in self.options or '-n' in self.options
+
+    @property
+    def recursive(self):
+        return bool({'-r', '--recursive', '-a', '--archive'} & self.options)
+
+    def itemize(self, flag, path):
+        if '--itemize-changes' in self.options or '-i' in self.options:
+            print('{} {}'.format(flag, path))
+
+    def copy_file(self, source, target, name):
+        stat = os.lstat(source)
+        self.files += 1
+        self.total_size += stat.st_size
+        try:
+            target_stat = os.lstat(target)
+            if (target_stat.st_size == stat.st_size and
+                    int(target_stat.st_mtime) == int(stat.st_mtime)):
+                return
+        except FileNotFoundError:
+            pass
+        self.transferred += 1
+        self.transferred_size += stat.st_size
+        self.itemize('>f+++++++++', name)
+        if self.dry_run:
+            return
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        if os.path.islink(source):
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(os.readlink(source), target)
+        else:
+            shutil.copy2(source, target)
+
+    def copy(self, source, target, name, recursive):
+        if os.path.isdir(source) and not os.path.islink(source):
+            self.files += 1
+            if not self.dry_run:
+                os.makedirs(target, exist_ok=True)
+            if not recursive:
+                return
+            for entry in sorted(os.listdir(source)):
+                self.copy(os.path.join(source, entry), os.path.join(target, entry),
+                          os.path.join(name, entry), recursive)
+        else:
+            self.copy_file(source, target, name)
+
+
+def local_path(path):
+    """ map remote path to local directory of fake host """
+    match = REMOTE.match(path)
+    if match is None:
+        # rsync that runs on a fake host with fake_ssh.py
+        if os.environ.get('SYNCME_FAKE_HOST'):
+            return os.path.join(ROOT, os.environ['SYNCME_FAKE_HOST'], path.lstrip('/'))
+        return path
+    host = match.group(1) or match.group(2)
+    return os.path.join(ROOT, host, match.group(3).lstrip('/'))
+
+
+def read_list(path, from0):
+    with open(path, 'rb') as f:
+        content = f.read().decode()
+    return [entry for entry in content.split('\0' if from0 else '\n') if entry]
+
+
+def main(argv):
+    if argv == ['--version']:
+        print('rsync  version 3.2.7  protocol version 31 (fake)')
+        return 0
+    options = set()
+    values = {}
+    paths = []
+    args = iter(argv)
+    for arg in args:
+        if arg == '-e':
+            next(args)
+        elif arg.startswith('--') and '=' in arg:
+            name, value = arg.split('=', 1)
+            values[name] = value
+            options.add(name)
+        elif arg.startswith('-'):
+            options.add(arg)
+        else:
+            paths.append(arg)
+    if len(paths) < 2:
+        print('fake rsync: source and destination are required', file=sys.stderr)
+        return 1
+
+    time.sleep(float(os.environ.get('SYNCME_FAKE_LATENCY', 0)))
+    start = time.monotonic()
+    transfer = Transfer(options)
+    sources, dest = [local_path(path) for path in paths[:-1]], local_path(paths[-1])
+    return_code = 0
+
+    if '--files-from' in values:
+        base = sources[0]
+        for entry in read_list(values['--files-from'], '--from0' in options):
+            source = os.path.join(base, entry)
+            target = os.path.join(dest, entry)
+            if not os.path.lexists(source):
+                if '--delete-missing-args' in options:
+                    force = '--force' in options or any(
+                        option in DELETE_OPTIONS for option in options)
+                    if os.path.isdir(target) and not os.path.islink(target) and \
+                            os.listdir(target) and not force:
+                        print('cannot delete non-empty directory: {}'.format(entry),
+                              file=sys.stderr)
+                        return_code = 23
+                        continue
+                    transfer.itemize('*deleting', entry)
+                    if not transfer.dry_run and os.path.isdir(target) and \
+                            not os.path.islink(target):
+                        shutil.rmtree(target)
+                    elif not transfer.dry_run and os.path.lexists(target):
+                        os.remove(target)
+                else:
+                    return_code = 23
+                continue
+            transfer.copy(source, target, entry, transfer.recursive)
+    else:
+        for source in sources:
+            if not os.path.lexists(source.rstrip('/') or '/'):
+                print('fake rsync: link_stat "{}" failed'.format(source), file=sys.stderr)
+                return_code = 23
+                continue
+            if source.endswith('/'):
+                target = dest
+            elif (len(sources) > 1 or os.path.isdir(dest) or dest.endswith('/') or
+                  os.path.isdir(source)):
+                target = os.path.join(dest, os.path.basename(source))
+            else:
+                target = dest
+            transfer.copy(source, target, os.path.basename(source.rstrip('/')),
+                          transfer.recursive)
+
+    bandwidth = float(os.environ.get('SYNCME_FAKE_BANDWIDTH', 0))
+    if bandwidth:
+        time.sleep(max(0, transfer.transferred_size / bandwidth - (time.monotonic() - start)))
+
+    if '--stats' in options:
+        elapsed = max(time.monotonic() - start, 1e-6)
+        print('Number of files: {:,}'.format(transfer.files))
+        print('Number of regular files transferred: {:,}'.format(transfer.transferred))
+        print('Total file size: {:,} bytes'.format(transfer.total_size))
+        print('Total transferred file size: {:,} bytes'.format(transfer.transferred_size))
+        print('Literal data: {:,} bytes'.format(transfer.transferred_size))
+        print('Matched data: 0 bytes')
+        print('Total bytes sent: {:,}'.format(transfer.transferred_size))
+        print('Total bytes received: 0')
+        print('')
+        print('sent {:,} bytes  received 0 bytes  {:,.2f} bytes/sec'.format(
+            transfer.transferred_size, transfer.transferred_size / elapsed))
+        print('total size is {:,}  speedup is {:.2f}'.format(
+            transfer.total_size, transfer.total_size / max(transfer.transferred_size, 1)))
+    return return_code
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+""" stand-in for ssh used by benchmarks
+
+sleep $SYNCME_FAKE_LATENCY seconds like a ssh handshake and run the remote
+command on local machine in $SYNCME_FAKE_ROOT/host, with fake_rsync.py used
+for rsync, so probes, master connections and relays of syncme work without
+network.
+"""
+
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+ROOT = os.environ.get('SYNCME_FAKE_ROOT', '/tmp/syncme-fake')
+# options of ssh that take an argument
+ARGUMENT_OPTIONS = {'-o', '-p', '-O', '-i', '-l', '-F', '-S', '-J', '-L', '-R', '-D'}
+
+
+def main(argv):
+    args = iter(argv)
+    destination = None
+    control = False
+    for arg in args:
+        if arg in ARGUMENT_OPTIONS:
+            control = control or arg == '-O'
+            next(args)
+        elif arg.startswith('-'):
+            continue
+        else:
+            destination = arg
+            break
+    command = list(args)
+    if control:
+        return 0
+    time.sleep(float(os.environ.get('SYNCME_FAKE_LATENCY', 0)))
+    if destination is None or not command:
+        return 0
+
+    host = destination.split('@')[-1]
+    home = os.path.join(ROOT, host)
+    os.makedirs(home, exist_ok=True)
+    command = shlex.split(' '.join(command))
+    if command[0] == 'rsync':
+        command[0] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_rsync.py')
+    return subprocess.call(command, cwd=home, env=dict(os.environ, SYNCME_FAKE_HOST=host))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+""" benchmark suite of syncme
+
+generate synthetic configs and directory trees in a temporary directory and
+measure syncme on them, with fake_rsync.py and fake_ssh.py standing in for
+rsync and ssh, so no network and no rsync needed. median times printed as
+json, e.g.:
+
+    python3 benchmarks/run.py --runs 5 --latency 0.02
+
+benchmarks:
+    config: load and validate of a big config, without and with the cache
+    scheduling: syncronize_syncs with rsync replaced by a no-op, so only the
+        overhead of syncme itself measured
+    push/pull of shapes: end-to-end transfers of trees with many small
+        files, a few huge files, many paths and many hosts (pushed directly
+        and relayed through each other). push measured twice, first to an
+        empty remote and again with nothing changed
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+import syncme  # noqa: E402
+
+# name: (number of paths, files in each path, size of each file, number of hosts,
+#        settings of sync)
+SHAPES = {
+    'small_files': (1, 2000, 1024, 1, {}),
+    'huge_files': (1, 3, 32 * 1024 * 1024, 1, {}),
+    'many_paths': (50, 10, 4096, 1, {}),
+    'many_hosts': (1, 50, 4096, 20, {}),
+    'many_hosts_relay': (1, 50, 4096, 20, {'relay': 'tree', 'relay_fanout': 3}),
+}
+
+
+def measure(func, runs, setup=None):
+    """ return median wall time of calling func in seconds """
+    times = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def make_tree(root, files, size):
+    """ create a tree of files in root, 10 files in each directory """
+    data = os.urandom(min(size, 1024 * 1024))
+    for index in range(files):
+        directory = os.path.join(root, 'd{:04d}'.format(index // 10))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'f{:06d}'.format(index)), 'wb') as f:
+            written = 0
+            while written < size:
+                f.write(data[:size - written])
+                written += len(data[:size - written])
+
+
+def make_config(work, paths, hosts, files=0, size=0, settings=None):
+    """ return yaml text of a config with one sync of paths, hosts and settings """
+    local_paths = []
+    for index in range(paths):
+        path = os.path.join(work, 'local', 'p{:03d}'.format(index))
+        if files:
+            make_tree(path, files, size)
+        else:
+            os.makedirs(path, exist_ok=True)
+        local_paths.append(path + '/')
+    lines = ['hosts:']
+    for index in range(hosts):
+        lines += ['  - name: h{:03d}'.format(index),
+                  '    address: h{:03d}'.format(index)]
+    lines += ['syncs:',
+              '  - name: bench',
+              '    recursive: true']
+    lines += ['    {}: {}'.format(key, value) for key, value in (settings or {}).items()]
+    lines += ['    paths:']
+    lines += ['      - {}'.format(path) for path in local_paths]
+    lines += ['    hosts:']
+    lines += ['      - name: h{:03d}'.format(index) for index in range(hosts)]
+    return '\n'.join(lines) + '\n'
+
+
+def big_config(syncs, hosts, paths):
+    """ return yaml text of a config with many syncs, each with all hosts """
+    lines = ['hosts:']
+    for index in range(hosts):
+        lines += ['  - name: h{:03d}'.format(index),
+                  '    address: h{:03d}.example.com'.format(index),
+                  '    user: backup']
+    lines += ['syncs:']
+    for index in range(syncs):
+        lines += ['  - name: s{:04d}'.format(index),
+                  '    paths:']
+        lines += ['      - /srv/s{:04d}/p{:02d}/'.format(index, path) for path in range(paths)]
+        lines += ['    hosts:']
+        lines += ['      - name: h{:03d}'.format(host) for host in range(hosts)]
+    return '\n'.join(lines) + '\n'
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def bench_config(work, runs):
+    config_path = os.path.join(work, 'big.yml')
+    write(config_path, big_config(syncs=200, hosts=20, paths=5))
+
+    def uncached():
+        syncme.validate_config(syncme.load_config(config_path)[0])
+
+    syncme.load_validated_config(config_path)
+    return {
+        'load_validate': measure(uncached, runs),
+        'load_validated_cached': measure(
+            lambda: syncme.load_validated_config(config_path), runs),
+    }
+
+
+def bench_scheduling(work, runs):
+    config_path = os.path.join(work, 'scheduling.yml')
+    write(config_path, big_config(syncs=200, hosts=20, paths=5))
+    config = syncme.load_validated_config(config_path)[0]
+    results = {}
+    with mock.patch.object(syncme, 'rsync', lambda **kwargs: 0):
+        for jobs in (1, 8):
+            results['push_jobs_{}'.format(jobs)] = measure(
+                lambda: syncme.syncronize_syncs('push', config, jobs=jobs), runs)
+        results['pull'] = measure(lambda: syncme.syncronize_syncs('pull', config), runs)
+    return results
+
+
+def bench_shape(work, name, runs, jobs):
+    paths, files, size, hosts, settings = SHAPES[name]
+    shape_dir = os.path.join(work, name)
+    os.makedirs(shape_dir)
+    config_path = os.path.join(shape_dir, 'syncme.yml')
+    write(config_path, make_config(shape_dir, paths, hosts, files, size, settings))
+    config = syncme.load_validated_config(config_path)[0]
+    remote = os.environ['SYNCME_FAKE_ROOT']
+    local = os.path.join(shape_dir, 'local')
+    pulled = os.path.join(shape_dir, 'pulled')
+
+    def clean_remote():
+        shutil.rmtree(remote, ignore_errors=True)
+        os.makedirs(remote)
+
+    def push():
+        assert not syncme.syncronize_syncs('push', config, jobs=jobs)
+
+    def pull():
+        assert not syncme.syncronize_syncs('pull', config, jobs=jobs)
+
+    results = {
+        'push': measure(push, runs, clean_remote),
+        'push_unchanged': measure(push, runs),
+    }
+    # pull into an empty local tree, keep the original for the next run
+    shutil.rmtree(pulled, ignore_errors=True)
+    shutil.move(local, pulled)
+
+    def empty_local():
+        shutil.rmtree(local, ignore_errors=True)
+        for path in config['syncs'][0]['paths']:
+            os.makedirs(path, exist_ok=True)
+
+    results['pull'] = measure(pull, runs, empty_local)
+    shutil.rmtree(shape_dir)
+    clean_remote()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated ssh handshake of each rsync in seconds')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='simulated link speed in bytes per second')
+    parser.add_argument('--only', action='append', choices=['config', 'scheduling'] + list(SHAPES),
+                        help='run only this benchmark, can be repeated')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as work:
+        os.environ['SYNCME_FAKE_ROOT'] = os.path.join(work, 'remote')
+        os.environ['SYNCME_FAKE_LATENCY'] = str(args.latency)
+        os.environ['SYNCME_FAKE_BANDWIDTH'] = str(args.bandwidth)
+        os.makedirs(os.environ['SYNCME_FAKE_ROOT'])
+        syncme.CACHE_DIR = os.path.join(work, 'cache')
+        syncme.SSH = os.path.join(BENCHMARKS, 'fake_ssh.py')
+        syncme.find_rsync(os.path.join(BENCHMARKS, 'fake_rsync.py'))
+
+        results = {}
+        selected = args.only or ['config', 'scheduling'] + list(SHAPES)
+        if 'config' in selected:
+            results['config'] = bench_config(work, args.runs)
+        if 'scheduling' in selected:
+            results['scheduling'] = bench_scheduling(work, args.runs)
+        for name in SHAPES:
+            if name in selected:
+                results[name] = bench_shape(work, name, args.runs, args.jobs)
+
+    report = {
+        'version': syncme.__version__,
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+        'jobs': args.jobs,
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'results': results,
+    }
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+    main()
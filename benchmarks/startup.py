@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+""" measure startup time of syncme
+
+run import of syncme and 'syncme list' in fresh interpreters several times
+and print median times as json, e.g.:
+
+    python3 benchmarks/startup.py --runs 20
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = """
+hosts:
+  - name: example
+    address: example.com
+syncs:
+  - name: default
+    paths: ['/home/user', '/etc/']
+    hosts:
+      - name: example
+"""
+
+
+def measure(cmd, runs, env):
+    """ return median wall time of running cmd in seconds """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call(cmd, env=env, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work:
+        config_path = os.path.join(work, 'syncme.yml')
+        with open(config_path, 'w') as f:
+            f.write(CONFIG)
+        env = dict(os.environ, PYTHONPATH=ROOT, XDG_CACHE_HOME=work)
+        python = [sys.executable, '-c']
+        results = {
+            'python': measure(python + ['pass'], args.runs, env),
+            'import': measure(python + ['import syncme'], args.runs, env),
+            'list': measure(python + ['import sys, syncme; sys.argv = ["syncme", "-c", {!r}, "list"]; '
+                                      'syncme.main()'.format(config_path)], args.runs, env),
+        }
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@ setup(name='syncme',
       author='Mohammad Ghobadi',
       author_email='ghobadimhd@gmail.com',
       url="https://github.com/ghobadimhd/syncme",
-      python_requires='>=3.5',
+      python_requires='>=3.7',
       install_requires=['pyaml==17.*'],
       py_modules=['syncme'],
       entry_points={
@@ -22,6 +22,6 @@ setup(name='syncme',
           'Intended Audience :: End Users/Desktop',
           'Topic :: Communications :: File Sharing',
           'License :: OSI Approved :: MIT License',
-          'Programming Language :: Python :: 3.5',
+          'Programming Language :: Python :: 3.7',
       ],
 )
@@ -2,13 +2,20 @@
 
 import logging
 import os
-import subprocess as sp
-import getpass
-import argparse
+import re
+import stat as stat_module
+import sys
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping, MutableMapping
+from contextlib import closing
 from itertools import zip_longest
-import yaml
+# other modules imported where they are used to keep startup fast
 
 
+__version__ = '0.1.5'
+
 # global variables
 SYNCME_CONFIG = os.path.expanduser(os.environ.get('SYNCME_CONFIG', ''))
 CONFIG_LOCATIONS = [
@@ -17,12 +24,111 @@ CONFIG_LOCATIONS = [
     os.path.expanduser('~/.config/syncme.yml'),
     '/etc/syncme.yml'
     ]
-RSYNC = '/usr/bin/rsync'
-if not os.path.exists(RSYNC):
-    logging.error('cannot find rsync at %s', RSYNC)
-    raise FileNotFoundError()
+# path of rsync, found by find_rsync when it's needed
+RSYNC = None
+RSYNC_VERSION = None
+SSH = 'ssh'
+PULL_STRATEGIES = ('order', 'fastest', 'race')
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'syncme')
+# seconds that cached size of a tree used for splitting it to shards
+SIZE_CACHE_TTL = 24 * 60 * 60
+# rsync exit codes of errors that may not happen again: socket and protocol
+# stream errors, partial transfer, timeouts. 1 (syntax) and 2 (protocol
+# incompatibility) never fixed by retrying
+RETRY_CODES = (10, 12, 23, 30, 35)
+RETRY_MAX_DELAY = 300
+# seconds that a compression decision of a path and host used
+COMPRESSION_CACHE_TTL = 24 * 60 * 60
+COMPRESSION_LEVELS = (1, 6, 9)
+# default --skip-compress list of rsync, suffixes found incompressible added to it
+SKIP_COMPRESS = ('3g2', '3gp', '7z', 'aac', 'ace', 'apk', 'avi', 'bz2', 'deb', 'dmg',
+                 'ear', 'f4v', 'flac', 'flv', 'gpg', 'gz', 'iso', 'jar', 'jpeg', 'jpg',
+                 'lrz', 'lz', 'lz4', 'lzma', 'lzo', 'm1a', 'm1v', 'm2a', 'm2ts', 'm2v',
+                 'm4a', 'm4b', 'm4p', 'm4r', 'm4v', 'mka', 'mkv', 'mov', 'mp1', 'mp2',
+                 'mp3', 'mp4', 'mpa', 'mpeg', 'mpg', 'mpv', 'mts', 'odb', 'odf', 'odg',
+                 'odi', 'odm', 'odp', 'ods', 'odt', 'oga', 'ogg', 'ogm', 'ogv', 'ogx',
+                 'opus', 'otg', 'oth', 'otp', 'ots', 'ott', 'oxt', 'png', 'qt', 'rar',
+                 'rpm', 'rz', 'rzip', 'spx', 'squashfs', 'sxc', 'sxd', 'sxg', 'sxm',
+                 'sxw', 'sz', 'tbz', 'tbz2', 'tgz', 'tlz', 'ts', 'txz', 'tzo', 'vob',
+                 'war', 'webm', 'webp', 'xz', 'z', 'zip', 'zst')
+# seconds that an estimate of plan command used for scheduling
+ESTIMATE_TTL = 24 * 60 * 60
+# rsync --itemize-changes lines of files that transferred and deleted
+ITEMIZE_TRANSFER = re.compile(r'^[<>]f')
+ITEMIZE_DELETE = re.compile(r'^\*deleting ')
+RATE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)\s*$', re.IGNORECASE)
+SCHEDULE_TIME = re.compile(r'^\s*(\d\d?):(\d\d)\s*-\s*(\d\d?):(\d\d)\s*$')
+# rsync --info=progress2 lines: bytes transferred, percent, rate
+PROGRESS_LINE = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+([\d.,]+)([kKMG]?B)/s')
+INTERVAL = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([smhdSMHD]?)\s*$')
+# rsync options that filter files, skip some of them or change their place in
+# destination, a path is not folded into its parent with them
+PATH_CHANGING_TAGS = ('--exclude', '--include', '--filter', '--files-from', '--relative',
+                      '--cvs-exclude', '--one-file-system', '--max-size', '--min-size',
+                      '--existing', '--ignore-existing')
+# rsync options that delete extraneous files on destination
+DELETE_TAGS = ('--del', '--delete', '--delete-before', '--delete-during', '--delete-delay',
+               '--delete-after', '--delete-excluded', '--delete-missing-args')
+# rsync short options that take rest of their tag as argument, e.g. -essh
+SHORT_ARGUMENT_OPTIONS = 'eBTfM@'
+# number of last output lines of each path kept to report failures
+OUTPUT_TAIL = 20
+# exit code of rsync when it's killed by a signal, used for cancelled commands
+RSYNC_CANCELLED = 20
+# rsync --stats output lines
+STATS_FIELDS = {
+    'Number of files': 'files',
+    'Number of regular files transferred': 'files_transferred',
+    'Number of files transferred': 'files_transferred',
+    'Total file size': 'total_size',
+    'Total transferred file size': 'transferred_size',
+    'Literal data': 'literal_data',
+    'Matched data': 'matched_data',
+    'Total bytes sent': 'bytes_sent',
+    'Total bytes received': 'bytes_received',
+    }
+STATS_LINE = re.compile(r'^([A-Za-z ]+): ([\d,.]+)([KMGTP]?)')
+SPEEDUP_LINE = re.compile(r'speedup is ([\d,.]+)')
+STATE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS manifest (
+        sync TEXT, host TEXT, local_path TEXT, remote_path TEXT,
+        fingerprint TEXT, updated REAL,
+        PRIMARY KEY (sync, host, local_path, remote_path))""",
+    """CREATE TABLE IF NOT EXISTS stats (
+        time REAL, sync TEXT, host TEXT, method TEXT,
+        local_path TEXT, remote_path TEXT, return_code INTEGER,
+        wall_time REAL, files INTEGER, files_transferred INTEGER,
+        total_size INTEGER, transferred_size INTEGER, literal_data INTEGER,
+        matched_data INTEGER, bytes_sent INTEGER, bytes_received INTEGER,
+        speedup REAL)""",
+    """CREATE TABLE IF NOT EXISTS last_success (
+        sync TEXT, host TEXT, time REAL, PRIMARY KEY (sync, host))""",
+    """CREATE TABLE IF NOT EXISTS failures (
+        method TEXT, sync TEXT, host TEXT, local_path TEXT, remote_path TEXT,
+        time REAL, PRIMARY KEY (method, sync, host, local_path, remote_path))""",
+    """CREATE TABLE IF NOT EXISTS compression (
+        host TEXT, local_path TEXT, options TEXT, updated REAL,
+        PRIMARY KEY (host, local_path))""",
+    """CREATE TABLE IF NOT EXISTS estimates (
+        sync TEXT, host TEXT, method TEXT, local_path TEXT, seconds REAL,
+        updated REAL, PRIMARY KEY (sync, host, method, local_path))""",
+    """CREATE TABLE IF NOT EXISTS sizes (
+        path TEXT, entry TEXT, size INTEGER, updated REAL,
+        PRIMARY KEY (path, entry))""",
+    ]
 
 logger = logging.getLogger(__name__)
+# serialize grouped output of parallel units
+_OUTPUT_LOCK = threading.Lock()
+# ssh master connections: (user, address) -> ssh command
+_CONTROL_MASTERS = {}
+_CONTROL_LOCKS = {}
+_CONTROL_LOCK = threading.Lock()
+_CONTROL_DIR = None
+_USER = None
+# cancellation of run that a thread works for (see _Cancellation)
+_LOCAL = threading.local()
 
 def setup_logger(level='INFO'):
     """ setup a default logger """
@@ -30,6 +136,65 @@ def setup_logger(level='INFO'):
     logger.setLevel(getattr(logging, level.upper()))
     logger.addHandler(logging.StreamHandler())
 
+def find_rsync(rsync_path=None):
+    """ return path of rsync
+
+    if rsync_path given it's used, otherwise rsync searched in PATH once
+    and the result reused.
+
+    args:
+        rsync_path: custom rsync path (rsync_path setting of config)
+
+    return: path of rsync. FileNotFoundError raised if rsync not found
+    """
+    global RSYNC, RSYNC_VERSION
+    if rsync_path is not None:
+        RSYNC = os.path.expanduser(rsync_path)
+        RSYNC_VERSION = None
+    elif RSYNC is None:
+        import shutil
+        RSYNC = shutil.which('rsync')
+    if RSYNC is None or not os.path.exists(RSYNC):
+        logger.error('cannot find rsync at %s', RSYNC or 'PATH')
+        RSYNC = None
+        raise FileNotFoundError('rsync')
+    return RSYNC
+
+def rsync_version():
+    """ return version of rsync as tuple of ints, (0,) if it is unknown """
+    global RSYNC_VERSION
+    if RSYNC_VERSION is None:
+        import subprocess as sp
+        try:
+            output = sp.check_output([find_rsync(), '--version'], stderr=sp.DEVNULL)
+            match = re.search(rb'version (\d+)\.(\d+)(?:\.(\d+))?', output)
+            RSYNC_VERSION = tuple(int(part) for part in match.groups() if part) \
+                if match else (0,)
+        except (OSError, sp.CalledProcessError):
+            RSYNC_VERSION = (0,)
+    return RSYNC_VERSION
+
+def _yaml_loader():
+    """ return fastest safe yaml loader, C loader if libyaml is available """
+    import yaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def find_config(path=None):
+    """ return path of config file
+
+    return path if it's given and exists, otherwise first file that exists
+    in CONFIG_LOCATIONS. None returned if there is no config file.
+    """
+    if path is not None:
+        paths = [path]
+    else:
+        paths = CONFIG_LOCATIONS
+    # Check paths and return first path that exists
+    for config_path in paths:
+        if os.path.exists(config_path) and os.path.isfile(config_path):
+            return config_path
+    return None
+
 def load_config(path=None):
     """ Load config from yml file
 
@@ -42,27 +207,83 @@ def load_config(path=None):
     args:
         path: custom config path
     """
-    if path is not None:
-        paths = [path]
-    else:
-        paths = CONFIG_LOCATIONS
-    # Check paths and read first path that exists
-    for config_path in paths:
-        if os.path.exists(config_path) and os.path.isfile(config_path):
-            try:
-                logger.debug('Try to load config from %s', config_path)
-                with open(config_path, 'r') as config_file:
-                    config = yaml.load(config_file)
-                    # config config (file) is empty
-                    if config is None:
-                        config = dict()
-                    logger.debug('Read config from %s', config_path)
-                    return (config, config_path)
-            except Exception as e:
-                raise e
+    import yaml
+    config_path = find_config(path)
+    if config_path is not None:
+        try:
+            logger.debug('Try to load config from %s', config_path)
+            with open(config_path, 'r') as config_file:
+                config = yaml.load(config_file, Loader=_yaml_loader())
+                # config config (file) is empty
+                if config is None:
+                    config = dict()
+                logger.debug('Read config from %s', config_path)
+                return (config, config_path)
+        except Exception as e:
+            raise e
     logger.error('config not found')
     return (None, None)
 
+def _config_cache_key(config_path):
+    """ return key that changes when config file or syncme changes """
+    import getpass
+    stat = os.stat(config_path)
+    return (os.path.abspath(config_path), stat.st_mtime_ns, stat.st_size,
+            __version__, getpass.getuser())
+
+def load_validated_config(path=None):
+    """ Load and validate config, use cached validated config if possible
+
+    validated config cached in CACHE_DIR with pickle as plain dicts and
+    lists (see _plain), so cache does not depend on how syncme imported,
+    and the cache used while config file (path, modification time and
+    size), syncme version and user are same. otherwise config loaded with
+    load_config and validated with validate_config.
+
+    args:
+        path: custom config path
+
+    return: tuple (config, config_path). config is None if config not
+        found or it's not valid
+    """
+    import hashlib
+    import pickle
+    config_path = find_config(path)
+    if config_path is None:
+        logger.error('config not found')
+        return (None, None)
+
+    key = _config_cache_key(config_path)
+    cache_path = os.path.join(CACHE_DIR, 'config-{}.pickle'.format(
+        hashlib.sha1(key[0].encode()).hexdigest()))
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached_key, config = pickle.load(cache_file)
+        if cached_key == key:
+            config = _records(config)
+            logger.debug('Read validated config from %s', cache_path)
+            return (config, config_path)
+    except Exception as e:
+        # any broken or incompatible cache is a cache miss
+        logger.debug('debug: cannot read cached config: %s', e)
+
+    config, config_path = load_config(config_path)
+    if config is None:
+        return (None, None)
+    if not validate_config(config):
+        logger.critical('config error')
+        return (None, config_path)
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(temp_path, 'wb') as cache_file:
+            pickle.dump((key, _plain(config)), cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logger.debug('debug: cannot cache config: %s', e)
+    return (config, config_path)
+
 def merge_host(global_host_list, host):
     """ Merge host with global host
 
@@ -75,10 +296,9 @@ def merge_host(global_host_list, host):
     """
     # FIXME: rename the variable
     target_host = None
-    for h in global_host_list:
-        if h['name'] == host['name']:
-            target_host = h
-            break
+    for h in _find_named(global_host_list, host['name']):
+        target_host = h
+        break
     if target_host is not None:
         for key in target_host.keys():
             host.setdefault(key, target_host[key])
@@ -119,6 +339,173 @@ def _fix_host_path(host_paths, sync_paths):
     return new_host_path_list
 
 
+class Record(MutableMapping):
+    """ base class of config records
+
+    settings in _fields kept in slots and other settings in a dict, and a
+    record can be used as a dict of its settings.
+    """
+    __slots__ = ('_extra',)
+    _fields = ()
+
+    def __init__(self, data=()):
+        self._extra = None
+        for key, value in dict(data).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._fields:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for key in self._fields:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self))
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+class Host(Record):
+    """ a host of config """
+    _fields = ('name', 'address', 'user', 'paths')
+    __slots__ = _fields
+
+
+class Sync(Record):
+    """ a sync of config """
+    _fields = ('name', 'paths', 'hosts', 'recursive', 'tags')
+    __slots__ = _fields
+
+
+class NamedList(list):
+    """ list of records that indexed by their name """
+    __slots__ = ('_index',)
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self._reindex()
+
+    def _reindex(self):
+        self._index = {}
+        for item in self:
+            self._index.setdefault(item['name'], []).append(item)
+
+    def find(self, name):
+        """ return list of items with name """
+        return list(self._index.get(name, ()))
+
+    def append(self, item):
+        super().append(item)
+        self._index.setdefault(item['name'], []).append(item)
+
+    def __reduce__(self):
+        return (type(self), (list(self),))
+
+    def extend(self, items):
+        super().extend(items)
+        self._reindex()
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self._reindex()
+
+    def remove(self, item):
+        super().remove(item)
+        self._reindex()
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self._reindex()
+        return item
+
+    def clear(self):
+        super().clear()
+        self._reindex()
+
+    def __setitem__(self, index, item):
+        super().__setitem__(index, item)
+        self._reindex()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._reindex()
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+
+def _find_named(items, name):
+    """ return items that have name, using the index if items is a NamedList """
+    if isinstance(items, NamedList):
+        return items.find(name)
+    return [item for item in items if item['name'] == name]
+
+
+def _plain(value):
+    """ convert records and named lists to dicts and lists """
+    if isinstance(value, Mapping):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    return value
+
+
+def _records(config):
+    """ return validated config of plain dicts and lists (see _plain) with
+    its hosts and syncs as records in named lists, as validate_config
+    makes them """
+    config = dict(config)
+    config['hosts'] = NamedList(Host(host) for host in config['hosts'])
+    config['syncs'] = NamedList(
+        Sync(dict(sync, hosts=NamedList(Host(host) for host in sync['hosts'])))
+        for sync in config['syncs'])
+    return config
+
+
+def _current_user():
+    """ return name of current user, it's looked up once """
+    global _USER
+    if _USER is None:
+        import getpass
+        _USER = getpass.getuser()
+    return _USER
+
+
 def validate_host(host, sync_paths, global_hosts=[]):
     """ validate host settings 
     
@@ -142,7 +529,8 @@ def validate_host(host, sync_paths, global_hosts=[]):
         logger.error('address is not defined for host')
         raise AttributeError('Host must have address')
     
-    host.setdefault('user', getpass.getuser())
+    if 'user' not in host:
+        host['user'] = _current_user()
     host.setdefault('paths', [])
 
     host['paths'] = _fix_host_path(host['paths'], sync_paths)
@@ -185,199 +573,2962 @@ def validate_sync(sync, default_recursive=False, default_tags=None):
     sync.setdefault('recursive', default_recursive)
     sync.setdefault('tags', default_tags)
 
-    if 'name' not in sync:
-        logger.error('each sync most have a name')
-        return False
-    else:
-        if sync['name'].lower() == 'all':
-            logger.error("sync's name cannot be 'all'")
-            return False
-        # sync name are case insensitive
-    
-    sync['name'] = sync['name'].lower()
-    sync.setdefault('hosts', [])
-    sync.setdefault('paths', [])
+    if 'name' not in sync:
+        logger.error('each sync most have a name')
+        return False
+    else:
+        if sync['name'].lower() == 'all':
+            logger.error("sync's name cannot be 'all'")
+            return False
+        # sync name are case insensitive
+    
+    sync['name'] = sync['name'].lower()
+    sync.setdefault('hosts', [])
+    sync.setdefault('paths', [])
+
+    if not _valid_count(sync.get('shards', 1)):
+        logger.error('shards of sync %s must be a positive integer or a mapping '
+                     'of paths to positive integers', sync['name'])
+        return False
+    if not _valid_count(sync.get('retries', 0), 0):
+        logger.error('retries of sync %s must be a non-negative integer or a mapping '
+                     'of paths to non-negative integers', sync['name'])
+        return False
+
+    return True
+
+def _validate_transport(host):
+    """ check transport and jobs settings of a host """
+    if host.get('transport', 'ssh') not in ('ssh', 'rsyncd'):
+        logger.error("transport of host %s must be 'ssh' or 'rsyncd'", host['name'])
+        return False
+    if host.get('transport') == 'rsyncd' and not host.get('module'):
+        logger.error('module is not defined for rsyncd host %s', host['name'])
+        return False
+    if not isinstance(host.get('port', 873), int) or isinstance(host.get('port'), bool):
+        logger.error('port of host %s must be an integer', host['name'])
+        return False
+    if not _valid_count(host.get('jobs', 1)) or isinstance(host.get('jobs'), dict):
+        logger.error('jobs of host %s must be a positive integer', host['name'])
+        return False
+    return True
+
+def _valid_count(setting, minimum=1):
+    """ check setting is an int not less than minimum or a dict of paths to such ints """
+    if isinstance(setting, dict):
+        return all(_valid_count(value, minimum) and not isinstance(value, dict)
+                   for value in setting.values())
+    return isinstance(setting, int) and not isinstance(setting, bool) and setting >= minimum
+
+
+
+def validate_config(config):
+    """ check and validate config
+
+    check syncs and hosts, fix missing user, check and fix source and
+    destination paths
+
+    syncs and hosts converted to Sync and Host records and lists of them to
+    NamedList, so they can be found by name without scanning lists.
+
+    args:
+        config: config loaded from yaml file
+
+    """
+    # set default global settings
+    config.setdefault('hosts', [])
+    config.setdefault('syncs', [])
+    config.setdefault('recursive', False)
+    config.setdefault('tags', [])
+
+    if not isinstance(config.get('jobs', 1), int) or config.get('jobs', 1) < 1:
+        logger.error('jobs must be a positive integer')
+        return False
+
+    if config.get('pull_strategy', 'order') not in PULL_STRATEGIES:
+        logger.error('pull_strategy must be one of %s', ', '.join(PULL_STRATEGIES))
+        return False
+
+    if not _valid_count(config.get('shards', 1)):
+        logger.error('shards must be a positive integer or a mapping of paths '
+                     'to positive integers')
+        return False
+
+    if not _valid_count(config.get('retries', 0), 0):
+        logger.error('retries must be a non-negative integer or a mapping of paths '
+                     'to non-negative integers')
+        return False
+
+    for item in [config] + config['syncs']:
+        if item.get('compress', False) not in (True, False, 'auto'):
+            logger.error("compress must be True, False or 'auto'")
+            return False
+        if item.get('relay', False) not in (False, 'chain', 'tree'):
+            logger.error("relay must be False, 'chain' or 'tree'")
+            return False
+        if not _valid_count(item.get('relay_fanout', 2)) or \
+                isinstance(item.get('relay_fanout'), dict):
+            logger.error('relay_fanout must be a positive integer')
+            return False
+        try:
+            if item.get('interval') is not None and parse_interval(item['interval']) <= 0:
+                raise ValueError('interval must be more than 0')
+            parse_interval(item.get('jitter', 0))
+        except ValueError as e:
+            logger.error('invalid interval setting: %s', e)
+            return False
+        if not _valid_count(item.get('output_tail', OUTPUT_TAIL)) or \
+                isinstance(item.get('output_tail'), dict):
+            logger.error('output_tail must be a positive integer')
+            return False
+
+    try:
+        _parse_schedule(config.get('bandwidth_schedule', []),
+                        parse_rate(config.get('bandwidth', 0)))
+        for host in config['hosts'] + [host for sync in config['syncs']
+                                       for host in sync.get('hosts', [])]:
+            parse_rate(host.get('bandwidth', 0))
+    except ValueError as e:
+        logger.error('invalid bandwidth setting: %s', e)
+        return False
+
+    # check and validate global hosts
+    for host in config['hosts']:
+        is_valid = validate_global_host(host) and _validate_transport(host)
+        if not is_valid:
+            return False
+    config['hosts'] = NamedList(Host(host) for host in config['hosts'])
+    # validate sync
+    for sync in config['syncs']:
+        sync.setdefault('hosts', [])
+        sync.setdefault('paths', [])
+        for host in sync['hosts']:
+            try:
+                validate_host(host, sync['paths'], config['hosts'])
+            except AttributeError:
+                return False
+            if not _validate_transport(host):
+                return False
+        # validate hosts in syncs
+        is_sync_valid = validate_sync(sync, config['recursive'], config['tags'])
+        if not is_sync_valid:
+            return False
+        sync['hosts'] = NamedList(Host(host) for host in sync['hosts'])
+    config['syncs'] = NamedList(Sync(sync) for sync in config['syncs'])
+
+    return True
+
+def _control_path(user, address):
+    """ return path of ssh control socket of user@address """
+    import atexit
+    import hashlib
+    import tempfile
+    global _CONTROL_DIR
+    if _CONTROL_DIR is None:
+        _CONTROL_DIR = tempfile.mkdtemp(prefix='syncme-')
+        atexit.register(close_control_masters)
+    # socket paths are limited to about 100 characters so use a short hash
+    name = hashlib.sha1('{}@{}'.format(user, address).encode()).hexdigest()[:16]
+    return os.path.join(_CONTROL_DIR, name)
+
+def open_control_master(user, address):
+    """ open a ssh master connection to a host
+
+    master connection opened once per (user, address) and reused by every
+    rsync of the run until close_control_masters called.
+
+    args:
+        user: user of remote host
+        address: remote host address
+
+    return: ssh command that use the master connection, None if master
+        connection cannot be opened
+    """
+    import subprocess as sp
+    key = (user, address)
+    with _CONTROL_LOCK:
+        host_lock = _CONTROL_LOCKS.setdefault(key, threading.Lock())
+    # other hosts must not wait while this one is connecting
+    with host_lock:
+        if key in _CONTROL_MASTERS:
+            return _CONTROL_MASTERS[key]
+
+        control_path = _control_path(user, address)
+        cmd = [SSH, '-f', '-N', '-o', 'ControlMaster=yes',
+               '-o', 'ControlPersist=yes', '-o', 'ControlPath=' + control_path,
+               '{0}@{1}'.format(user, address)]
+        logger.debug('debug: running ' + ' '.join(cmd))
+        if sp.call(cmd) == 0:
+            ssh_command = '{} -o ControlMaster=no -o ControlPath={}'.format(
+                SSH, control_path)
+        else:
+            logger.warning('cannot open master connection to %s, '
+                           'connecting without multiplexing', address)
+            ssh_command = None
+        _CONTROL_MASTERS[key] = ssh_command
+        return ssh_command
+
+def close_control_masters():
+    """ close all ssh master connections opened by open_control_master """
+    import shutil
+    import subprocess as sp
+    global _CONTROL_DIR
+    with _CONTROL_LOCK:
+        for (user, address), ssh_command in _CONTROL_MASTERS.items():
+            if ssh_command is None:
+                continue
+            sp.call([SSH, '-o', 'ControlPath=' + _control_path(user, address),
+                     '-O', 'exit', '{0}@{1}'.format(user, address)],
+                    stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        _CONTROL_MASTERS.clear()
+        if _CONTROL_DIR is not None:
+            shutil.rmtree(_CONTROL_DIR, ignore_errors=True)
+            _CONTROL_DIR = None
+
+def check_control_masters():
+    """ forget ssh master connections that are not alive, so they are opened
+    again by next open_control_master. masters that could not be opened
+    tried again too """
+    import subprocess as sp
+    with _CONTROL_LOCK:
+        masters = list(_CONTROL_MASTERS.items())
+    for (user, address), ssh_command in masters:
+        if ssh_command is not None and sp.call(
+                [SSH, '-o', 'ControlPath=' + _control_path(user, address), '-O', 'check',
+                 '{0}@{1}'.format(user, address)],
+                stdout=sp.DEVNULL, stderr=sp.DEVNULL) == 0:
+            continue
+        logger.debug('master connection to %s is not alive', address)
+        with _CONTROL_LOCK:
+            _CONTROL_MASTERS.pop((user, address), None)
+
+def open_state():
+    """ open database that keeps syncme state between runs
+
+    database is a sqlite file in CACHE_DIR. every call return a new
+    connection so it can be used in any thread.
+    """
+    import sqlite3
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    db = sqlite3.connect(os.path.join(CACHE_DIR, 'state.db'), timeout=60)
+    for statement in STATE_SCHEMA:
+        db.execute(statement)
+    return db
+
+def tree_fingerprint(path, *extra):
+    """ return fingerprint of a local file or directory tree
+
+    fingerprint is made of number of entries, total size and a hash of
+    name, type, size, mtime, ctime and inode of every entry of the tree, so
+    any change in the tree changes the fingerprint.
+
+    args:
+        path: local path
+        extra: other values (e.g. rsync options) added to the hash
+
+    return: fingerprint as str, None if tree cannot be read
+    """
+    import hashlib
+    digest = hashlib.sha1(repr(extra).encode())
+    count = size = 0
+    path = os.path.expanduser(path)
+
+    def add(name, stat):
+        nonlocal count, size
+        count += 1
+        size += stat.st_size
+        digest.update('{}\0{}\0{}\0{}\0{}\0{}\n'.format(
+            name, stat.st_mode, stat.st_size, stat.st_mtime_ns,
+            stat.st_ctime_ns, stat.st_ino).encode('utf-8', 'surrogateescape'))
+
+    try:
+        stat = os.lstat(path)
+        add('', stat)
+        stack = [path] if os.path.isdir(path) and not os.path.islink(path) else []
+        while stack:
+            directory = stack.pop()
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                add(os.path.relpath(entry.path, path), entry.stat(follow_symlinks=False))
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+    except OSError as e:
+        logger.debug('debug: cannot fingerprint %s: %s', path, e)
+        return None
+
+    return '{}:{}:{}'.format(count, size, digest.hexdigest())
+
+def get_manifest(sync_name, host_name, local_path, remote_path):
+    """ return fingerprint of path at last successful push, None if unknown """
+    with closing(open_state()) as db:
+        row = db.execute(
+            'SELECT fingerprint FROM manifest WHERE sync=? AND host=? '
+            'AND local_path=? AND remote_path=?',
+            (sync_name, host_name, local_path, remote_path)).fetchone()
+    return row[0] if row else None
+
+def set_manifest(sync_name, host_name, local_path, remote_path, fingerprint):
+    """ save fingerprint of path after a successful push """
+    with closing(open_state()) as db, db:
+        db.execute('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?)',
+                   (sync_name, host_name, local_path, remote_path,
+                    fingerprint, time.time()))
+
+def save_stats(results):
+    """ save statistics of rsync commands (see syncronize_host) in history """
+    columns = ('time', 'sync', 'host', 'method', 'local_path', 'remote_path',
+               'return_code', 'wall_time', 'files', 'files_transferred',
+               'total_size', 'transferred_size', 'literal_data', 'matched_data',
+               'bytes_sent', 'bytes_received', 'speedup')
+    with closing(open_state()) as db, db:
+        db.executemany(
+            'INSERT INTO stats ({}) VALUES ({})'.format(
+                ', '.join(columns), ', '.join('?' * len(columns))),
+            [tuple(result.get(column) for column in columns) for result in results])
+
+def _format_size(size):
+    """ return human readable size """
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(size) < 1024 or unit == 'TB':
+            break
+        size /= 1024
+    return '{:.1f}{}'.format(size, unit)
+
+def show_stats(days=30, limit=10):
+    """ print throughput of last days and slowest paths and hosts
+
+    args:
+        days: number of days of history to show
+        limit: number of slowest paths and hosts to show
+    """
+    since = time.time() - days * 86400
+    with closing(open_state()) as db:
+        daily = db.execute(
+            "SELECT date(time, 'unixepoch', 'localtime'), COUNT(*), SUM(return_code != 0), "
+            "SUM(bytes_sent + bytes_received), SUM(wall_time) FROM stats "
+            "WHERE time >= ? GROUP BY 1 ORDER BY 1", (since,)).fetchall()
+        paths = db.execute(
+            "SELECT sync, host, local_path, COUNT(*), AVG(wall_time), "
+            "SUM(bytes_sent + bytes_received) / SUM(wall_time) FROM stats "
+            "WHERE time >= ? GROUP BY sync, host, local_path "
+            "ORDER BY 5 DESC LIMIT ?", (since, limit)).fetchall()
+        hosts = db.execute(
+            "SELECT host, COUNT(*), SUM(wall_time), "
+            "SUM(bytes_sent + bytes_received) / SUM(wall_time) FROM stats "
+            "WHERE time >= ? GROUP BY host ORDER BY 4 LIMIT ?", (since, limit)).fetchall()
+
+    print('throughput:')
+    for day, runs, failed, transferred, wall_time in daily:
+        print('\t{}: {} runs, {} failed, {} in {:.0f}s, {}/s'.format(
+            day, runs, failed, _format_size(transferred or 0), wall_time or 0,
+            _format_size((transferred or 0) / (wall_time or 1))))
+    print('slowest paths:')
+    for sync, host, path, runs, wall_time, throughput in paths:
+        print('\t{}/{}:{}: {} runs, {:.1f}s average, {}/s'.format(
+            sync, host, path, runs, wall_time or 0, _format_size(throughput or 0)))
+    print('slowest hosts:')
+    for host, runs, wall_time, throughput in hosts:
+        print('\t{}: {} runs in {:.0f}s, {}/s'.format(
+            host, runs, wall_time or 0, _format_size(throughput or 0)))
+
+def set_last_success(sync_name, host_name):
+    """ save time of a successful sync of a sync with a host """
+    with closing(open_state()) as db, db:
+        db.execute('INSERT OR REPLACE INTO last_success VALUES (?, ?, ?)',
+                   (sync_name, host_name, time.time()))
+
+def _write_failures(db, records):
+    """ write failures of synced paths to state database
+
+    failures of a sync are only deleted if it has any in database, so syncs
+    that do not fail do not write to database.
+
+    args:
+        db: connection to state database (see open_state)
+        records: list of tuple (method_name, sync_name, host_name,
+            path_pairs, failed_paths, time), see save_failures
+    """
+    failing = set(db.execute('SELECT DISTINCT method, sync FROM failures'))
+    for method_name, sync_name, host_name, path_pairs, failed_paths, now in records:
+        for local_path, remote_path in path_pairs:
+            if (local_path, remote_path) in failed_paths:
+                db.execute('INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?, ?)',
+                           (method_name, sync_name, host_name, local_path,
+                            remote_path, now))
+                failing.add((method_name, sync_name))
+            elif (method_name, sync_name) not in failing:
+                continue
+            elif method_name == 'pull':
+                db.execute('DELETE FROM failures WHERE method=? AND sync=? AND local_path=?',
+                           (method_name, sync_name, local_path))
+            else:
+                db.execute('DELETE FROM failures WHERE method=? AND sync=? AND host=? '
+                           'AND local_path=? AND remote_path=?',
+                           (method_name, sync_name, host_name, local_path, remote_path))
+
+def save_failures(method_name, sync_name, host_name, path_pairs, failed_paths):
+    """ save failed paths of a sync with a host so retry command can sync them
+
+    failures of paths that synced successfully removed, in pull a path
+    synced from any host removes its failures with all hosts.
+
+    args:
+        method_name: 'push' or 'pull'
+        sync_name: name of sync
+        host_name: name of host
+        path_pairs: list of tuple (local_path, remote_path) that synced
+        failed_paths: list of tuple (local_path, remote_path) that failed
+    """
+    with closing(open_state()) as db, db:
+        _write_failures(db, [(method_name, sync_name, host_name, path_pairs,
+                              failed_paths, time.time())])
+
+class _StateWrites:
+    """ failures and last success of units of a run
+
+    they are kept in memory and written to state database at once by
+    flush, so units do not open database and commit one by one. methods
+    are same as save_failures and set_last_success.
+    """
+
+    def __init__(self):
+        self._failures = []
+        self._successes = []
+        self._lock = threading.Lock()
+
+    def save_failures(self, method_name, sync_name, host_name, path_pairs, failed_paths):
+        with self._lock:
+            self._failures.append((method_name, sync_name, host_name, list(path_pairs),
+                                   list(failed_paths), time.time()))
+
+    def set_last_success(self, sync_name, host_name):
+        with self._lock:
+            self._successes.append((sync_name, host_name, time.time()))
+
+    def flush(self):
+        """ write kept records to state database with one connection """
+        import sqlite3
+        with self._lock:
+            failures, self._failures = self._failures, []
+            successes, self._successes = self._successes, []
+        if not failures and not successes:
+            return
+        try:
+            with closing(open_state()) as db, db:
+                _write_failures(db, failures)
+                db.executemany('INSERT OR REPLACE INTO last_success VALUES (?, ?, ?)',
+                               successes)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning('cannot save state of syncs: %s', e)
+
+def get_failures(sync_name=None, host_name=None):
+    """ return saved failures as list of tuple (method, sync, host, local_path, remote_path)
+
+    args:
+        sync_name: only return failures of this sync
+        host_name: only return failures with this host
+    """
+    query = 'SELECT method, sync, host, local_path, remote_path FROM failures'
+    conditions, params = [], []
+    if sync_name is not None:
+        conditions.append('sync=?')
+        params.append(sync_name.lower())
+    if host_name is not None:
+        conditions.append('host=?')
+        params.append(host_name.lower())
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    with closing(open_state()) as db:
+        return db.execute(query + ' ORDER BY time', params).fetchall()
+
+def _summarize_results(results, key):
+    """ summarize statistics of rsync commands grouped by key function
+
+    return: dict of key to dict of duration, bytes, exit_code and failures
+    """
+    summary = OrderedDict()
+    for result in results:
+        start = result['time']
+        end = start + (result.get('wall_time') or 0)
+        item = summary.setdefault(key(result), {
+            'start': start, 'end': end, 'bytes': 0, 'exit_code': 0, 'failures': 0})
+        item['start'] = min(item['start'], start)
+        item['end'] = max(item['end'], end)
+        item['bytes'] += (result.get('bytes_sent') or 0) + (result.get('bytes_received') or 0)
+        if result['return_code'] != 0:
+            item['exit_code'] = result['return_code']
+            item['failures'] += 1
+    for item in summary.values():
+        item['duration'] = item.pop('end') - item.pop('start')
+    return summary
+
+def _metric_labels(**labels):
+    """ return prometheus labels """
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in sorted(labels.items())) + '}'
+
+def write_metrics(path, method_name, results, started):
+    """ write metrics of a run to path
+
+    if path ends with .json metrics written as a json document, otherwise
+    as a prometheus node_exporter textfile. file replaced atomically.
+
+    args:
+        path: path of metrics file
+        method_name: 'push' or 'pull'
+        results: statistics of rsync commands of the run (see syncronize_host)
+        started: start time of the run
+    """
+    import json
+    syncs = _summarize_results(results, lambda result: result['sync'])
+    hosts = _summarize_results(results, lambda result: (result['sync'], result['host']))
+    with closing(open_state()) as db:
+        last_success = db.execute('SELECT sync, host, time FROM last_success').fetchall()
+    duration = time.time() - started
+
+    if path.endswith('.json'):
+        document = {
+            'method': method_name,
+            'time': started,
+            'duration': duration,
+            'syncs': {name: dict(item, hosts={}) for name, item in syncs.items()},
+            'last_success': {},
+        }
+        for (sync_name, host_name), item in hosts.items():
+            document['syncs'][sync_name]['hosts'][host_name] = item
+        for sync_name, host_name, success_time in last_success:
+            document['last_success'].setdefault(sync_name, {})[host_name] = success_time
+        content = json.dumps(document, indent=2, sort_keys=True) + '\n'
+    else:
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP syncme_{} {}'.format(name, help_text))
+            lines.append('# TYPE syncme_{} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('syncme_{}{} {}'.format(name, labels, value))
+
+        metric('run_timestamp_seconds', 'Start time of last run.',
+               [(_metric_labels(method=method_name), started)])
+        metric('run_duration_seconds', 'Duration of last run.',
+               [(_metric_labels(method=method_name), duration)])
+        metric('sync_duration_seconds', 'Duration of sync in last run.',
+               [(_metric_labels(method=method_name, sync=name), item['duration'])
+                for name, item in syncs.items()])
+        for name, key, help_text in (
+                ('host_duration_seconds', 'duration', 'Duration of sync with host.'),
+                ('host_transferred_bytes', 'bytes', 'Bytes sent and received.'),
+                ('host_exit_code', 'exit_code', 'Last non zero rsync exit code.'),
+                ('host_failed_paths', 'failures', 'Number of failed rsync commands.')):
+            metric(name, help_text, [
+                (_metric_labels(method=method_name, sync=sync_name, host=host_name), item[key])
+                for (sync_name, host_name), item in hosts.items()])
+        metric('last_success_timestamp_seconds', 'Time of last successful sync with host.',
+               [(_metric_labels(sync=sync_name, host=host_name), success_time)
+                for sync_name, host_name, success_time in last_success])
+        content = '\n'.join(lines) + '\n'
+
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+def walk_tree(root):
+    """ walk a local tree and yield (relative path, stat) of its entries
+
+    entries of each directory sorted by name and directories walked depth
+    first, so order of entries is stable and same as order of lists of
+    path components. only listings of directories on the current branch
+    kept in memory.
+    """
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except NotADirectoryError:
+        return
+    stack = [('', iter(entries))]
+    while stack:
+        directory, entries = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            continue
+        path = os.path.join(directory, entry.name)
+        yield path, entry.stat(follow_symlinks=False)
+        if entry.is_dir(follow_symlinks=False):
+            with os.scandir(entry.path) as it:
+                stack.append((path, iter(sorted(it, key=lambda entry: entry.name))))
+
+def _read_records(path):
+    """ yield NUL terminated records of a file, yield nothing if file does not exist """
+    try:
+        state_file = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with state_file:
+        rest = b''
+        for chunk in iter(lambda: state_file.read(1 << 16), b''):
+            records = (rest + chunk).split(b'\0')
+            rest = records.pop()
+            for record in records:
+                yield record
+
+def scan_changes(root, state_path, new_state_path, list_path, prefix='', deletions=False):
+    """ compare local tree with its state at last push
+
+    tree is walked with walk_tree and compared with state file entry by
+    entry, both are in same order so nothing but current entries kept in
+    memory. changed and new entries and if deletions is True deleted
+    entries written to list_path as a NUL separated list for rsync
+    --files-from, and new state of tree written to new_state_path.
+
+    args:
+        root: local tree
+        state_path: state file of last push
+        new_state_path: path to write new state
+        list_path: path to write list of changed entries
+        prefix: prefix added to entries of list
+        deletions: if set True deleted entries added to list
+
+    return: tuple (number of changed entries, number of deleted entries)
+    """
+    def parse(record):
+        mode, size, mtime, path = record.split(b' ', 3)
+        path = os.fsdecode(path)
+        return path.split(os.sep), path, (int(mode), int(size), int(mtime))
+
+    def add(path):
+        list_file.write(os.fsencode(os.path.join(prefix, path)) + b'\0')
+
+    old_entries = (parse(record) for record in _read_records(state_path))
+    changed = deleted = 0
+    deleted_dir = None
+
+    def delete(old):
+        nonlocal deleted, deleted_dir
+        deleted += 1
+        # entries of a deleted directory deleted with it
+        if deleted_dir is not None and old[0][:len(deleted_dir)] == deleted_dir:
+            return
+        if stat_module.S_ISDIR(old[2][0]):
+            deleted_dir = old[0]
+        if deletions:
+            add(old[1])
+
+    with open(new_state_path, 'wb') as state_file, open(list_path, 'wb') as list_file:
+        old = next(old_entries, None)
+        for path, stat in walk_tree(root):
+            key = path.split(os.sep)
+            # size and mtime of directories change with their content
+            if stat_module.S_ISDIR(stat.st_mode):
+                signature = (stat.st_mode, 0, 0)
+            else:
+                signature = (stat.st_mode, stat.st_size, stat.st_mtime_ns)
+            state_file.write('{} {} {} '.format(*signature).encode() +
+                             os.fsencode(path) + b'\0')
+
+            while old is not None and old[0] < key:
+                delete(old)
+                old = next(old_entries, None)
+            if old is not None and old[0] == key:
+                if old[2] != signature:
+                    changed += 1
+                    add(path)
+                old = next(old_entries, None)
+            else:
+                changed += 1
+                add(path)
+        while old is not None:
+            delete(old)
+            old = next(old_entries, None)
+
+    return changed, deleted
+
+def _short_options(tag):
+    """ return letters of a tag that bundles short options, e.g. 'avz' of
+    -avz, up to an option that takes rest of the tag as its argument (e.g.
+    -essh). return empty string for other tags """
+    if not tag.startswith('-') or tag.startswith('--'):
+        return ''
+    letters = ''
+    for letter in tag[1:]:
+        letters += letter
+        if letter in SHORT_ARGUMENT_OPTIONS:
+            break
+    return letters
+
+def _deletes(tags):
+    """ return True if rsync tags delete extraneous files on destination """
+    return any(tag in DELETE_TAGS for tag in tags)
+
+def _is_recursive(tags):
+    """ return True if rsync tags recurse into directories, with -r, -a or
+    a bundle of short options that has one of them (e.g. -avz) """
+    for tag in tags:
+        if tag in ('-r', '--recursive', '-a', '--archive'):
+            return True
+        if any(option in _short_options(tag) for option in 'ar'):
+            return True
+    return False
+
+def _without_recursion(tags, archive=True):
+    """ return tags without options that recurse into directories
+
+    -r removed from tags and bundles of short options. if archive is True,
+    -a replaced by -lptgoD, options of -a other than -r, e.g. -avz becomes
+    -lptgoDvz.
+
+    args:
+        tags: list of rsync tags
+        archive: if set False -a kept (it does not recurse with --files-from)
+    """
+    result = []
+    for tag in tags:
+        letters = _short_options(tag)
+        if tag in ('-r', '--recursive'):
+            continue
+        elif tag == '--archive' and archive:
+            tag = '-lptgoD'
+        elif 'r' in letters or (archive and 'a' in letters):
+            new_letters = letters.replace('r', '')
+            if archive:
+                new_letters = new_letters.replace('a', 'lptgoD')
+            if not new_letters:
+                continue
+            tag = '-' + new_letters + tag[1 + len(letters):]
+        result.append(tag)
+    return result
+
+def push_delta(state_key, **kwargs):
+    """ push only entries of local path that changed since its last push
+
+    local tree scanned and compared with its state at last successful push
+    and only changed entries pushed with rsync --files-from. deleted
+    entries deleted on remote host with --delete-missing-args and --force if
+    a --delete option is in tags. If there is no state (first push) whole path pushed.
+
+    args:
+        state_key: unique name of (sync, host, path) used for state file
+        other arguments are same as push
+    """
+    import tempfile
+    local_path = os.path.expanduser(kwargs['local_path'])
+    tags = kwargs.get('tags', [])
+    if not os.path.isdir(local_path):
+        return push(**kwargs)
+    if local_path.endswith('/'):
+        base, prefix = local_path, ''
+    else:
+        base, prefix = os.path.split(local_path)
+        base = (base or '.') + '/'
+    deletions = _deletes(tags)
+
+    state_dir = os.path.join(CACHE_DIR, 'delta')
+    os.makedirs(state_dir, exist_ok=True)
+    state_path = os.path.join(state_dir, state_key)
+    new_state_path = state_path + '.new'
+    list_fd, list_path = tempfile.mkstemp(prefix='syncme-', suffix='.list')
+    os.close(list_fd)
+    try:
+        changed, deleted = scan_changes(
+            os.path.join(base, prefix), state_path, new_state_path, list_path,
+            prefix, deletions)
+        if not os.path.exists(state_path):
+            return_code = push(**kwargs)
+        elif changed == 0 and (deleted == 0 or not deletions):
+            logger.info('no change in %s since last push, skipped', kwargs['local_path'])
+            return_code = 0
+        else:
+            logger.info('pushing %d changed and %d deleted entries of %s',
+                        changed, deleted if deletions else 0, kwargs['local_path'])
+            options = dict(kwargs, local_path=base, recursive=False)
+            # --files-from does not recurse into listed directories without
+            # -r, and --delete options does not work without -r
+            options['tags'] = [tag for tag in _without_recursion(tags, archive=False)
+                               if tag not in DELETE_TAGS]
+            options['tags'] += ['--from0', '--files-from=' + list_path]
+            if deletions:
+                # a deleted directory listed without its entries, rsync
+                # deletes it only with --force if it's not empty on remote
+                options['tags'] += ['--delete-missing-args', '--force']
+            return_code = push(**options)
+        if return_code == 0:
+            os.replace(new_state_path, state_path)
+    finally:
+        os.remove(list_path)
+        if os.path.exists(new_state_path):
+            os.remove(new_state_path)
+    return return_code
+
+def estimate_sizes(path):
+    """ return dict of top-level entries of a local directory to their size
+
+    size of an entry is total size of its tree. sizes cached in state
+    database and an entry walked again only if its cached size is older
+    than SIZE_CACHE_TTL, they are used to balance shards so they do not
+    need to be exact.
+
+    args:
+        path: local directory
+    """
+    path = os.path.expanduser(path)
+    now = time.time()
+    with closing(open_state()) as db:
+        cached = {entry: size for entry, size in db.execute(
+            'SELECT entry, size FROM sizes WHERE path=? AND updated>=?',
+            (path, now - SIZE_CACHE_TTL))}
+    sizes = {}
+    updated = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name in cached:
+                sizes[entry.name] = cached[entry.name]
+                continue
+            size = entry.stat(follow_symlinks=False).st_size
+            if entry.is_dir(follow_symlinks=False):
+                size += sum(stat.st_size for _, stat in walk_tree(entry.path))
+            sizes[entry.name] = size
+            updated.append((path, entry.name, size, now))
+    with closing(open_state()) as db, db:
+        db.execute('DELETE FROM sizes WHERE path=? AND updated<?',
+                   (path, now - SIZE_CACHE_TTL))
+        db.executemany('INSERT OR REPLACE INTO sizes VALUES (?, ?, ?, ?)', updated)
+    return sizes
+
+def split_shards(sizes, count):
+    """ split entries to at most count shards of about same total size
+
+    entries assigned biggest first to the shard with smallest total size
+    (longest processing time first). empty shards dropped.
+
+    args:
+        sizes: dict of entry name to its size
+        count: number of shards
+
+    return: list of shards, each shard is a sorted list of entry names
+    """
+    import heapq
+    shards = [(0, index, []) for index in range(count)]
+    for name in sorted(sizes, key=lambda name: (-sizes[name], name)):
+        total, index, names = heapq.heappop(shards)
+        names.append(name)
+        heapq.heappush(shards, (total + sizes[name], index, names))
+    return [sorted(names) for _, _, names in sorted(shards, key=lambda shard: shard[1])
+            if names]
+
+def push_sharded(count, **kwargs):
+    """ push a local directory with several concurrent rsync commands
+
+    top-level entries of directory split to count shards of about same size
+    (see estimate_sizes and split_shards) and each shard pushed to same
+    destination with its own rsync --files-from -r at the same time. if a
+    --delete option is in tags, entries that deleted from top of directory
+    deleted on remote host with one more rsync --dirs when all shards are
+    successful.
+
+    output of shards streamed as they run (see OutputStream) and their
+    statistics summed, so directory reported as one path.
+
+    args:
+        count: number of shards
+        other arguments are same as push, path is pushed recursively
+
+    return: 0 if all shards successful, otherwise return code of first failed shard
+    """
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    local_path = os.path.expanduser(kwargs['local_path'])
+    if not os.path.isdir(local_path):
+        return push(**kwargs)
+    if local_path.endswith('/'):
+        base, prefix = local_path, ''
+    else:
+        base, prefix = os.path.split(local_path)
+        base = (base or '.') + '/'
+    shards = split_shards(estimate_sizes(local_path), count)
+    if len(shards) <= 1:
+        return push(**dict(kwargs, recursive=True))
+
+    tags = kwargs.get('tags', [])
+    output = kwargs.get('output')
+    stats = kwargs.get('stats')
+    if isinstance(output, OutputStream):
+        outputs = [output.for_path(output.path) for _ in shards]
+    elif output is not None:
+        outputs = [output for _ in shards]
+    else:
+        # lines of shards prefixed, so they can be told apart
+        outputs = [OutputStream(None, None, kwargs['local_path']) for _ in shards]
+    # bandwidth of the path shared by its shards
+    shard_tags = []
+    for tag in tags:
+        if tag.startswith('--bwlimit='):
+            try:
+                rate = parse_rate(tag.split('=', 1)[1])
+            except ValueError:
+                rate = None
+            if rate is not None:
+                tag = '--bwlimit={}'.format(max(1, int(rate / len(shards))))
+        shard_tags.append(tag)
+    shard_stats = [{} if stats is not None else None for _ in shards]
+    list_paths = []
+    start = time.monotonic()
+    logger.info('pushing %s in %d shards', kwargs['local_path'], len(shards))
+    try:
+        for shard in shards:
+            list_fd, list_path = tempfile.mkstemp(prefix='syncme-', suffix='.list')
+            with os.fdopen(list_fd, 'wb') as list_file:
+                for name in shard:
+                    list_file.write(os.fsencode(os.path.join(prefix, name)) + b'\0')
+            list_paths.append(list_path)
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            futures = [executor.submit(
+                _with_cancellation(push), **dict(kwargs, local_path=base, recursive=True, output=outputs[index],
+                             stats=shard_stats[index],
+                             tags=shard_tags + ['--from0', '--files-from=' + list_path]))
+                       for index, list_path in enumerate(list_paths)]
+            return_codes = [future.result() for future in futures]
+    finally:
+        for list_path in list_paths:
+            os.remove(list_path)
+
+    return_code = next((code for code in return_codes if code != 0), 0)
+    if return_code == 0 and _deletes(tags):
+        # -a and -r recurse whole tree, --dirs only looks at top of it
+        options = dict(kwargs, local_path=os.path.join(base, prefix, ''),
+                       remote_path=os.path.join(kwargs['remote_path'], prefix, ''),
+                       recursive=False, output=outputs[-1], stats=None)
+        options['tags'] = _without_recursion(tags) + ['--dirs']
+        return_code = push(**options)
+
+    if stats is not None:
+        for field in STATS_FIELDS.values():
+            values = [item[field] for item in shard_stats if field in item]
+            if values:
+                stats[field] = sum(values)
+        sent = stats.get('bytes_sent', 0) + stats.get('bytes_received', 0)
+        if 'total_size' in stats and sent:
+            stats['speedup'] = stats['total_size'] / sent
+        stats['wall_time'] = time.monotonic() - start
+    return return_code
+
+def _path_setting(setting, path, default):
+    """ return value of a per path setting (a value or dict of paths to values) for path """
+    if isinstance(setting, dict):
+        for setting_path, value in setting.items():
+            if os.path.normpath(setting_path) == os.path.normpath(path):
+                return value
+        return default
+    return setting
+
+def _rsync_options(kwargs):
+    """ return arguments of push or pull that passed to rsync as is """
+    return {key: value for key, value in kwargs.items()
+            if key not in ('local_path', 'remote_path', 'host', 'user')}
+
+def push(**kwargs):
+    """ transfer file from local to remote
+
+    args:
+        local_path: path of source file to transfer or list of paths
+        remote_path: path of destination file
+        host: remote host address
+        user: user of remote host
+        recursive: if set True path trasfered recursively
+        tags: list of str tags(options) added to rsync command
+        output: if a list given, rsync output captured and appended to it
+
+        other arguments passed to rsync
+    """
+    options = _rsync_options(kwargs)
+    return_code = rsync(
+        source_path=kwargs.get('local_path'), dest_path=kwargs.get('remote_path'),
+            dest_host=kwargs.get('host'), dest_user=kwargs.get('user'), **options)
+
+    return return_code
+
+def pull(**kwargs):
+    """ transfer file from remote to local
+
+    args:
+        local_path: path of source file (destination)
+        remote_path: path of remote file or list of paths
+        host: remote host address
+        user: user of remote host
+        recursive: if set True path trasfered recursively
+        tags: list of str tags(options) added to rsync command
+        output: if a list given, rsync output captured and appended to it
+
+        other arguments passed to rsync
+    """
+    options = _rsync_options(kwargs)
+    return_code = rsync(
+        dest_path=kwargs.get('local_path'), source_path=kwargs.get('remote_path'),
+            source_host=kwargs.get('host'), source_user=kwargs.get('user'), **options)
+    return return_code
+
+class _Cancellation:
+    """ cancel rsync commands of a run
+
+    threads that work for a run have it in _LOCAL.cancellation (see
+    _with_cancellation). when run cancelled its running rsync commands
+    terminated, and rsync commands that start later return RSYNC_CANCELLED
+    without running.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            processes = list(self._processes)
+        for process in processes:
+            try:
+                process.terminate()
+            except OSError:
+                pass
+
+    def register(self, process):
+        """ add a running process, it's terminated if run is already cancelled """
+        with self._lock:
+            self._processes.add(process)
+            cancelled = self._event.is_set()
+        if cancelled:
+            process.terminate()
+
+    def unregister(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def wait(self, seconds):
+        """ sleep for seconds or until run cancelled, return True if cancelled """
+        return self._event.wait(seconds)
+
+
+def _with_cancellation(func, cancellation=None):
+    """ return func that runs with cancellation of calling thread (or given
+    cancellation) in a worker thread """
+    if cancellation is None:
+        cancellation = getattr(_LOCAL, 'cancellation', None)
+    if cancellation is None:
+        return func
+
+    def run(*args, **kwargs):
+        _LOCAL.cancellation = cancellation
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _LOCAL.cancellation = None
+    return run
+
+
+def _sleep(seconds):
+    """ sleep for seconds, wake up when run of thread cancelled """
+    cancellation = getattr(_LOCAL, 'cancellation', None)
+    if cancellation is None:
+        time.sleep(seconds)
+    else:
+        cancellation.wait(seconds)
+
+
+class ProgressDisplay:
+    """ one line of aggregate progress of rsync commands that run at same time
+
+    rsync commands with --info=progress2 report bytes transferred and rate
+    of their whole transfer. report of each command kept and their sum
+    written on one line of a terminal, at most once in interval seconds.
+    nothing written if file is not a terminal.
+
+    args:
+        file: file that progress written to, sys.stderr by default
+        interval: minimum seconds between updates of the line
+    """
+
+    def __init__(self, file=None, interval=0.5):
+        self.file = file
+        self.interval = interval
+        self._transfers = {}
+        self._updated = 0
+        self._shown = False
+
+    def _file(self):
+        return self.file if self.file is not None else sys.stderr
+
+    def update(self, key, transferred, rate):
+        """ set bytes transferred and rate (bytes per second) of a command """
+        with _OUTPUT_LOCK:
+            self._transfers[key] = (transferred, rate)
+            now = time.monotonic()
+            if now - self._updated >= self.interval:
+                self._updated = now
+                self._write()
+
+    def finish(self, key):
+        """ remove a finished command from progress """
+        with _OUTPUT_LOCK:
+            if self._transfers.pop(key, None) is not None:
+                if self._transfers:
+                    self._write()
+                else:
+                    self.clear()
+
+    def _write(self):
+        file = self._file()
+        if not file.isatty():
+            return
+        transferred = sum(item[0] for item in self._transfers.values())
+        rate = sum(item[1] for item in self._transfers.values())
+        file.write('\r{} transfers, {} transferred, {}/s\x1b[K'.format(
+            len(self._transfers), _format_size(transferred), _format_size(rate)))
+        file.flush()
+        self._shown = True
+
+    def clear(self):
+        """ erase progress line, so an output line can be written.
+        _OUTPUT_LOCK must be held """
+        if self._shown:
+            self._file().write('\r\x1b[K')
+            self._file().flush()
+            self._shown = False
+
+
+_PROGRESS = ProgressDisplay()
+
+
+class OutputStream:
+    """ stream output of rsync commands of a sync and host
+
+    it's given as output argument of rsync, so each line written as soon as
+    rsync writes it with a [sync/host/path] prefix, and only last lines of
+    each path kept to be reported if path fails. memory use does not grow
+    with output. --info=progress2 lines not written, they update the
+    aggregate progress line (see ProgressDisplay).
+
+    args:
+        sync_name: name of sync
+        host_name: name of host
+        path: local path that output belongs to, see for_path. parts of
+            prefix that are None left out
+        tail: number of last lines of each path kept
+        file: file that lines written to, sys.stdout by default
+    """
+
+    def __init__(self, sync_name, host_name, path=None, tail=OUTPUT_TAIL, file=None,
+                 tails=None):
+        self.sync_name = sync_name
+        self.host_name = host_name
+        self.path = path
+        self.tail = tail
+        self.file = file
+        self._tails = tails if tails is not None else {}
+        self.prefix = '/'.join(str(part) for part in (sync_name, host_name, path)
+                               if part is not None)
+
+    def for_path(self, path):
+        """ return stream of output of path, that shares tails of this stream """
+        return OutputStream(self.sync_name, self.host_name, path, self.tail, self.file,
+                            self._tails)
+
+    def append(self, line):
+        """ write a line of rsync output """
+        match = PROGRESS_LINE.match(line)
+        if match:
+            _PROGRESS.update(self, int(match.group(1).replace(',', '')),
+                             _parse_progress_rate(match.group(3), match.group(4)))
+            return
+        if self.path not in self._tails:
+            from collections import deque
+            self._tails[self.path] = deque(maxlen=self.tail)
+        self._tails[self.path].append(line)
+        with _OUTPUT_LOCK:
+            _PROGRESS.clear()
+            file = self.file if self.file is not None else sys.stdout
+            file.write('[{}] {}'.format(self.prefix, line))
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def finish(self):
+        """ called when rsync command of stream is done """
+        _PROGRESS.finish(self)
+
+    def get_tail(self, path=None):
+        """ return last lines of output of path """
+        return list(self._tails.get(path, ()))
+
+
+def _parse_progress_rate(number, unit):
+    """ return bytes per second of rate of a --info=progress2 line """
+    factors = {'B': 1, 'kB': 1024, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+    return float(number.replace(',', '')) * factors.get(unit, 1)
+
+
+def _read_lines(pipes, handle):
+    """ read lines of pipes as they are written and call handle with each of them
+
+    pipes read together with a selector, so a process that fills one of
+    them does not block. \\r ends a line too, as rsync progress lines
+    overwrite each other with it. a long line without end is handled in
+    parts, so memory use is bounded.
+
+    args:
+        pipes: list of binary pipes to read until their end
+        handle: function called with each line (bytes without end of line)
+    """
+    import selectors
+    selector = selectors.DefaultSelector()
+    buffers = {}
+    for pipe in pipes:
+        selector.register(pipe, selectors.EVENT_READ)
+        buffers[pipe] = b''
+    with closing(selector):
+        while buffers:
+            for key, _ in selector.select():
+                pipe = key.fileobj
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(pipe)
+                    if buffers[pipe]:
+                        handle(buffers[pipe])
+                    del buffers[pipe]
+                    continue
+                lines = re.split(rb'[\r\n]', buffers[pipe] + chunk)
+                buffers[pipe] = lines.pop()
+                if len(buffers[pipe]) > 65536:
+                    lines.append(buffers[pipe])
+                    buffers[pipe] = b''
+                for line in lines:
+                    if line:
+                        handle(line)
+
+
+def rsync(**kwargs):
+    """ this is wrapper around rsync command
+
+    args:
+        source_path: path of source file or list of paths of source files
+        dest_path: path of destination file
+        source_host: address of source host
+        dest_host: address of destination host
+        source_user: source host username
+        dest_user: destination host username
+        tags: list of str tags(options) added to rsync command
+        recursive: if set True -r option added to rsync
+        output: if a list (or an object with append method like
+            OutputStream) given, stdout and stderr of rsync read line by
+            line as they are written and appended to it instead of being
+            printed. finish method of it called when rsync is done
+        ssh_command: remote shell command used by rsync (-e option)
+        relay: tuple (user, address) of a host that rsync runs on with ssh.
+            source paths are on that host, ssh_command used to connect to it
+        daemon: if a dict given, remote host reached with rsync daemon
+            protocol (rsync:// url) instead of ssh. it has module of daemon
+            and optional port and password_file (see _daemon_options)
+        stats: if a dict given, --stats option added to rsync and transfer
+            statistics and wall time of rsync added to it (see parse_stats)
+    """
+    import getpass
+    import subprocess as sp
+
+    # set default user for source and destination
+    if kwargs.get('source_user') is None:
+        kwargs['source_user'] = getpass.getuser()
+    if kwargs.get('dest_user') is None:
+        kwargs['dest_user'] = getpass.getuser()
+
+    kwargs.setdefault('source_path', '.')
+    kwargs.setdefault('dest_path', '.')
+    kwargs.setdefault('tags', [])
+    kwargs.setdefault('recursive', False)
+
+    source_paths = kwargs['source_path']
+    if not isinstance(source_paths, list):
+        source_paths = [source_paths]
+
+    relay = kwargs.get('relay')
+    if relay is not None:
+        # rsync runs in home directory of relay host, and ~ is not expanded
+        # in quoted paths
+        rsync_path = 'rsync'
+        source_paths = [path[2:] if path.startswith('~/') else path for path in source_paths]
+    else:
+        rsync_path = find_rsync()
+
+    daemon = kwargs.get('daemon')
+    if kwargs.get('source_host', None) is None:
+        cmd = [rsync_path] + ['{0}'.format(path) for path in source_paths] + [
+               _remote_path(kwargs['dest_user'], kwargs['dest_host'],
+                            kwargs['dest_path'], daemon)]
+    elif kwargs.get('dest_host', None) is None and relay is None:
+        cmd = [find_rsync()] + [_remote_path(kwargs['source_user'], kwargs['source_host'],
+                                             path, daemon) for path in source_paths] + [
+               '{0}'.format(kwargs['dest_path'])]
+    else:
+        logger.critical('Both source and destination cannot be remote hosts')
+        return 1
+
+    # add recursive tag to command
+    if kwargs['recursive']:
+        cmd.append('-r')
+    if kwargs.get('ssh_command') is not None and relay is None and daemon is None:
+        cmd += ['-e', kwargs['ssh_command']]
+    if daemon is not None and daemon.get('password_file'):
+        cmd.append('--password-file=' + os.path.expanduser(daemon['password_file']))
+    stats = kwargs.get('stats')
+    if stats is not None:
+        cmd.append('--stats')
+    # add tags
+    cmd = cmd + kwargs['tags']
+    if relay is not None:
+        import shlex
+        ssh = shlex.split(kwargs['ssh_command']) if kwargs.get('ssh_command') else [SSH]
+        cmd = ssh + ['{0}@{1}'.format(*relay), ' '.join(shlex.quote(arg) for arg in cmd)]
+    logger.debug('debug: running ' + ' '.join(cmd))
+    cancellation = getattr(_LOCAL, 'cancellation', None)
+    if cancellation is not None and cancellation.is_set():
+        logger.warning('run cancelled, rsync not started')
+        return RSYNC_CANCELLED
+    start = time.monotonic()
+    output = kwargs.get('output')
+    if output is None and stats is None:
+        job = sp.Popen(cmd)
+    else:
+        job = sp.Popen(cmd, stdout=sp.PIPE,
+                       stderr=sp.PIPE if output is not None else None)
+    if cancellation is not None:
+        cancellation.register(job)
+
+    def handle(line):
+        line = line.decode('utf-8', 'replace') + '\n'
+        if stats is not None:
+            parse_stats(line, stats)
+        if output is not None:
+            output.append(line)
+        else:
+            sys.stdout.write(line)
+    try:
+        if output is not None or stats is not None:
+            _read_lines([job.stdout] + ([job.stderr] if output is not None else []), handle)
+    finally:
+        if output is not None or stats is not None:
+            job.stdout.close()
+            if output is not None:
+                job.stderr.close()
+        return_code = job.wait()
+        if cancellation is not None:
+            cancellation.unregister(job)
+        if hasattr(output, 'finish'):
+            output.finish()
+    if stats is not None:
+        stats['wall_time'] = time.monotonic() - start
+    return return_code
+
+def _remote_path(user, address, path, daemon=None):
+    """ return rsync argument of path on a remote host
+
+    user@address:path for ssh and rsync://user@address:port/module/path
+    for rsync daemon, paths of daemon are relative to its module.
+    """
+    if daemon is None:
+        return '{0}@{1}:{2}'.format(user, address, path)
+    if path.startswith('~/'):
+        path = path[2:]
+    port = ':{}'.format(daemon['port']) if daemon.get('port') else ''
+    return 'rsync://{0}@{1}{2}/{3}/{4}'.format(user, address, port, daemon['module'],
+                                               path.lstrip('/'))
+
+def _daemon_options(host):
+    """ return daemon argument of rsync for a host with rsyncd transport, None for ssh """
+    if host.get('transport', 'ssh') != 'rsyncd':
+        return None
+    return {'module': host['module'], 'port': host.get('port'),
+            'password_file': host.get('password_file')}
+
+def start_rsync_daemon(modules, port=None, read_only=False):
+    """ start a rsync daemon on local host, e.g. for testing rsyncd transport
+
+    daemon runs as a child process with a config in a temporary
+    directory that deleted when syncme exits, and listens on 127.0.0.1.
+
+    args:
+        modules: dict of module name to local path
+        port: port to listen on, if None a free port used
+        read_only: if set True modules are read only
+
+    return: tuple (process of daemon, port)
+    """
+    import atexit
+    import shutil
+    import socket
+    import subprocess as sp
+    import tempfile
+    if port is None:
+        with closing(socket.socket()) as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+    config_dir = tempfile.mkdtemp(prefix='syncme-rsyncd-')
+    config_path = os.path.join(config_dir, 'rsyncd.conf')
+    with open(config_path, 'w') as config_file:
+        config_file.write('use chroot = no\npid file = {}\n'.format(
+            os.path.join(config_dir, 'rsyncd.pid')))
+        for name, path in modules.items():
+            config_file.write('[{}]\npath = {}\nread only = {}\n'.format(
+                name, os.path.abspath(os.path.expanduser(path)),
+                'yes' if read_only else 'no'))
+    cmd = [find_rsync(), '--daemon', '--no-detach', '--address=127.0.0.1',
+           '--port={}'.format(port), '--config=' + config_path]
+    logger.debug('debug: running ' + ' '.join(cmd))
+    process = sp.Popen(cmd)
+    # daemon reads its config for every connection
+    atexit.register(shutil.rmtree, config_dir, True)
+    # wait until daemon accepts connections
+    start = time.monotonic()
+    while process.poll() is None and time.monotonic() - start < 5:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process, port
+
+def parse_stats(line, stats):
+    """ parse a line of rsync --stats output and add its value to stats dict
+
+    keys are values of STATS_FIELDS and speedup, sizes are in bytes
+    """
+    match = STATS_LINE.match(line)
+    if match is not None and match.group(1) in STATS_FIELDS:
+        number = float(match.group(2).replace(',', ''))
+        number *= 1024 ** ' KMGTP'.index(match.group(3) or ' ')
+        stats[STATS_FIELDS[match.group(1)]] = int(number)
+        return
+    match = SPEEDUP_LINE.search(line)
+    if match is not None:
+        stats['speedup'] = float(match.group(1).replace(',', ''))
+
+def sample_compression(path, files=32, sample_size=64 * 1024):
+    """ estimate how well files of a local path compress
+
+    up to sample_size bytes of at most files regular files (spread over
+    first entries of the tree) compressed with zlib in each of
+    COMPRESSION_LEVELS.
+
+    args:
+        path: local file or directory
+        files: number of files to sample
+        sample_size: number of bytes to read from each file
+
+    return: dict with 'levels', a dict of level to tuple (compressed size /
+        size, compressed bytes per second), and 'incompressible', a sorted
+        list of file suffixes that do not compress. None if nothing to
+        sample
+    """
+    import zlib
+    path = os.path.expanduser(path)
+    candidates = []
+    try:
+        if os.path.isfile(path):
+            candidates.append(path)
+        for name, stat in walk_tree(path):
+            if stat_module.S_ISREG(stat.st_mode) and stat.st_size:
+                candidates.append(os.path.join(path, name))
+            if len(candidates) >= files * 32:
+                break
+    except OSError as e:
+        logger.debug('debug: cannot sample %s: %s', path, e)
+    step = max(1, len(candidates) // files)
+    samples = []
+    for file_path in candidates[::step][:files]:
+        try:
+            with open(file_path, 'rb') as f:
+                samples.append((file_path, f.read(sample_size)))
+        except OSError:
+            continue
+    size = sum(len(data) for _, data in samples)
+    if not size:
+        return None
+
+    levels = {}
+    for level in COMPRESSION_LEVELS:
+        start = time.perf_counter()
+        compressed = sum(len(zlib.compress(data, level)) for _, data in samples)
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        levels[level] = (compressed / size, size / elapsed)
+    suffixes = {}
+    for file_path, data in samples:
+        suffix = os.path.splitext(file_path)[1][1:].lower()
+        if suffix and data:
+            ratio = len(zlib.compress(data, 1)) / len(data)
+            suffixes.setdefault(suffix, []).append(ratio)
+    incompressible = sorted(suffix for suffix, ratios in suffixes.items()
+                            if min(ratios) >= 0.95)
+    return {'levels': levels, 'incompressible': incompressible}
+
+def link_throughput(host_name, days=30):
+    """ return average throughput of transfers with host in bytes per second
+
+    computed from statistics history (stats setting) of transfers that
+    sent or received more than 1 MiB. None if there is no history.
+    """
+    with closing(open_state()) as db:
+        row = db.execute(
+            'SELECT SUM(bytes_sent + bytes_received), SUM(wall_time) FROM stats '
+            'WHERE host=? AND time>=? AND return_code=0 AND '
+            'bytes_sent + bytes_received > 1048576 AND wall_time > 0',
+            (host_name, time.time() - days * 86400)).fetchone()
+    if not row or not row[0]:
+        return None
+    return row[0] / row[1]
+
+def choose_compression(sample, throughput=None):
+    """ return rsync options of compression for a sample and link throughput
+
+    compression used with the level that gives the highest effective
+    throughput: a compressed transfer is limited by speed of compression
+    and by link throughput divided by compression ratio. it must be at
+    least 10% faster than an uncompressed transfer. if throughput of link
+    is unknown, compression used if data compresses to less than 80%.
+
+    args:
+        sample: result of sample_compression
+        throughput: throughput of link in bytes per second
+    """
+    if sample is None:
+        return []
+    if throughput is None:
+        ratio, _ = sample['levels'][COMPRESSION_LEVELS[0]]
+        if ratio >= 0.8:
+            return []
+        level = COMPRESSION_LEVELS[0]
+    else:
+        level, rate = None, throughput * 1.1
+        for candidate, (ratio, speed) in sorted(sample['levels'].items()):
+            candidate_rate = min(speed, throughput / max(ratio, 0.01))
+            if candidate_rate > rate:
+                level, rate = candidate, candidate_rate
+        if level is None:
+            return []
+    options = ['-z', '--compress-level={}'.format(level)]
+    extra = [suffix for suffix in sample['incompressible'] if suffix not in SKIP_COMPRESS]
+    if extra:
+        options.append('--skip-compress=' + '/'.join(SKIP_COMPRESS + tuple(extra)))
+    return options
+
+def compression_options(host_name, local_path):
+    """ return compression options of rsync for a path and host
+
+    decision made by choose_compression from a sample of local path and
+    throughput of host and cached for COMPRESSION_CACHE_TTL seconds.
+    """
+    import json
+    now = time.time()
+    with closing(open_state()) as db:
+        row = db.execute(
+            'SELECT options FROM compression WHERE host=? AND local_path=? AND updated>=?',
+            (host_name, local_path, now - COMPRESSION_CACHE_TTL)).fetchone()
+    if row is not None:
+        options = json.loads(row[0])
+    else:
+        options = choose_compression(sample_compression(local_path),
+                                     link_throughput(host_name))
+        logger.debug('debug: compression of %s with %s: %s', local_path, host_name,
+                     ' '.join(options) or 'off')
+        with closing(open_state()) as db, db:
+            db.execute('INSERT OR REPLACE INTO compression VALUES (?, ?, ?, ?)',
+                       (host_name, local_path, json.dumps(options), now))
+    # rsync 3.2 negotiates zstd or lz4, levels are chosen for zlib
+    if options and rsync_version() >= (3, 2):
+        options = options + ['--compress-choice=zlib']
+    return options
+
+def parse_rate(rate):
+    """ return bandwidth rate in KiB per second, None if rate is 0 (unlimited)
+
+    rate is a number of KiB per second like rsync --bwlimit or a str with
+    K, M or G suffix, e.g. '10M'. ValueError raised for invalid rates.
+    """
+    if isinstance(rate, bool):
+        raise ValueError('invalid rate {!r}'.format(rate))
+    if isinstance(rate, (int, float)):
+        value = float(rate)
+    else:
+        match = RATE.match(str(rate))
+        if match is None:
+            raise ValueError('invalid rate {!r}'.format(rate))
+        value = float(match.group(1)) * 1024 ** 'KMG'.index(match.group(2).upper() or 'K')
+    if value < 0:
+        raise ValueError('invalid rate {!r}'.format(rate))
+    return value or None
+
+def _parse_schedule(schedule, limit):
+    """ return bandwidth schedule as list of (start minute, end minute, KiB/s or None)
+
+    args:
+        schedule: list of dicts with time ('HH:MM-HH:MM') and bandwidth
+            (a rate or percent of limit, e.g. '20%')
+        limit: bandwidth limit in KiB/s that percents are relative to
+
+    ValueError raised for invalid schedules
+    """
+    entries = []
+    for entry in schedule:
+        if not isinstance(entry, dict) or 'time' not in entry or 'bandwidth' not in entry:
+            raise ValueError('schedule entries must have time and bandwidth')
+        match = SCHEDULE_TIME.match(str(entry['time']))
+        if match is None:
+            raise ValueError('invalid time {!r}, use HH:MM-HH:MM'.format(entry['time']))
+        start_hour, start_minute, end_hour, end_minute = (int(group) for group in match.groups())
+        if max(start_hour, end_hour) > 24 or max(start_minute, end_minute) > 59:
+            raise ValueError('invalid time {!r}'.format(entry['time']))
+        rate = str(entry['bandwidth']).strip()
+        if rate.endswith('%'):
+            if limit is None:
+                raise ValueError('percents of bandwidth need a bandwidth setting')
+            rate = limit * float(rate[:-1]) / 100
+        entries.append((start_hour * 60 + start_minute, end_hour * 60 + end_minute,
+                        parse_rate(rate)))
+    return entries
+
+
+class BandwidthBudget:
+    """ share bandwidth limits among rsync commands that run at same time
+
+    a global limit (that may change by time of day) and a limit for each
+    host divided among rsync commands. rsync cannot change limit of a
+    running transfer, so each command gets a share of what is not used by
+    running commands when it starts: unused limit divided by number of
+    slots (concurrent jobs) that are free. when a command finishes its
+    share is free for next commands.
+
+    args:
+        limit: global limit in KiB/s, None for unlimited
+        host_limits: dict of host name to its limit in KiB/s
+        slots: number of commands that may run at same time
+        schedule: list of (start minute, end minute, limit) that override
+            limit in their time of day (see _parse_schedule)
+        host_slots: dict of host name to number of commands that may run
+            with the host at same time, slots by default
+    """
+
+    def __init__(self, limit=None, host_limits=None, slots=1, schedule=None,
+                 host_slots=None):
+        self.limit = limit
+        self.host_limits = host_limits or {}
+        self.slots = slots
+        self.host_slots = host_slots or {}
+        self.schedule = schedule or []
+        self._allocated = {}
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def current_limit(self, now=None):
+        """ return global limit at now (time.localtime() by default) """
+        if now is None:
+            now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, limit in self.schedule:
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return limit
+        return self.limit
+
+    def _share(self, key, limit):
+        slots = self.slots if key is None else self.host_slots.get(key, self.slots)
+        free_slots = max(1, slots - self._active.get(key, 0))
+        return max(1, (limit - self._allocated.get(key, 0)) / free_slots)
+
+    def acquire(self, host_name):
+        """ return bandwidth of a new command to host in KiB/s, None if unlimited
+
+        release must be called with same arguments when command finishes
+        """
+        with self._lock:
+            limits = {None: self.current_limit(), host_name: self.host_limits.get(host_name)}
+            shares = [self._share(key, limit) for key, limit in limits.items() if limit]
+            if not shares:
+                return None
+            share = min(shares)
+            for key in limits:
+                self._allocated[key] = self._allocated.get(key, 0) + share
+                self._active[key] = self._active.get(key, 0) + 1
+            return share
+
+    def release(self, host_name, share):
+        """ free share of a finished command """
+        if share is None:
+            return
+        with self._lock:
+            for key in (None, host_name):
+                self._allocated[key] -= share
+                self._active[key] -= 1
+
+
+def bandwidth_budget(config, jobs=1, host_slots=None):
+    """ return BandwidthBudget of bandwidth settings of config, None if there is no limit
+
+    args:
+        config: validated config
+        jobs: number of rsync commands that run at same time
+        host_slots: dict of host name to number of units that may run with
+            the host at same time
+    """
+    limit = parse_rate(config.get('bandwidth', 0))
+    schedule = _parse_schedule(config.get('bandwidth_schedule', []), limit)
+    host_limits = {}
+    for host in list(config['hosts']) + [host for sync in config['syncs']
+                                         for host in sync['hosts']]:
+        if host.get('bandwidth'):
+            host_limits[host['name']] = parse_rate(host['bandwidth'])
+    if limit is None and not host_limits and not any(entry[2] for entry in schedule):
+        return None
+    return BandwidthBudget(limit, host_limits, jobs, schedule, host_slots)
+
+def list_syncs(config):
+    """list syncs """
+    for sync in config['syncs']:
+        print('{}:'.format(sync['name']))
+        print('\tpaths:')
+        for path in sync['paths']:
+            print('\t\t{}'.format(path))
+        print('\thosts:')
+        for host in sync['hosts']:
+            print('\t\tname: {}'.format(host['name']))
+            print('\t\taddress: {}'.format(host['address']))
+            print('\t\tuser: {}'.format(host['user']))
+            print('\t\tpaths:')
+            for path in host['paths']:
+                print('\t\t\t{}'.format(path))
+        print('\ttags:')
+        for tag in sync['tags']:
+            print('\t\t{}'.format(tag))
+        print('')
+
+def _group_paths(method_name, path_pairs):
+    """ group path pairs that have same destination
+
+    destination is remote path in push and local path in pull. paths of a
+    group can be transfered with one rsync command with several sources.
+
+    args:
+        method_name: 'push' or 'pull'
+        path_pairs: list of tuple (local_path, remote_path)
+
+    return: list of groups, each group is a list of (local_path, remote_path)
+    """
+    destination_index = 1 if method_name == 'push' else 0
+    groups = OrderedDict()
+    for pair in path_pairs:
+        groups.setdefault(pair[destination_index], []).append(pair)
+    return list(groups.values())
+
+
+def syncronize_host(method_name, host, sync_paths, recursive=False, tags=[],
+                    output=None, batch=False, multiplex=False, sync_name=None,
+                    manifest=False, force=False, delta=False, results=None, shards=1,
+                    retries=0, retry_delay=5, partial_dir='.rsync-partial',
+                    bandwidth=None, compress=False):
+    """ syncronize sync paths base on method (push or pull) 
+
+    syncronize (pull or push) sync_paths with host paths
+
+    args:
+        method_name: string contain name of method use which used to syncronize. most be 'pull' or 'push'
+        host: host to syncronize with
+        sync_paths: list of paths for syncing with host's paths
+        tags: list of str tags(options) added to rsync command
+        recursive: if set True -r option added to rsync
+        output: if a list given, rsync output captured and appended to it,
+            if an OutputStream given output of each path streamed with its
+            own prefix (see OutputStream.for_path)
+        batch: if set True paths with same destination transfered with one
+            rsync command. if the command fails paths synced one by one to
+            find failed paths
+        multiplex: if set True all rsync commands use one ssh master
+            connection to host
+        sync_name: name of sync, used as key of manifest
+        manifest: if set True, in push paths that did not change since last
+            successful push to host are skipped
+        force: if set True paths pushed even if manifest says they did not
+            change
+        delta: if set True, in recursive push each path scanned for changes
+            since last push and only changed files pushed (see push_delta)
+        results: if a list given, statistics of each rsync command (see
+            rsync stats argument) with its sync, host, method, paths,
+            start time and return code appended to it. last lines of output
+            of a failed command added as tail if output is an OutputStream
+        shards: number of rsync commands that push each recursive directory
+            at the same time, or a dict of local paths to their number of
+            shards (see push_sharded)
+        retries: number of times a path synced again when rsync fails with
+            an error that may not happen again (see RETRY_CODES), or a dict
+            of local paths to their number of retries. waits between
+            retries grow exponentially from retry_delay seconds with random
+            jitter
+        retry_delay: seconds to wait before first retry
+        partial_dir: if retries is set, rsync --partial-dir option with this
+            directory added so interrupted files resume in next try
+        bandwidth: BandwidthBudget that gives each rsync command a
+            --bwlimit, not used if a --bwlimit option is in tags
+        compress: if set True -z option added to rsync, if set 'auto'
+            compression options of each path chosen by a sample of its files
+            and throughput of host (see compression_options). not used if a
+            compression option is in tags
+
+    returns: list of paths that failed to sync
+    """
+    import hashlib
+    import random
+    methods = {'push': push, 'pull': pull}
+
+    if method_name not in methods.keys():
+        raise AttributeError("method most 'push' or 'pull' ")
+    else:
+        method = methods[method_name]
+
+    # check if localpath is None, it happens when there are more remote_paths than local_paths
+    path_pairs = [(local_path, remote_path)
+                  for local_path, remote_path in zip(sync_paths, host['paths'])
+                  if local_path is not None]
+
+    fingerprints = {}
+    if manifest and method_name == 'push':
+        for local_path, remote_path in path_pairs:
+            fingerprints[local_path, remote_path] = tree_fingerprint(
+                local_path, remote_path, host['address'], host['user'], recursive, tags)
+        if not force:
+            unchanged = [pair for pair in path_pairs if fingerprints[pair] is not None and
+                         get_manifest(sync_name, host['name'], *pair) == fingerprints[pair]]
+            for local_path, remote_path in unchanged:
+                logger.info('path %s did not change since last push to %s, skipped',
+                            local_path, host['name'])
+            path_pairs = [pair for pair in path_pairs if pair not in unchanged]
+
+    def synced(pairs):
+        for pair in pairs:
+            if fingerprints.get(pair) is not None:
+                set_manifest(sync_name, host['name'], pair[0], pair[1], fingerprints[pair])
+
+    sharded = set()
+    if method_name == 'push' and (recursive or _is_recursive(tags)):
+        sharded = {pair for pair in path_pairs if _path_setting(shards, pair[0], 1) > 1}
+    # a path that is not pushed recursively has no tree of changes to push
+    delta = delta and method_name == 'push' and (recursive or _is_recursive(tags))
+
+    if delta:
+        # each path has its own list of changes, so they cannot be batched
+        groups = [[pair] for pair in path_pairs]
+    elif batch:
+        groups = _group_paths(method_name, [pair for pair in path_pairs
+                                            if pair not in sharded])
+        groups += [[pair] for pair in path_pairs if pair in sharded]
+    else:
+        groups = [[pair] for pair in path_pairs]
+
+    options = {'tags': tags, 'recursive': recursive, 'output': output,
+               'daemon': _daemon_options(host)}
+    if retries and partial_dir and not any(tag.startswith('--partial') for tag in tags):
+        options['tags'] = tags + ['--partial-dir=' + partial_dir]
+    if multiplex and options['daemon'] is None:
+        options['ssh_command'] = open_control_master(host['user'], host['address'])
+
+    if any(tag.startswith('--bwlimit') for tag in tags):
+        bandwidth = None
+    if any(tag.startswith('--compress') or tag.startswith('--skip-compress') or
+           (tag.startswith('-') and not tag.startswith('--') and 'z' in tag) for tag in tags):
+        compress = False
+    elif compress is True:
+        options['tags'] = options['tags'] + ['-z']
+
+    def run(local_path, remote_path):
+        share = bandwidth.acquire(host['name']) if bandwidth is not None else None
+        if share is None:
+            return transfer(local_path, remote_path, options)
+        try:
+            return transfer(local_path, remote_path, dict(
+                options, tags=options['tags'] + ['--bwlimit={}'.format(int(share))]))
+        finally:
+            bandwidth.release(host['name'], share)
+
+    def transfer(local_path, remote_path, options):
+        stats = {} if results is not None else None
+        started = time.time()
+        if compress == 'auto':
+            # a batch compressed like its first path
+            path = local_path[0] if isinstance(local_path, list) else local_path
+            options = dict(options, tags=options['tags'] +
+                           compression_options(host['name'], os.path.expanduser(path)))
+        if isinstance(options['output'], OutputStream):
+            options = dict(options, output=options['output'].for_path(_path_label(local_path)))
+        if delta:
+            state_key = hashlib.sha1(repr(
+                (sync_name, host['name'], host['address'], host['user'],
+                 local_path, remote_path)).encode()).hexdigest()
+            return_code = push_delta(state_key, local_path=local_path,
+                                     remote_path=remote_path, host=host['address'],
+                                     user=host['user'], stats=stats, **options)
+        elif not isinstance(local_path, list) and (local_path, remote_path) in sharded:
+            return_code = push_sharded(_path_setting(shards, local_path, 1), local_path=local_path,
+                                       remote_path=remote_path, host=host['address'],
+                                       user=host['user'], stats=stats, **options)
+        else:
+            return_code = method(local_path=local_path, remote_path=remote_path,
+                                 host=host['address'], user=host['user'],
+                                 stats=stats, **options)
+        if results is not None:
+            stats.update(time=started, sync=sync_name, host=host['name'],
+                         method=method_name, return_code=return_code,
+                         local_path=_path_label(local_path),
+                         remote_path=_path_label(remote_path))
+            if return_code != 0 and isinstance(options['output'], OutputStream):
+                stats['tail'] = options['output'].get_tail(options['output'].path)
+            results.append(stats)
+        return return_code
+
+    failed_paths = []
+    for group in groups:
+        if len(group) > 1:
+            if method_name == 'push':
+                local_path, remote_path = [pair[0] for pair in group], group[0][1]
+            else:
+                local_path, remote_path = group[0][0], [pair[1] for pair in group]
+            if run(local_path, remote_path) == 0:
+                synced(group)
+                continue
+            logger.warning('failed to sync (%s) %d paths with %s at once, '
+                           'syncing them one by one', method_name, len(group), host['name'])
+
+        for local_path, remote_path in group:
+            return_code = run(local_path, remote_path)
+            path_retries = _path_setting(retries, local_path, 0)
+            for attempt in range(path_retries):
+                if return_code not in RETRY_CODES:
+                    break
+                delay = min(RETRY_MAX_DELAY, retry_delay * 2 ** attempt)
+                delay = random.uniform(delay / 2, delay)
+                logger.warning('failed to sync (%s) path %s to %s with exit code %d, '
+                               'retry %d of %d in %.1f seconds', method_name, local_path,
+                               host['name'], return_code, attempt + 1, path_retries, delay)
+                _sleep(delay)
+                return_code = run(local_path, remote_path)
+            if return_code != 0:
+                logger.error(
+                    'failed to sync (%s) path %s to %s', method_name, local_path, host['name'])
+                failed_paths.append((local_path, remote_path))
+            else:
+                synced([(local_path, remote_path)])
+
+    return failed_paths
+
+
+def relay_host(parent, host, sync_paths, recursive=False, tags=[], output=None,
+               multiplex=False, sync_name=None, results=None):
+    """ push paths to host from parent host that already has them
+
+    rsync runs on parent host over ssh and pushes parent's copy of each
+    path to host, so data is not sent from local host again. parent host
+    must be able to connect to host with ssh (e.g. with agent forwarding).
+    only directories relayed, place of a file on remote host depends on
+    whether its destination is a directory. hosts with rsyncd transport
+    are not relayed.
+
+    args:
+        parent: host that has the paths
+        host: host to push paths to
+        sync_paths: list of local paths of sync
+        other arguments are same as syncronize_host
+
+    returns: list of paths that are not relayed, because they are not
+        directories or relaying them failed
+    """
+    not_relayed = []
+    if _daemon_options(parent) is not None or _daemon_options(host) is not None:
+        # rsync cannot run on a daemon host, and password file is local
+        return [(local_path, remote_path) for local_path, remote_path
+                in zip(sync_paths, host['paths']) if local_path is not None]
+    ssh_command = None
+    if multiplex:
+        ssh_command = open_control_master(parent['user'], parent['address'])
+    for local_path, parent_path, remote_path in zip(sync_paths, parent['paths'], host['paths']):
+        if local_path is None:
+            continue
+        if not os.path.isdir(os.path.expanduser(local_path)):
+            not_relayed.append((local_path, remote_path))
+            continue
+        # without trailing / directory itself pushed into destination
+        if not local_path.endswith('/'):
+            parent_path = os.path.join(parent_path, os.path.basename(os.path.normpath(local_path)))
+        stats = {} if results is not None else None
+        started = time.time()
+        path_output = output
+        if isinstance(output, OutputStream):
+            path_output = output.for_path(local_path)
+        return_code = push(local_path=parent_path, remote_path=remote_path,
+                           host=host['address'], user=host['user'], recursive=recursive,
+                           tags=tags, output=path_output, stats=stats, ssh_command=ssh_command,
+                           relay=(parent['user'], parent['address']))
+        if results is not None:
+            stats.update(time=started, sync=sync_name, host=host['name'], method='push',
+                         return_code=return_code, local_path=local_path,
+                         remote_path=remote_path)
+            results.append(stats)
+        if return_code != 0:
+            logger.warning('failed to relay path %s from %s to %s',
+                           local_path, parent['name'], host['name'])
+            not_relayed.append((local_path, remote_path))
+    return not_relayed
+
+
+def _path_label(path):
+    """ return path or list of paths of a batch as one str """
+    if isinstance(path, list):
+        return ' '.join(path)
+    return path
+
+
+def _host_key(host):
+    """ return key that identify a remote host connection """
+    return (host['user'], host['address'])
+
+
+def probe_hosts(hosts, timeout=5, first=False):
+    """ measure latency of hosts
+
+    probe hosts in parallel by running a no-op command over ssh, or by
+    listing module of hosts with rsyncd transport
+
+    args:
+        hosts: list of hosts to probe
+        timeout: seconds to wait for hosts to answer
+        first: if set True return as soon as one host answers and cancel
+            probe of other hosts
+
+    return: dict of host key to latency in seconds, unreachable hosts are
+        not in dict
+    """
+    import subprocess as sp
+    jobs = OrderedDict()
+    for host in hosts:
+        key = _host_key(host)
+        if key in jobs:
+            continue
+        daemon = _daemon_options(host)
+        if daemon is None:
+            cmd = [SSH, '-o', 'BatchMode=yes', '-o', 'ConnectTimeout={}'.format(timeout),
+                   '{0}@{1}'.format(*key), 'true']
+        else:
+            # list root of module
+            cmd = [find_rsync(), '--contimeout={}'.format(timeout),
+                   _remote_path(host['user'], host['address'], '', daemon)]
+            if daemon.get('password_file'):
+                cmd.append('--password-file=' + os.path.expanduser(daemon['password_file']))
+        jobs[key] = sp.Popen(cmd, stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+
+    start = time.monotonic()
+    latencies = {}
+    pending = dict(jobs)
+    while pending and time.monotonic() - start < timeout:
+        for key, job in list(pending.items()):
+            if job.poll() is None:
+                continue
+            del pending[key]
+            if job.returncode == 0:
+                latencies[key] = time.monotonic() - start
+        if first and latencies:
+            break
+        time.sleep(0.01)
+    # cancel probes that did not finish
+    for job in pending.values():
+        job.kill()
+        job.wait()
+
+    for key in jobs:
+        if key in latencies:
+            logger.info('probe %s@%s: %.0f ms', key[0], key[1], latencies[key] * 1000)
+        elif key in pending and latencies:
+            logger.info('probe %s@%s: cancelled', *key)
+        else:
+            logger.info('probe %s@%s: unreachable', *key)
+    return latencies
+
+
+def _order_hosts(hosts, latencies):
+    """ sort hosts by latency, unreachable hosts kept at the end in config order """
+    reachable = sorted((host for host in hosts if _host_key(host) in latencies),
+                       key=lambda host: latencies[_host_key(host)])
+    unreachable = [host for host in hosts if _host_key(host) not in latencies]
+    return reachable + unreachable
+
+
+def _sync_setting(config, sync, key, default=None):
+    """ return setting of sync, fallback to global setting of config """
+    return sync.get(key, config.get(key, default))
+
+
+def _syncronize_unit(method_name, config, sync, hosts, capture=False, force=False,
+                     results=None, bandwidth=None, state=None):
+    """ syncronize a sync with a list of hosts
+
+    this is one unit of work of syncronize_syncs. in pull method hosts are
+    tried one by one until a successful sync happens.
+
+    args:
+        method_name: string contain name of method use which used to syncronize. most be 'pull' or 'push'
+        config: config object that used for global settings
+        sync: sync to syncronize
+        hosts: list of hosts to syncronize with
+        capture: if set True rsync output streamed with [sync/host/path]
+            prefix of each line (see OutputStream), so output of units
+            running in parallel can be told apart. last lines of output of
+            failed paths logged again when the host is done
+        force: if set True manifest is ignored and all paths pushed
+        results: if a list given, statistics of rsync commands appended to
+            it (see syncronize_host)
+        bandwidth: BandwidthBudget shared by rsync commands of all units
+        state: _StateWrites of run that failures and last success kept in,
+            if None they are saved when each host is done
+
+    return: list of tuple (sync, host, failed_paths)
+    """
+    failed_syncs = []
+    for host in hosts:
+        logger.info('Syncronize (%s) %s with %s:', method_name.title(), sync['name'],
+                    host['name'])
+        tags = sync['tags']
+        if capture:
+            output = OutputStream(sync['name'], host['name'],
+                                  tail=_sync_setting(config, sync, 'output_tail', OUTPUT_TAIL))
+            if _sync_setting(config, sync, 'progress', False):
+                tags = tags + ['--info=progress2']
+        else:
+            output = None
+        host_results = [] if results is not None else None
+        failed_paths = syncronize_host(
+            method_name, host, sync['paths'], sync['recursive'], tags,
+            output=output, batch=_sync_setting(config, sync, 'batch', False),
+            multiplex=host.get('multiplex', config.get('multiplex', False)),
+            sync_name=sync['name'], manifest=_sync_setting(config, sync, 'manifest', False),
+            force=force, delta=_sync_setting(config, sync, 'delta', False),
+            results=host_results, shards=_sync_setting(config, sync, 'shards', 1),
+            bandwidth=bandwidth, compress=_sync_setting(config, sync, 'compress', False),
+            retries=_sync_setting(config, sync, 'retries', 0),
+            retry_delay=_sync_setting(config, sync, 'retry_delay', 5),
+            partial_dir=_sync_setting(config, sync, 'partial_dir', '.rsync-partial'))
+        path_pairs = [(local_path, remote_path) for local_path, remote_path
+                      in zip(sync['paths'], host['paths']) if local_path is not None]
+        writes = _StateWrites() if state is None else state
+        writes.save_failures(method_name, sync['name'], host['name'], path_pairs, failed_paths)
+        if not failed_paths:
+            writes.set_last_success(sync['name'], host['name'])
+        if state is None:
+            writes.flush()
+        if host_results is not None:
+            if host_results and config.get('stats', False):
+                save_stats(host_results)
+            results.extend(host_results)
+
+        with _OUTPUT_LOCK:
+            _PROGRESS.clear()
+            if capture:
+                sys.stdout.flush()
+                for local_path, _ in failed_paths:
+                    lines = output.get_tail(_path_label(local_path))
+                    if lines:
+                        logger.error('last lines of output of %s:\n%s',
+                                     _path_label(local_path), ''.join(lines).rstrip('\n'))
+            if failed_paths:
+                failed_syncs.append((sync, host, failed_paths))
+                logger.error(
+                    'Be careful paths partialy synced try to sync with another host')
+            else:
+                logger.info(
+                    'Local system successfully synced with %s', host['name'])
+        # after one successful pull stop pulling from other hosts
+        if not failed_paths and method_name == 'pull':
+            break
+
+    return failed_syncs
+
+
+def _spread_unit(method_name, config, sync, hosts, capture=False, force=False,
+                 results=None, bandwidth=None, state=None):
+    """ pull paths of a sync from several hosts at the same time
+
+    every host of a sync has same paths, so paths are put in a queue and
+    each reachable host pulls next path of queue whenever it is free.
+    faster hosts (by throughput in history, see link_throughput) start
+    first and pull more paths. a path that fails with a host put back in
+    queue for other hosts and the host is not used anymore. arguments and
+    return value are same as _syncronize_unit.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    latencies = probe_hosts(hosts)
+    reachable = [host for host in hosts if _host_key(host) in latencies]
+    if len(reachable) <= 1:
+        return _syncronize_unit(method_name, config, sync, _order_hosts(hosts, latencies),
+                                capture, force, results, bandwidth, state)
+    throughputs = {host['name']: link_throughput(host['name']) or 0 for host in reachable}
+    reachable.sort(key=lambda host: (-throughputs[host['name']],
+                                     latencies[_host_key(host)]))
+    logger.info('Pull %s from %s', sync['name'],
+                ', '.join(host['name'] for host in reachable))
+
+    pending = [index for index, path in enumerate(sync['paths']) if path is not None]
+    tried = {index: set() for index in pending}
+    alive = {host['name'] for host in reachable}
+    failures = {}
+    in_flight = [0]
+    condition = threading.Condition()
+
+    def next_path(name):
+        with condition:
+            while True:
+                for index in pending:
+                    if name not in tried[index]:
+                        pending.remove(index)
+                        tried[index].add(name)
+                        in_flight[0] += 1
+                        return index
+                if not in_flight[0]:
+                    return None
+                condition.wait()
+
+    def done(name, index, failed):
+        with condition:
+            in_flight[0] -= 1
+            if failed:
+                failures[index] = failed
+                alive.discard(name)
+                if alive - tried[index]:
+                    pending.append(index)
+            else:
+                failures.pop(index, None)
+            # paths that no alive host can pull failed
+            for other in list(pending):
+                if not alive - tried[other]:
+                    pending.remove(other)
+            condition.notify_all()
+
+    def worker(host):
+        while host['name'] in alive:
+            index = next_path(host['name'])
+            if index is None:
+                return
+            path_sync = dict(sync, paths=[sync['paths'][index]])
+            path_host = dict(host, paths=[host['paths'][index]])
+            failed = _syncronize_unit(method_name, config, path_sync, [path_host], True,
+                                      force, results, bandwidth, state)
+            done(host['name'], index, failed)
+
+    with ThreadPoolExecutor(max_workers=len(reachable)) as executor:
+        list(executor.map(_with_cancellation(worker), reachable))
+
+    failed_syncs = []
+    for index in sorted(failures):
+        failed_syncs.extend(failures[index])
+    return failed_syncs
+
+
+class _ItemizeCounter:
+    """ count files transferred and deleted in rsync --itemize-changes output
+    without keeping its lines """
+
+    def __init__(self):
+        self.files = 0
+        self.deleted = 0
+
+    def append(self, line):
+        if ITEMIZE_TRANSFER.match(line):
+            self.files += 1
+        elif ITEMIZE_DELETE.match(line):
+            self.deleted += 1
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+
+def plan_syncs(config, method_name='push', sync_name=None, host_name=None, jobs=8):
+    """ estimate what push or pull would transfer and how long it takes
+
+    rsync --dry-run --itemize-changes --stats runs for every (sync, host,
+    path) at the same time in a pool of jobs threads, files and bytes it
+    would transfer printed with estimated time: bytes divided by throughput
+    of host in history (see link_throughput), and at least time of dry run
+    itself. in pull paths planned with first host of sync. estimates saved
+    and used to run longest units first (see syncronize_syncs).
+
+    args:
+        config: validated config
+        method_name: 'push' or 'pull'
+        sync_name: name of sync to plan. if None all syncs planned
+        host_name: name of host to plan with
+        jobs: number of dry runs that run at the same time
+
+    return: list of dicts with sync, host, local_path, files, deleted,
+        bytes, seconds (None if unknown) and return_code of each path
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    methods = {'push': push, 'pull': pull}
+    items = []
+    for sync in find_syncs(config, sync_name):
+        hosts = find_hosts(sync, host_name)
+        if method_name == 'pull':
+            hosts = hosts[:1]
+        for host in hosts:
+            items.extend((sync, host, local_path, remote_path) for local_path, remote_path
+                         in zip(sync['paths'], host['paths']) if local_path is not None)
+    throughputs = {}
+
+    def dry_run(item):
+        sync, host, local_path, remote_path = item
+        multiplex = host.get('multiplex', config.get('multiplex', False))
+        daemon = _daemon_options(host)
+        output, stats = _ItemizeCounter(), {}
+        return_code = methods[method_name](
+            local_path=local_path, remote_path=remote_path, host=host['address'],
+            user=host['user'], recursive=sync['recursive'], output=output, stats=stats,
+            tags=sync['tags'] + ['--dry-run', '--itemize-changes'], daemon=daemon,
+            ssh_command=open_control_master(host['user'], host['address'])
+            if multiplex and daemon is None else None)
+        if host['name'] not in throughputs:
+            throughputs[host['name']] = link_throughput(host['name'])
+        size = stats.get('transferred_size', 0)
+        seconds = stats.get('wall_time')
+        if throughputs[host['name']]:
+            seconds = max(seconds, size / throughputs[host['name']])
+        else:
+            seconds = None if size else seconds
+        return {'sync': sync['name'], 'host': host['name'], 'local_path': local_path,
+                'files': output.files, 'deleted': output.deleted,
+                'bytes': size, 'seconds': seconds, 'return_code': return_code}
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        plan = list(executor.map(dry_run, items))
+
+    now = time.time()
+    with closing(open_state()) as db, db:
+        db.executemany('INSERT OR REPLACE INTO estimates VALUES (?, ?, ?, ?, ?, ?)',
+                       [(item['sync'], item['host'], method_name, item['local_path'],
+                         item['seconds'], now)
+                        for item in plan if item['seconds'] is not None])
+
+    print('plan ({}):'.format(method_name))
+    for item in plan:
+        if item['return_code'] != 0:
+            print('\t{sync}/{host}:{local_path}: dry run failed with exit code '
+                  '{return_code}'.format(**item))
+            continue
+        print('\t{}/{}:{}: {} files, {} deleted, {}, {}'.format(
+            item['sync'], item['host'], item['local_path'], item['files'], item['deleted'],
+            _format_size(item['bytes']), _format_duration(item['seconds'])))
+    known = [item['seconds'] for item in plan if item['seconds'] is not None]
+    print('total: {} files, {}, {} (longest {})'.format(
+        sum(item['files'] for item in plan), _format_size(sum(item['bytes'] for item in plan)),
+        _format_duration(sum(known) if known else None),
+        _format_duration(max(known) if known else None)))
+    return plan
+
+
+def _format_duration(seconds):
+    """ return duration in human readable form, 'unknown time' for None """
+    if seconds is None:
+        return 'unknown time'
+    if seconds < 60:
+        return 'about {:.0f}s'.format(seconds)
+    if seconds < 3600:
+        return 'about {:.0f}m'.format(seconds / 60)
+    return 'about {:.1f}h'.format(seconds / 3600)
+
+
+def get_durations(method_name, days=30):
+    """ return expected duration of paths as dict of (sync, host, local_path) to seconds
+
+    estimate of plan command used if it is newer than ESTIMATE_TTL,
+    otherwise average time of successful syncs in statistics history
+    (stats setting) of last days.
+    """
+    with closing(open_state()) as db:
+        durations = {(sync, host, local_path): seconds for sync, host, local_path, seconds
+                     in db.execute(
+                         'SELECT sync, host, local_path, AVG(wall_time) FROM stats '
+                         'WHERE method=? AND return_code=0 AND time>=? '
+                         'GROUP BY sync, host, local_path',
+                         (method_name, time.time() - days * 86400))}
+        durations.update(((sync, host, local_path), seconds)
+                         for sync, host, local_path, seconds in db.execute(
+                             'SELECT sync, host, local_path, seconds FROM estimates '
+                             'WHERE method=? AND updated>=?',
+                             (method_name, time.time() - ESTIMATE_TTL)))
+    return durations
+
+
+def relay_parents(count, topology='tree', fanout=2):
+    """ return index of parent of each of count hosts in a relay topology
+
+    first host (the seed) has no parent and is pushed from local host. in
+    'chain' each host is parent of next one, in 'tree' each host is
+    parent of fanout hosts, so depth of tree grows with logarithm of count.
+    """
+    if topology == 'chain':
+        fanout = 1
+    return [None] + [(index - 1) // fanout for index in range(1, count)]
+
+
+def _relay_levels(config, sync, hosts):
+    """ return tuple (parents, levels) of relay topology of hosts of sync:
+    index of parent of each host (see relay_parents) and OrderedDict of
+    depth to indexes of hosts in that depth, that are pushed at same time """
+    parents = relay_parents(len(hosts), _sync_setting(config, sync, 'relay'),
+                            _sync_setting(config, sync, 'relay_fanout', 2))
+    levels = OrderedDict()
+    depths = []
+    for index, parent in enumerate(parents):
+        depths.append(0 if parent is None else depths[parent] + 1)
+        levels.setdefault(depths[index], []).append(index)
+    return parents, levels
+
+
+def _unit_concurrency(config, sync, hosts, function):
+    """ return number of rsync commands that a unit may run at same time,
+    a spread pull runs one for each host and a relay push one for each
+    host of a level (see _relay_unit) """
+    if function is _spread_unit:
+        return len(hosts)
+    if function is _relay_unit:
+        return max(len(level) for level in _relay_levels(config, sync, hosts)[1].values())
+    return 1
+
+
+def _relay_unit(method_name, config, sync, hosts, capture=False, force=False,
+                results=None, bandwidth=None, state=None):
+    """ push a sync to first host and relay it from hosts to other hosts
+
+    hosts are arranged by relay setting of sync (see relay_parents). hosts
+    of a level of the topology pushed at the same time when their parents
+    are done. a host that its parent failed or relaying to it failed is
+    pushed from local host. arguments and return value are same as
+    _syncronize_unit.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    parents, levels = _relay_levels(config, sync, hosts)
+
+    synced = set()
+    failed_syncs = []
+
+    def relay(index):
+        parent = parents[index]
+        if parent is None or parent not in synced:
+            return _syncronize_unit(method_name, config, sync, [hosts[index]], capture,
+                                    force, results, bandwidth, state)
+        return _relay_to(config, sync, hosts[parent], hosts[index], capture, force,
+                         results, bandwidth, state)
+
+    for level in levels.values():
+        if len(level) == 1:
+            level_results = [relay(level[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(level)) as executor:
+                level_results = list(executor.map(_with_cancellation(relay), level))
+        for index, result in zip(level, level_results):
+            if not result:
+                synced.add(index)
+            failed_syncs.extend(result)
+    return failed_syncs
+
+
+def _relay_to(config, sync, parent, host, capture=False, force=False, results=None,
+              bandwidth=None, state=None):
+    """ relay paths of sync from parent to host, push paths that are not relayed """
+    logger.info('Relay %s from %s to %s:', sync['name'], parent['name'], host['name'])
+    output = OutputStream(sync['name'], host['name']) if capture else None
+    host_results = [] if results is not None else None
+    not_relayed = relay_host(
+        parent, host, sync['paths'], sync['recursive'], sync['tags'], output=output,
+        multiplex=parent.get('multiplex', config.get('multiplex', False)),
+        sync_name=sync['name'], results=host_results)
+    if host_results is not None:
+        if host_results and config.get('stats', False):
+            save_stats(host_results)
+        results.extend(host_results)
+
+    relayed = [(local_path, remote_path) for local_path, remote_path
+               in zip(sync['paths'], host['paths'])
+               if local_path is not None and (local_path, remote_path) not in not_relayed]
+    writes = _StateWrites() if state is None else state
+    writes.save_failures('push', sync['name'], host['name'], relayed, [])
+    if not not_relayed:
+        writes.set_last_success(sync['name'], host['name'])
+    if state is None:
+        writes.flush()
+    if not not_relayed:
+        logger.info('%s successfully relayed to %s', sync['name'], host['name'])
+        return []
+
+    indexes = [index for index, pair in enumerate(zip(sync['paths'], host['paths']))
+               if pair in not_relayed]
+    rest = dict(sync, paths=[sync['paths'][index] for index in indexes])
+    rest_host = dict(host, paths=[host['paths'][index] for index in indexes])
+    return _syncronize_unit('push', config, rest, [rest_host], capture, force, results,
+                            bandwidth, state)
+
+
+def _unit_duration(unit, durations):
+    """ return expected duration of a unit, sum of durations of its paths with its first host """
+    sync, hosts = unit
+    return sum(durations.get((sync['name'], hosts[0]['name'], local_path), 0)
+               for local_path in sync['paths'] if local_path is not None)
+
+
+def _transfer_key(sync, host):
+    """ return key of transfers of a sync with a host that give same result
+    for same paths: connection to host and rsync options """
+    daemon = _daemon_options(host) or {}
+    return (_host_key(host), daemon.get('module'), daemon.get('port'),
+            tuple(sync['tags']))
 
-    return True
 
+def _changes_paths(tags):
+    """ return True if tags filter files, skip some of them (e.g. other file
+    systems) or change where they are placed, so a path cannot be folded
+    into its parent """
+    for tag in tags:
+        if tag.startswith(PATH_CHANGING_TAGS):
+            return True
+        if any(option in _short_options(tag) for option in 'RfFCx'):
+            return True
+    return False
 
 
-def validate_config(config):
-    """ check and validate config
+def find_overlaps(config, units=None):
+    """ find push transfers that other transfers of same run already do
 
-    check syncs and hosts, fix missing user, check and fix source and
-    destination paths
+    every (host, local path, remote path) of units compared with others of
+    same host and rsync options. a transfer is a duplicate if an earlier
+    one has same paths, and it's nested if a recursive transfer of a parent
+    directory puts it in same remote path, e.g. /home/user/projects/ to
+    /backup/projects/ is nested in /home/user/ to /backup/. a path behind a
+    symlink or with tags that skip files (see _changes_paths) is not
+    nested. paths of units with several hosts (relay) may cover others but
+    are not coalesced.
 
     args:
-        config: config loaded from yaml file
+        config: validated config
+        units: list of units of SyncEngine.units, all push units of config
+            by default
 
+    return: list of dicts with sync, host, local_path and remote_path of
+        a transfer, kind ('duplicate' or 'nested') and by, tuple (sync,
+        local_path, remote_path) of transfer that covers it
     """
-    # set default global settings
-    config.setdefault('hosts', [])
-    config.setdefault('syncs', [])
-    config.setdefault('recursive', False)
-    config.setdefault('tags', [])
+    import posixpath
+    if units is None:
+        units = SyncEngine(config).units('push', coalesce=False)
+    groups = {}
+    order = 0
+    for unit_index, (sync, hosts, _) in enumerate(units):
+        recursive = sync['recursive'] or _is_recursive(sync['tags'])
+        for host in hosts:
+            group = groups.setdefault(_transfer_key(sync, host), {})
+            for local_path, remote_path in zip(sync['paths'], host['paths']):
+                if local_path is None:
+                    continue
+                source = os.path.normpath(os.path.expanduser(local_path))
+                destination = posixpath.normpath(remote_path)
+                # without trailing / directory itself put in destination
+                if not local_path.endswith('/'):
+                    destination = posixpath.join(destination, os.path.basename(source))
+                group.setdefault(source, []).append({
+                    'unit': unit_index, 'sync': sync['name'], 'host': host['name'],
+                    'local_path': local_path, 'remote_path': remote_path,
+                    'destination': destination, 'recursive': recursive,
+                    'fixed': len(hosts) > 1, 'order': order})
+                order += 1
 
-    # check and validate global hosts
-    for host in config['hosts']:
-        is_valid = validate_global_host(host)
-        if not is_valid:
-            return False
-    # validate sync
-    for sync in config['syncs']:
-        sync.setdefault('hosts', [])
-        for host in sync['hosts']:
-            is_host_valid = validate_host(host, sync['paths'], config['hosts'])
-            if not is_host_valid:
-                return False
-        # validate hosts in syncs
-        is_sync_valid = validate_sync(sync, config['recursive'], config['tags'])
-        if not is_sync_valid:
-            return False
+    overlaps = []
+    for key, group in groups.items():
+        nested = not _changes_paths(key[-1])
+        for source, entries in group.items():
+            for entry in entries:
+                if entry['fixed']:
+                    continue
+                cover = None
+                for other in entries:
+                    if other is not entry and other['destination'] == entry['destination'] \
+                            and (other['recursive'], -other['order']) > \
+                            (entry['recursive'], -entry['order']):
+                        cover, kind = other, 'duplicate'
+                        break
+                parent = source
+                while cover is None and nested and os.path.dirname(parent) != parent:
+                    parent = os.path.dirname(parent)
+                    if parent not in group:
+                        continue
+                    relative = source[len(parent):].lstrip(os.sep)
+                    # rsync does not follow symlinks in parent, a path behind
+                    # one is not pushed by it
+                    if not os.path.isdir(parent) or os.path.realpath(source) != \
+                            os.path.join(os.path.realpath(parent), relative):
+                        continue
+                    for other in group[parent]:
+                        if other['recursive'] and \
+                                posixpath.join(other['destination'], relative) == \
+                                entry['destination']:
+                            cover, kind = other, 'nested'
+                            break
+                if cover is not None:
+                    overlaps.append({
+                        'unit': entry['unit'], 'sync': entry['sync'], 'host': entry['host'],
+                        'local_path': entry['local_path'], 'remote_path': entry['remote_path'],
+                        'kind': kind,
+                        'by': (cover['sync'], cover['local_path'], cover['remote_path'])})
+    overlaps.sort(key=lambda overlap: overlap['unit'])
+    return overlaps
 
-    return True
 
-def push(**kwargs):
-    """ transfer file from local to remote
+def coalesce_units(config, units):
+    """ remove transfers of units that other units already do (see find_overlaps)
 
     args:
-        local_path: path of source file to transfer
-        remote_path: path of destination file
-        host: remote host address
-        user: user of remote host
-        recursive: if set True path trasfered recursively
-        tags: list of str tags(options) added to rsync command
+        config: validated config
+        units: list of units of SyncEngine.units
+
+    return: tuple of list of units without coalesced paths (units that
+        have no path left removed) and list of overlaps
     """
-    return_code = rsync(
-        source_path=kwargs.get('local_path'), dest_path=kwargs.get('remote_path'),
-            dest_host=kwargs.get('host'), dest_user=kwargs.get('user'),
-            tags=kwargs.get('tags', []), recursive=kwargs.get('recursive', False))
+    overlaps = find_overlaps(config, units)
+    if not overlaps:
+        return units, overlaps
+    removed = {}
+    for overlap in overlaps:
+        removed.setdefault(overlap['unit'], set()).add(
+            (overlap['local_path'], overlap['remote_path']))
+    coalesced = []
+    for index, (sync, hosts, function) in enumerate(units):
+        if index in removed:
+            # paths that are None skipped (see syncronize_host)
+            paths = [None if (local_path, remote_path) in removed[index] else local_path
+                     for local_path, remote_path in zip_longest(sync['paths'], hosts[0]['paths'])]
+            if not any(path is not None for path in paths):
+                continue
+            sync = dict(sync, paths=paths)
+        coalesced.append((sync, hosts, function))
+    logger.info('%d transfers coalesced, other syncs already push them to same hosts',
+                len(overlaps))
+    return coalesced, overlaps
 
-    return return_code
 
-def pull(**kwargs):
-    """ transfer file from remote to local
+def lint_overlaps(config):
+    """ print transfers of push that coalesced (see find_overlaps) and the
+    time they took in history (see get_durations) """
+    overlaps = find_overlaps(config)
+    durations = get_durations('push')
+    total = sum(len([path for path in sync['paths'] if path is not None]) * len(sync['hosts'])
+                for sync in config['syncs'])
+    host = None
+    for overlap in sorted(overlaps, key=lambda overlap: overlap['host']):
+        if overlap['host'] != host:
+            host = overlap['host']
+            print('{}:'.format(host))
+        print('\t{} {} -> {}: {} {} {} -> {}'.format(
+            overlap['sync'], overlap['local_path'], overlap['remote_path'],
+            'same as' if overlap['kind'] == 'duplicate' else 'inside', *overlap['by']))
+    saved = sum(durations.get((overlap['sync'], overlap['host'], overlap['local_path']), 0)
+                for overlap in overlaps)
+    print('{} of {} transfers coalesced{}'.format(
+        len(overlaps), total,
+        ', {} of each push saved'.format(_format_duration(saved)) if saved else ''))
+    return overlaps
 
-    args:
-        local_path: path of source file (destination)
-        remote_path: path of remote file
-        host: remote host address
-        user: user of remote host
-        recursive: if set True path trasfered recursively
-        tags: list of str tags(options) added to rsync command
+
+class SyncResult(namedtuple('SyncResult', [
+        'index', 'method', 'sync', 'hosts', 'failed_paths', 'return_code', 'started',
+        'finished', 'bytes', 'tail', 'cancelled'])):
+    """ result of a unit of work of SyncEngine
+
+    fields:
+        index: place of unit in the run, units are in order of config
+        method: 'push' or 'pull'
+        sync: name of sync
+        hosts: list of names of hosts of unit
+        failed_paths: dict of host name to list of (local_path, remote_path)
+            that failed to sync with it
+        return_code: exit code of first failed rsync command, 0 if all paths
+            synced, None if it's not known (statistics not collected)
+        started, finished: time that unit started and finished
+        bytes: bytes sent and received by rsync commands of unit, 0 if
+            statistics not collected
+        tail: last lines of output of failed rsync commands (output
+            captured only when units run at the same time)
+        cancelled: True if run cancelled before unit finished
     """
-    return_code = rsync(
-        dest_path=kwargs.get('local_path'), source_path=kwargs.get('remote_path'),
-            source_host=kwargs.get('host'), source_user=kwargs.get('user'),
-            tags=kwargs.get('tags', []), recursive=kwargs.get('recursive', False))
-    return return_code
+    __slots__ = ()
 
-def rsync(**kwargs):
-    """ this is wrapper around rsync command
+    @property
+    def duration(self):
+        return self.finished - self.started
+
+    @property
+    def ok(self):
+        return not self.failed_paths and not self.cancelled
+
+
+class SyncEngine:
+    """ push and pull syncs of a config on an asyncio event loop
+
+    each (sync, host) pair of push and each sync of pull is a unit of work
+    (see syncronize_syncs). units run in a pool of worker threads, at most
+    jobs of them and jobs of a host (host_jobs) at the same time, and a
+    SyncResult yielded for each unit as soon as it's done. if the task
+    that iterates over results cancelled, or cancel called, running rsync
+    commands terminated and units that did not start are not run.
+
+        engine = SyncEngine(config, jobs=4)
+        async for result in engine.push(sync_name='default'):
+            print(result.sync, result.hosts, result.ok, result.duration)
 
     args:
-        source_path: path of source file
-        dest_path: path of destination file
-        source_host: address of source host
-        dest_host: address of destination host
-        source_user: source host username
-        dest_user: destination host username
-        tags: list of str tags(options) added to rsync command
-        recursive: if set True -r option added to rsync
+        config: validated config
+        jobs: number of units that run at the same time. if None, jobs
+            setting of config used (default 1)
+        host_jobs: dict of host name to number of units that use the host
+            at the same time. if a host is not in it, jobs setting of host
+            used (default unlimited)
+        on_event: function called with name of an event and its data:
+            'unit_started' with dict of index, method, sync and hosts of
+            unit, 'unit_finished' with SyncResult of unit. if it returns an
+            awaitable it's awaited
+        capture: if set True rsync output streamed with prefixes and tails
+            of failed commands kept (see OutputStream). if None, output
+            captured when more than one unit runs at the same time
+        stats: if set True statistics of rsync commands collected for bytes
+            and return_code of results (rsync runs with --stats). they are
+            collected anyway if stats or metrics_file setting of config set
     """
 
-    # set default user for source and destination
-    if kwargs.get('source_user') is None:
-        kwargs['source_user'] = getpass.getuser()
-    if kwargs.get('dest_user') is None:
-        kwargs['dest_user'] = getpass.getuser()
+    def __init__(self, config, jobs=None, host_jobs=None, on_event=None, capture=None,
+                 stats=True):
+        self.config = config
+        self.jobs = config.get('jobs', 1) if jobs is None else jobs
+        self.host_jobs = host_jobs or {}
+        self.on_event = on_event
+        self.capture = capture
+        self.stats = stats
+        self._cancellations = set()
 
-    kwargs.setdefault('source_path', '.')
-    kwargs.setdefault('dest_path', '.')
-    kwargs.setdefault('tags', [])
-    kwargs.setdefault('recursive', False)
+    def push(self, sync_name=None, host_name=None, force=False, metrics_file=None,
+             longest_first=None):
+        """ push syncs, return async iterator of SyncResult of units.
+        arguments are same as syncronize_syncs """
+        return self.run('push', sync_name, host_name, force=force,
+                        metrics_file=metrics_file, longest_first=longest_first)
 
-    if kwargs.get('source_host', None) is None:
-        cmd = [RSYNC, '{0}'.format(kwargs['source_path']),
-               '{0}@{1}:{2}'.format(kwargs['dest_user'], kwargs['dest_host'],
-               kwargs['dest_path'])]
-    elif kwargs.get('dest_host', None) is None:
-        cmd = [RSYNC, '{0}@{1}:{2}'.format(kwargs['source_user'],
-               kwargs['source_host'], kwargs['source_path']),
-               '{0}'.format(kwargs['dest_path'])]
-    else:
-        logger.critical('Both source and destination cannot be remote hosts')
-        return 1
+    def pull(self, sync_name=None, host_name=None, strategy=None, metrics_file=None,
+             spread=False, longest_first=None):
+        """ pull syncs, return async iterator of SyncResult of units.
+        arguments are same as syncronize_syncs """
+        return self.run('pull', sync_name, host_name, strategy=strategy,
+                        metrics_file=metrics_file, spread=spread,
+                        longest_first=longest_first)
 
-    # add recursive tag to command
-    if kwargs['recursive']:
-        cmd.append('-r')
-    # add tags
-    cmd = cmd + kwargs['tags']
-    logger.debug('debug: running ' + ' '.join(cmd))
-    job = sp.Popen(cmd)
-    return_code = job.wait()
-    return return_code
+    def cancel(self):
+        """ cancel all runs of engine """
+        for cancellation in list(self._cancellations):
+            cancellation.cancel()
 
-def list_syncs(config):
-    """list syncs """
-    for sync in config['syncs']:
-        print('{}:'.format(sync['name']))
-        print('\tpaths:')
-        for path in sync['paths']:
-            print('\t\t{}'.format(path))
-        print('\thosts:')
-        for host in sync['hosts']:
-            print('\t\tname: {}'.format(host['name']))
-            print('\t\taddress: {}'.format(host['address']))
-            print('\t\tuser: {}'.format(host['user']))
-            print('\t\tpaths:')
-            for path in host['paths']:
-                print('\t\t\t{}'.format(path))
-        print('\ttags:')
-        for tag in sync['tags']:
-            print('\t\t{}'.format(tag))
-        print('')
+    def units(self, method_name, sync_name=None, host_name=None, strategy=None,
+              spread=False, coalesce=None):
+        """ return list of units of a run: tuple (sync, hosts, unit function).
+        hosts may be probed (see strategy of syncronize_syncs). in push paths
+        that other units already push removed if coalesce is True (see
+        coalesce_units), if None coalesce setting of config used (default
+        False) """
+        config = self.config
+        syncs = find_syncs(config, sync_name)
+        if strategy is None:
+            strategy = config.get('pull_strategy', 'order')
+        if method_name == 'pull' and host_name is None and strategy == 'fastest':
+            # probe every host once, even if it is used in several syncs
+            latencies = probe_hosts([host for sync in syncs for host in sync['hosts']])
 
-def syncronize_host(method_name, host, sync_paths, recursive=False, tags=[]):
-    """ syncronize sync paths base on method (push or pull) 
+        units = []
+        for sync in syncs:
+            # find host
+            remote_hosts = find_hosts(sync, host_name)
+            if method_name == 'pull' and spread and host_name is None and \
+                    len(remote_hosts) > 1:
+                units.append((sync, remote_hosts, _spread_unit))
+            elif method_name == 'pull':
+                if host_name is None and len(remote_hosts) > 1:
+                    if strategy == 'race':
+                        latencies = probe_hosts(remote_hosts, first=True)
+                    if strategy in ('fastest', 'race'):
+                        remote_hosts = _order_hosts(remote_hosts, latencies)
+                        logger.info('Pull %s from %s', sync['name'], remote_hosts[0]['name'])
+                # hosts are tried one after another so they are one unit
+                units.append((sync, remote_hosts, _syncronize_unit))
+            elif host_name is None and len(remote_hosts) > 1 and \
+                    _sync_setting(config, sync, 'relay', False):
+                # hosts are pushed through each other so they are one unit
+                units.append((sync, remote_hosts, _relay_unit))
+            else:
+                units.extend((sync, [host], _syncronize_unit) for host in remote_hosts)
+        if coalesce is None:
+            coalesce = config.get('coalesce', False)
+        if method_name == 'push' and coalesce:
+            units = coalesce_units(config, units)[0]
+        return units
 
-    syncronize (pull or push) sync_paths with host paths
+    async def _emit(self, event, data):
+        if self.on_event is not None:
+            import inspect
+            result = self.on_event(event, data)
+            if inspect.isawaitable(result):
+                await result
 
-    args:
-        method_name: string contain name of method use which used to syncronize. most be 'pull' or 'push'
-        host: host to syncronize with
-        sync_paths: list of paths for syncing with host's paths
-        tags: list of str tags(options) added to rsync command
-        recursive: if set True -r option added to rsync
+    async def run(self, method_name, sync_name=None, host_name=None, force=False,
+                  strategy=None, metrics_file=None, spread=False, longest_first=None):
+        """ syncronize syncs, yield SyncResult of each unit when it's done.
+        arguments are same as syncronize_syncs. FileNotFoundError raised
+        if rsync of rsync_path setting of config not found """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        if method_name not in ('push', 'pull'):
+            raise AttributeError("method most 'push' or 'pull' ")
+        config = self.config
+        if config.get('rsync_path') is not None:
+            find_rsync(config['rsync_path'])
+        started = time.time()
+        if metrics_file is None:
+            metrics_file = config.get('metrics_file')
+        collect = self.stats or config.get('stats', False) or bool(metrics_file)
+        run_results = [] if collect else None
+        loop = asyncio.get_event_loop()
+        jobs = max(1, self.jobs)
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        cancellation = _Cancellation()
+        self._cancellations.add(cancellation)
+        # failures and last success of units saved once when run is done
+        state = _StateWrites()
+        tasks = []
+        try:
+            # probing hosts blocks
+            units = await loop.run_in_executor(
+                executor, _with_cancellation(self.units, cancellation), method_name,
+                sync_name, host_name, strategy, spread)
 
-    returns: list of paths that failed to sync
-    """
-    methods = {'push': push, 'pull': pull}
+            host_units = {}
+            for sync, hosts, _ in units:
+                for host in hosts:
+                    host_units[host['name']] = host_units.get(host['name'], 0) + 1
+            # units that run several rsync commands at same time use more slots
+            concurrency = sorted((_unit_concurrency(config, *unit) for unit in units),
+                                 reverse=True)
+            bandwidth = bandwidth_budget(
+                config, max(1, sum(concurrency[:jobs])),
+                {name: min(jobs, count) for name, count in host_units.items()})
+            capture = self.capture
+            if capture is None:
+                capture = jobs > 1 and len(units) > 1
+            slots = asyncio.Semaphore(jobs)
+            host_slots = {}
+            for sync, hosts, _ in units:
+                for host in hosts:
+                    limit = self.host_jobs.get(host['name'], host.get('jobs'))
+                    if limit and host['name'] not in host_slots:
+                        host_slots[host['name']] = asyncio.Semaphore(limit)
 
-    if method_name not in methods.keys():
-        raise AttributeError("method most 'push' or 'pull' ")
-    else:
-        method = methods[method_name]
+            order = list(range(len(units)))
+            if longest_first is None:
+                longest_first = config.get('longest_first', False)
+            if longest_first and jobs > 1:
+                durations = get_durations(method_name)
+                order.sort(key=lambda index: -_unit_duration(units[index][:2], durations))
 
-    failed_paths = []
-    for local_path, remote_path in zip(sync_paths, host['paths']):
-        # check if localpath is None, it happens when there are more remote_paths than local_paths
-        if local_path is None:
-            # if localpath is None pass to next path
-            continue
-        
-        return_code = method(local_path=local_path, remote_path=remote_path,
-                           host=host['address'], user=host['user'], tags=tags, recursive=recursive)
-        if return_code != 0:
-            logger.error(
-                'failed to sync (%s) path %s to %s', method_name, local_path, host['name'])
-            failed_paths.append((local_path, remote_path))
+            async def run_unit(index):
+                sync, hosts, function = units[index]
+                names = [host['name'] for host in hosts]
+                # hosts locked in order of names, so units do not wait for each other
+                semaphores = [host_slots[name] for name in sorted(set(names))
+                              if name in host_slots] + [slots]
+                acquired = []
+                ran = False
+                unit_started = time.time()
+                failed, unit_results = [], [] if collect else None
+                try:
+                    for semaphore in semaphores:
+                        await semaphore.acquire()
+                        acquired.append(semaphore)
+                    if not cancellation.is_set():
+                        await self._emit('unit_started', {
+                            'index': index, 'method': method_name, 'sync': sync['name'],
+                            'hosts': names})
+                        unit_started = time.time()
+                        failed = await loop.run_in_executor(
+                            executor, _with_cancellation(function, cancellation),
+                            method_name, config, sync, hosts, capture, force,
+                            unit_results, bandwidth, state)
+                        ran = True
+                finally:
+                    for semaphore in acquired:
+                        semaphore.release()
+                if unit_results:
+                    run_results.extend(unit_results)
+                # a unit that was done before run cancelled is not cancelled
+                cancelled = cancellation.is_set() and (not ran or bool(failed))
+                result = self._result(index, method_name, sync['name'], names, failed,
+                                      unit_results, unit_started, cancelled)
+                await self._emit('unit_finished', result)
+                return result
 
-    return failed_paths
+            tasks = [loop.create_task(run_unit(index)) for index in order]
+            for future in asyncio.as_completed(tasks):
+                yield await future
+            # metrics read last success of this run from state database
+            state.flush()
+            if metrics_file:
+                write_metrics(metrics_file, method_name, run_results, started)
+        finally:
+            if any(not task.done() for task in tasks):
+                # iteration stopped or cancelled, stop units and wait for them
+                cancellation.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            state.flush()
+            self._cancellations.discard(cancellation)
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _result(index, method_name, sync_name, host_names, failed, unit_results, started,
+                cancelled):
+        """ return SyncResult of a unit """
+        failed_paths = OrderedDict()
+        for _, host, paths in failed:
+            failed_paths.setdefault(host['name'], []).extend(paths)
+        return_code = None if failed_paths or cancelled else 0
+        size, tail = 0, []
+        for item in unit_results or []:
+            size += (item.get('bytes_sent') or 0) + (item.get('bytes_received') or 0)
+            if return_code is None and item.get('return_code'):
+                return_code = item['return_code']
+            if failed_paths:
+                tail.extend(item.get('tail', []))
+        if return_code is None and cancelled:
+            return_code = RSYNC_CANCELLED
+        return SyncResult(index, method_name, sync_name, host_names, failed_paths,
+                          return_code, started, time.time(), size, tail, cancelled)
 
 
-def syncronize_syncs(method_name, config, sync_name=None, host_name=None):
+def syncronize_syncs(method_name, config, sync_name=None, host_name=None, jobs=None,
+                     strategy=None, force=False, metrics_file=None, spread=False,
+                     longest_first=None):
     """use the config to push paths to hosts 
     
     syncronize syncs by pulling or pushing sync's paths to hosts
@@ -385,41 +3536,622 @@ def syncronize_syncs(method_name, config, sync_name=None, host_name=None):
      with all hosts, but in pull method it start syncing sync to
      hosts until a successful sync happens.
 
+    Each (sync, host) pair of push and each sync of pull is a unit of
+    work. a sync with relay setting pushed to all its hosts as one unit
+    (see _relay_unit). if jobs is more than 1, units run concurrently.
+    units run by a SyncEngine, this function blocks until all of them are
+    done.
+
     args:
         method_name: string contain name of method use which used to syncronize. most be 'pull' or 'push'
         config: config object that used to find syncs and hosts
         sync_name: name of sync to syncronize. if  None used all sync will syncronized
         host_name: name of host to syncronize with.
+        jobs: number of units to run concurrently. if None, jobs setting
+            of config used (default 1)
+        strategy: order of hosts in pull when host_name is None. 'order'
+            use hosts in config order, 'fastest' probe all hosts and pull
+            from host with lowest latency first, 'race' pull from first host
+            that answers. if None, pull_strategy setting of config used
+            (default 'order')
+        force: if set True manifest is ignored and all paths pushed
+        metrics_file: path of file to write metrics of the run (see
+            write_metrics). if None, metrics_file setting of config used
+        spread: if set True in pull paths of a sync pulled from all its
+            reachable hosts at the same time (see _spread_unit)
+        longest_first: if set True and jobs is more than 1, units that are
+            expected to take longest (see get_durations) started first.
+            if None, longest_first setting of config used (default False)
 
     return: list of tuple (sync, host, failed_paths)
     """
+    import asyncio
+    engine = SyncEngine(config, jobs=jobs, stats=False)
+
+    async def run():
+        return [result async for result in engine.run(
+            method_name, sync_name, host_name, force=force, strategy=strategy,
+            metrics_file=metrics_file, spread=spread, longest_first=longest_first)]
 
+    # keep the order of units regardless of which one finished first
     failed_syncs = []
-    # find sync
+    for result in sorted(asyncio.run(run()), key=lambda result: result.index):
+        sync = get_sync(config, result.sync)
+        for name, paths in result.failed_paths.items():
+            failed_syncs.append((sync, find_hosts(sync, name)[0], paths))
+    return failed_syncs
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+
+class InotifyWatcher:
+    """ watch local trees for changes with linux inotify
+
+    every directory of a tree watched separately, new directories added
+    to watch when they are created. OSError raised if inotify is not
+    available or watch limit reached.
+    """
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> (directory, tag)
+        self._watches = {}
+        self._tags = set()
+
+    def _add_watch(self, path, tag):
+        import ctypes
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), IN_WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, '{}: {}'.format(os.strerror(errno), path))
+        self._watches[wd] = (path, tag)
+
+    def add_tree(self, path, tag):
+        """ watch path and all directories in it, changes reported with tag.
+        directories in it that cannot be read skipped with a warning """
+        import errno
+
+        def skip(error):
+            logger.warning('cannot watch directory: %s', error)
+
+        self._tags.add(tag)
+        self._add_watch(path, tag)
+        if not os.path.isdir(path):
+            return
+        for directory, names, _ in os.walk(path, onerror=skip):
+            for name in names:
+                subdirectory = os.path.join(directory, name)
+                if os.path.islink(subdirectory):
+                    continue
+                try:
+                    self._add_watch(subdirectory, tag)
+                except OSError as e:
+                    # watch limit reached, no other directory can be watched
+                    if e.errno in (errno.ENOSPC, errno.ENOMEM):
+                        raise
+                    skip(e)
+
+    def read(self, timeout):
+        """ wait for changes for timeout seconds and return set of tags that changed """
+        import select
+        import struct
+        changed = set()
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return changed
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                # events lost, everything may be changed
+                changed |= self._tags
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches:
+                continue
+            directory, tag = self._watches[wd]
+            changed.add(tag)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self.add_tree(os.path.join(directory, os.fsdecode(name)), tag)
+                except OSError as e:
+                    logger.warning('cannot watch new directory: %s', e)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """ watch local trees for changes by comparing their fingerprint periodically """
+
+    def __init__(self, interval=30):
+        self.interval = interval
+        # tag -> list of [path, fingerprint]
+        self._trees = {}
+
+    def add_tree(self, path, tag):
+        """ watch path, changes reported with tag """
+        self._trees.setdefault(tag, []).append([path, tree_fingerprint(path)])
+
+    def read(self, timeout):
+        """ wait for timeout seconds (at most interval) and return set of tags that changed """
+        time.sleep(min(timeout, self.interval))
+        changed = set()
+        for tag, trees in self._trees.items():
+            for tree in trees:
+                fingerprint = tree_fingerprint(tree[0])
+                if fingerprint != tree[1]:
+                    tree[1] = fingerprint
+                    changed.add(tag)
+        return changed
+
+    def close(self):
+        pass
+
+
+class _MixedWatcher:
+    """ watch some paths with InotifyWatcher and others with PollingWatcher """
+
+    def __init__(self, inotify, polling):
+        self.inotify = inotify
+        self.polling = polling
+        self._next_poll = time.monotonic() + polling.interval
+
+    def read(self, timeout):
+        """ wait for changes for timeout seconds and return set of tags that changed """
+        changed = self.inotify.read(max(0, min(timeout, self._next_poll - time.monotonic())))
+        if time.monotonic() >= self._next_poll:
+            changed |= self.polling.read(0)
+            self._next_poll = time.monotonic() + self.polling.interval
+        return changed
+
+    def close(self):
+        self.inotify.close()
+        self.polling.close()
+
+
+def _select_paths(config, selected):
+    """ return copy of config that only contain selected paths
+
+    args:
+        config: validated config
+        selected: set of tuple (sync name, index of path in sync paths)
+    """
+    syncs = []
+    for sync in config['syncs']:
+        indexes = sorted(index for name, index in selected if name == sync['name'])
+        if not indexes:
+            continue
+        hosts = [dict(host, paths=[host['paths'][index] for index in indexes])
+                 for host in sync['hosts']]
+        syncs.append(dict(sync, paths=[sync['paths'][index] for index in indexes],
+                          hosts=hosts))
+    return dict(config, syncs=syncs)
+
+
+def _watch_paths(config, syncs):
+    """ return watcher of paths of syncs, changes of a path reported with
+    tag (sync name, index of path in sync paths)
+
+    inotify used if available, otherwise paths polled every poll_interval
+    seconds of config. a path that cannot be watched with inotify (e.g. it
+    does not exist) is polled, other paths still watched with inotify.
+    """
+    import errno
+    paths = [(os.path.expanduser(path), (sync['name'], index)) for sync in syncs
+             for index, path in enumerate(sync['paths']) if path is not None]
+    polled = []
+    try:
+        watcher = InotifyWatcher()
+    except OSError as e:
+        logger.warning('cannot use inotify (%s), polling paths for changes', e)
+        watcher = None
+    for path, tag in paths if watcher is not None else []:
+        try:
+            watcher.add_tree(path, tag)
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.ENOMEM):
+                logger.warning('cannot use inotify (%s), polling paths for changes', e)
+                watcher.close()
+                watcher = None
+                break
+            logger.warning('cannot watch %s (%s), polling it for changes', path, e)
+            polled.append((path, tag))
+    if watcher is None:
+        polled = paths
+    polling = PollingWatcher(config.get('poll_interval', 30))
+    for path, tag in polled:
+        polling.add_tree(path, tag)
+    if watcher is None:
+        return polling
+    if polled:
+        return _MixedWatcher(watcher, polling)
+    return watcher
+
+
+def watch_syncs(config, sync_name=None, debounce=None, jobs=None):
+    """ watch paths of syncs and push them to their hosts when they change
+
+    changes collected until no change happened for debounce seconds (or
+    for at most 10 times of debounce when changes does not stop), then
+    only changed paths pushed. config loaded once and used for all pushes.
+    inotify used if available, otherwise paths polled every poll_interval
+    seconds of config (see _watch_paths).
+
+    args:
+        config: validated config
+        sync_name: name of sync to watch. if None all syncs watched
+        debounce: seconds to wait for more changes. if None, debounce setting
+            of config used (default 2)
+        jobs: number of hosts to push to concurrently
+    """
+    if debounce is None:
+        debounce = config.get('debounce', 2)
     syncs = find_syncs(config, sync_name)
+    watcher = _watch_paths(config, syncs)
 
-    for sync in syncs:
-        # find host
-        remote_hosts = find_hosts(sync,  host_name)
+    logger.info('Watching %d syncs for changes', len(syncs))
+    pending = set()
+    first_change = last_change = None
+    try:
+        while True:
+            changed = watcher.read(debounce if pending else 60)
+            now = time.monotonic()
+            if changed:
+                if not pending:
+                    first_change = now
+                pending |= changed
+                last_change = now
+            if pending and (now - last_change >= debounce or
+                            now - first_change >= debounce * 10):
+                selected, pending = pending, set()
+                syncronize_syncs('push', _select_paths(config, selected), jobs=jobs)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
-        for host in remote_hosts:
-            logger.info('Syncronize (%s) %s with %s:', method_name.title(), sync['name'], host['name'])
-            failed_paths = syncronize_host(
-                method_name, host, sync['paths'], sync['recursive'], sync['tags'])
 
-            if failed_paths:
-                failed_syncs.append((sync, host, failed_paths))
-                logger.error(
-                    'Be careful paths partialy synced try to sync with another host')
+def parse_interval(interval):
+    """ return seconds of an interval setting
+
+    args:
+        interval: number of seconds, or str of a number with s, m, h or d
+            suffix (e.g. '15m')
+
+    return: float seconds. ValueError raised if interval is not valid
+    """
+    if isinstance(interval, bool):
+        raise ValueError('invalid interval {!r}'.format(interval))
+    if isinstance(interval, (int, float)):
+        seconds = float(interval)
+    else:
+        match = INTERVAL.match(str(interval))
+        if match is None:
+            raise ValueError('invalid interval {!r}'.format(interval))
+        seconds = float(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600,
+                                          'd': 86400}[match.group(2).lower()]
+    if seconds < 0:
+        raise ValueError('invalid interval {!r}'.format(interval))
+    return seconds
+
+
+def get_last_success(sync_name):
+    """ return time of last run of a sync that was successful with all of
+    its hosts that ever synced, None if it never synced successfully """
+    with closing(open_state()) as db:
+        times = [row[0] for row in db.execute(
+            'SELECT time FROM last_success WHERE sync=?', (sync_name,))]
+    return min(times) if times else None
+
+
+class SyncScheduler:
+    """ push syncs of a config in their intervals in one process
+
+    syncs that have interval setting put in a priority queue (heapq) by
+    time of their next run, which is time of their last run plus interval
+    and a random jitter. syncs that are due pushed with a SyncEngine, at
+    most jobs syncs at the same time. a sync that is due while it's
+    running is pushed once more when it's done, however many times it was
+    due. config, ssh master connections and state database kept between
+    runs, and config reloaded on SIGHUP.
+
+    args:
+        config: validated config
+        config_path: path of config that reloaded (see reload)
+        jobs: number of syncs that run at the same time, and hosts that
+            each of them pushed to at the same time. if None, jobs setting
+            of config used (default 1)
+    """
+
+    def __init__(self, config, config_path=None, jobs=None):
+        self.config = config
+        self.config_path = config_path
+        self.jobs = jobs
+        self.queue = []
+        self.intervals = {}
+        self.running = {}
+        self.pending = set()
+        self.runs = 0
+        self._sequence = 0
+        self._slots = None
+        self._wakeup = None
+        self._stopping = False
+        self._warm(config)
+
+    @staticmethod
+    def _warm(config):
+        if 'multiplex' not in config:
+            # connections are kept between runs
+            config['multiplex'] = True
+
+    def _interval(self, sync):
+        interval = _sync_setting(self.config, sync, 'interval')
+        if interval is None:
+            return None
+        return (parse_interval(interval),
+                parse_interval(_sync_setting(self.config, sync, 'jitter', 0)))
+
+    def _push(self, due, name):
+        import heapq
+        self._sequence += 1
+        heapq.heappush(self.queue, (due, self._sequence, name))
+
+    def schedule(self, now=None):
+        """ build queue from syncs of config, a sync that was in queue with
+        same interval keeps its time. first run of other syncs is interval
+        after their last successful run (see get_last_success), or now """
+        import sqlite3
+        if now is None:
+            now = time.time()
+        old = {name: due for due, _, name in self.queue}
+        old_intervals = self.intervals
+        self.queue, self.intervals = [], {}
+        for sync in self.config['syncs']:
+            interval = self._interval(sync)
+            if interval is None:
+                continue
+            self.intervals[sync['name']] = interval
+            if sync['name'] in old and old_intervals.get(sync['name']) == interval:
+                due = old[sync['name']]
             else:
-                logger.info(
-                    'Local system successfully synced with %s', host['name'])
-                # after one successful pull stop pulling from other hosts
-                if method_name == 'pull':
-                    break
+                try:
+                    last = get_last_success(sync['name'])
+                except (OSError, sqlite3.Error) as e:
+                    logger.warning('cannot read last run of %s: %s', sync['name'], e)
+                    last = None
+                due = now if last is None else max(now, last + interval[0])
+            self._push(due, sync['name'])
+        return len(self.intervals)
+
+    def pop_due(self, now=None):
+        """ return names of syncs that are due and put their next run in
+        queue. runs that were missed are merged into one """
+        import heapq
+        import random
+        if now is None:
+            now = time.time()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            run_time, _, name = heapq.heappop(self.queue)
+            interval, jitter = self.intervals[name]
+            next_run = run_time + interval
+            if next_run <= now:
+                next_run = now + interval
+            self._push(next_run + random.uniform(0, jitter), name)
+            due.append(name)
+        return due
+
+    def next_due(self):
+        """ return time of next due sync, None if queue is empty """
+        return self.queue[0][0] if self.queue else None
+
+    def trigger(self, name):
+        """ start a run of sync, or merge it into pending run if sync is running
+
+        return: True if run started
+        """
+        import asyncio
+        if name in self.running:
+            if name not in self.pending:
+                logger.info('%s is still running, next run of it is pending', name)
+            self.pending.add(name)
+            return False
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._jobs())
+        self.running[name] = asyncio.ensure_future(self._run(name))
+        return True
+
+    async def _run(self, name):
+        import asyncio
+        try:
+            async with self._slots:
+                await self.run_sync(name)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('run of %s failed', name)
+        finally:
+            self.runs += 1
+            del self.running[name]
+            if name in self.pending and not self._stopping:
+                self.pending.discard(name)
+                self.trigger(name)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    async def run_sync(self, name):
+        """ push a sync once """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        # reopen master connections that died since last run
+        await loop.run_in_executor(None, check_control_masters)
+        engine = SyncEngine(self.config, jobs=self._jobs(), stats=False)
+        logger.info('Running %s', name)
+        failed = 0
+        async for result in engine.push(sync_name=name):
+            if not result.ok:
+                failed += 1
+        if failed:
+            logger.error('%s failed with %d hosts', name, failed)
+
+    def _jobs(self):
+        return max(1, self.jobs if self.jobs is not None else self.config.get('jobs', 1))
+
+    def reload(self):
+        """ load config from config_path again, keep current config if new
+        one is not valid """
+        config, _ = load_validated_config(self.config_path)
+        if config is None:
+            logger.error('cannot reload config, using previous config')
+            return False
+        self._warm(config)
+        self.config = config
+        try:
+            count = self.schedule()
+        except ValueError as e:
+            logger.error('invalid interval after reload: %s', e)
+            return False
+        logger.info('Config reloaded, %d syncs scheduled', count)
+        return True
+
+    async def serve(self, stop=None):
+        """ run syncs when they are due until stop (an asyncio.Event) set.
+        SIGHUP reloads config, SIGINT and SIGTERM stop it """
+        import asyncio
+        import signal
+        loop = asyncio.get_event_loop()
+        self._slots = asyncio.Semaphore(self._jobs())
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        if stop is None:
+            stop = asyncio.Event()
+        handled = []
+        try:
+            for signum, handler in ((signal.SIGHUP, self._on_hangup),
+                                    (signal.SIGINT, stop.set), (signal.SIGTERM, stop.set)):
+                loop.add_signal_handler(signum, handler)
+                handled.append(signum)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # not in main thread, or no signals on this platform
+            pass
+        try:
+            while not stop.is_set():
+                for name in self.pop_due():
+                    self.trigger(name)
+                next_due = self.next_due()
+                timeout = 60 if next_due is None else max(0, next_due - time.time())
+                self._wakeup.clear()
+                waiters = [asyncio.ensure_future(stop.wait()),
+                           asyncio.ensure_future(self._wakeup.wait())]
+                await asyncio.wait(waiters, timeout=timeout,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                for waiter in waiters:
+                    waiter.cancel()
+        finally:
+            self._stopping = True
+            for signum in handled:
+                loop.remove_signal_handler(signum)
+            # cancelled runs terminate their rsync commands
+            for task in list(self.running.values()):
+                task.cancel()
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+
+    def _on_hangup(self):
+        logger.info('SIGHUP received, reloading config')
+        self.reload()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+
+def daemon_syncs(config, config_path=None, jobs=None):
+    """ push syncs in their intervals until stopped (see SyncScheduler)
+
+    args:
+        config: validated config
+        config_path: path of config, reloaded on SIGHUP
+        jobs: number of syncs to push at the same time
+    """
+    import asyncio
+    scheduler = SyncScheduler(config, config_path, jobs)
+    if not scheduler.schedule():
+        logger.error('no sync has interval setting')
+        return False
+    logger.info('Scheduled %d syncs', len(scheduler.intervals))
+    try:
+        asyncio.run(scheduler.serve())
+    finally:
+        close_control_masters()
+    return True
+
+
+def retry_failures(config, sync_name=None, host_name=None, jobs=None):
+    """ sync again paths that failed in previous runs
+
+    failed paths saved by syncronize_syncs are synced with the same method.
+    in push only the failed host used, in pull hosts are tried like a
+    normal pull. manifest is ignored for failed paths.
+
+    args:
+        config: validated config
+        sync_name: only retry failures of this sync
+        host_name: only retry failures with this host
+        jobs: number of units to run concurrently
+
+    return: list of tuple (sync, host, failed_paths)
+    """
+    groups = OrderedDict()
+    for method_name, name, host, local_path, remote_path in get_failures(sync_name, host_name):
+        sync = get_sync(config, name)
+        if sync is None or local_path not in sync['paths']:
+            logger.warning('path %s of sync %s is not in config anymore, forgotten',
+                           local_path, name)
+            save_failures(method_name, name, host, [(local_path, remote_path)], [])
+            continue
+        key = (method_name, name, host if method_name == 'push' else None)
+        groups.setdefault(key, set()).add((name, sync['paths'].index(local_path)))
 
+    if not groups:
+        logger.info('There is no failed path to retry')
+    failed_syncs = []
+    for (method_name, name, host), selected in groups.items():
+        failed_syncs.extend(syncronize_syncs(method_name, _select_paths(config, selected),
+                                             name, host, jobs=jobs, force=True))
     return failed_syncs
 
+
 def find_syncs(config, sync_name=None):
     """ return list of syncs 
     
@@ -431,7 +4163,7 @@ def find_syncs(config, sync_name=None):
         syncs = config['syncs']
     else:
         sync_name = sync_name.lower()
-        syncs = [x for x in config['syncs'] if x['name'] == sync_name]
+        syncs = _find_named(config['syncs'], sync_name)
 
     return syncs
 
@@ -442,34 +4174,30 @@ def find_hosts(sync, host_name=None):
         remote_hosts = sync['hosts']
     else:
         host_name = host_name.lower()
-        remote_hosts = [x for x in sync['hosts']
-                         if x['name'] == host_name]
+        remote_hosts = _find_named(sync['hosts'], host_name)
 
     return remote_hosts
 
 def get_sync(config, name):
     """ find sync in config and return it """
 
-    for sync in config['syncs']:
-        if sync['name'] == name:
-            return sync
+    for sync in _find_named(config['syncs'], name):
+        return sync
     return None
 
 def get_host(config, sync_name, name):
     """ find host in sync and return it  """
     sync = get_sync(config, sync_name)
 
-    for host in sync['hosts']:
-        if host['name'] == name:
-            return host
+    for host in _find_named(sync['hosts'], name):
+        return host
     return None
 
 def get_global_host(config, name):
     """ find global host in config with its name and return it """
 
-    for host in config['hosts']:
-        if host['name'] == name:
-            return host
+    for host in _find_named(config['hosts'], name):
+        return host
     return None
 
 def add_sync(config, **kwargs):
@@ -492,12 +4220,12 @@ def add_sync(config, **kwargs):
     if kwargs['recursive'] is None:
         kwargs['recursive'] = config['recursive']
 
-    sync = {'name': kwargs['name'],
-            'paths': kwargs['paths'],
-            'tags': kwargs['tags'],
-            'recursive': kwargs['recursive'],
-            'hosts': []
-        }
+    sync = Sync({'name': kwargs['name'],
+                 'paths': kwargs['paths'],
+                 'tags': kwargs['tags'],
+                 'recursive': kwargs['recursive'],
+                 'hosts': NamedList()
+                 })
 
     config['syncs'].append(sync)
 
@@ -515,6 +4243,7 @@ def add_host(config, **kwargs):
         user: user of host to connect. default: current user
         recursive: True or False
     """
+    import getpass
     if kwargs['sync_name'] is None:
         logger.critical('sync name is necessary')
         return False
@@ -528,9 +4257,9 @@ def add_host(config, **kwargs):
         logger.critical("there is no sync with name %s", kwargs['sync_name'])
         return False
 
-    host = {'paths': kwargs['paths'],
-            'user': kwargs['user'],
-        }
+    host = Host({'paths': kwargs['paths'],
+                 'user': kwargs['user'],
+                 })
 
     if kwargs['name'] is not None:
         host['name'] = kwargs['name'].lower()
@@ -548,7 +4277,7 @@ def add_host(config, **kwargs):
         return False
 
     if sync.get('hosts', None) is None:
-        sync['hosts'] = []
+        sync['hosts'] = NamedList()
     sync['hosts'].append(host)
 
     return True
@@ -564,13 +4293,14 @@ def add_global_host(config, **kwargs):
         address: host address
         user: user of host to connect. default: current user
     """
+    import getpass
 
     if kwargs['user'] is None:
         kwargs['user'] = getpass.getuser()
 
-    host = {'name': kwargs['name'],
-            'user': kwargs['user'],
-            }
+    host = Host({'name': kwargs['name'],
+                 'user': kwargs['user'],
+                 })
     # if address defined
     if kwargs['address'] is not None:
         host['address'] = kwargs['address'].lower()
@@ -584,14 +4314,15 @@ def add_global_host(config, **kwargs):
         return False
 
     if config.get('hosts', None) is None:
-        config['hosts'] = []
-    
+        config['hosts'] = NamedList()
+
     config['hosts'].append(host)
     return True
 
 def save_config(path, config):
     """ save config to path """
-    yaml_conf = yaml.dump(config, default_flow_style=False)
+    import yaml
+    yaml_conf = yaml.dump(_plain(config), default_flow_style=False)
     with open(path, 'w') as f:
         f.write(yaml_conf)
     return True
@@ -617,12 +4348,13 @@ def remove_sync(config, name):
     return True
 
 def remove_host(config, sync_name, name):
-    """ remove sync """
-    sync = get_sync(config, name)
+    """ remove host of sync """
+    sync = get_sync(config, sync_name)
     sync['hosts'].remove(get_host(config, sync_name, name))
     return True
 
 def setup_argparse():
+    import argparse
     parser = argparse.ArgumentParser(prog='syncme')
     parser.add_argument('-v', action='store_true', help='verbose mode')
     parser.add_argument('-c', '--config', help='load config from file specified by CONFIG')
@@ -635,11 +4367,84 @@ def setup_argparse():
     parser_push.set_defaults(action='push')
     parser_push.add_argument('--sync-name', dest='sync_name', default=None)
     parser_push.add_argument('--host-name', dest='host_name', default=None)
+    parser_push.add_argument('--metrics-file', dest='metrics_file', default=None,
+                             help='write metrics of the run to METRICS_FILE')
+    parser_push.add_argument('--longest-first', dest='longest_first', action='store_true',
+                             default=None, help='start units that take longest first')
+    parser_push.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                             help='number of hosts to push to concurrently')
+    parser_push.add_argument('--force', dest='force', action='store_true',
+                             help='push paths even if they did not change')
 
     parser_pull = subparsers.add_parser('pull', help='pull paths from a host')
     parser_pull.set_defaults(action='pull')
     parser_pull.add_argument('--sync-name', dest='sync_name', default=None)
     parser_pull.add_argument('--host-name', dest='host_name', default=None)
+    parser_pull.add_argument('--metrics-file', dest='metrics_file', default=None,
+                             help='write metrics of the run to METRICS_FILE')
+    parser_pull.add_argument('--longest-first', dest='longest_first', action='store_true',
+                             default=None, help='start units that take longest first')
+    parser_pull.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                             help='number of syncs to pull concurrently')
+    parser_pull.add_argument('--strategy', dest='strategy', default=None,
+                             choices=PULL_STRATEGIES,
+                             help='order of hosts to pull from')
+    parser_pull.add_argument('--spread', dest='spread', action='store_true',
+                             help='pull paths from all reachable hosts at the same time')
+
+    parser_plan = subparsers.add_parser(
+        'plan', help='estimate what push or pull would transfer with a dry run')
+    parser_plan.set_defaults(action='plan')
+    parser_plan.add_argument('method', nargs='?', default='push', choices=['push', 'pull'])
+    parser_plan.add_argument('--sync-name', dest='sync_name', default=None)
+    parser_plan.add_argument('--host-name', dest='host_name', default=None)
+    parser_plan.add_argument('-j', '--jobs', dest='jobs', type=int, default=8,
+                             help='number of dry runs to run concurrently')
+
+    parser_lint = subparsers.add_parser('lint', help='check config for wasted work')
+    parser_lint.set_defaults(action='lint')
+    parser_lint.add_argument('--overlaps', dest='overlaps', action='store_true',
+                             help='show transfers that other syncs already push')
+
+    parser_stats = subparsers.add_parser('stats', help='show transfer statistics')
+    parser_stats.set_defaults(action='stats')
+    parser_stats.add_argument('--days', dest='days', type=int, default=30,
+                              help='number of days of history to show')
+    parser_stats.add_argument('--limit', dest='limit', type=int, default=10,
+                              help='number of slowest paths and hosts to show')
+
+    parser_retry = subparsers.add_parser(
+        'retry', help='sync again paths that failed in previous runs')
+    parser_retry.set_defaults(action='retry')
+    parser_retry.add_argument('--sync-name', dest='sync_name', default=None)
+    parser_retry.add_argument('--host-name', dest='host_name', default=None)
+    parser_retry.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                              help='number of units to sync concurrently')
+
+    parser_rsyncd = subparsers.add_parser(
+        'rsyncd', help='run a rsync daemon on local host for testing rsyncd transport')
+    parser_rsyncd.set_defaults(action='rsyncd')
+    parser_rsyncd.add_argument('modules', nargs='+', metavar='MODULE=PATH',
+                               help='module of daemon and its local path')
+    parser_rsyncd.add_argument('--port', dest='port', type=int, default=None,
+                               help='port to listen on, a free port by default')
+    parser_rsyncd.add_argument('--read-only', dest='read_only', action='store_true',
+                               help='do not allow pushing to modules')
+
+    parser_daemon = subparsers.add_parser(
+        'daemon', help='push syncs in their intervals in one process')
+    parser_daemon.set_defaults(action='daemon')
+    parser_daemon.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                               help='number of syncs to push concurrently')
+
+    parser_watch = subparsers.add_parser(
+        'watch', help='push paths to hosts whenever they change')
+    parser_watch.set_defaults(action='watch')
+    parser_watch.add_argument('--sync-name', dest='sync_name', default=None)
+    parser_watch.add_argument('--debounce', dest='debounce', type=float, default=None,
+                              help='seconds to wait for more changes before pushing')
+    parser_watch.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                              help='number of hosts to push to concurrently')
 
     return parser
 
@@ -655,20 +4460,54 @@ def main():
     else:
         setup_logger()
     if 'config' in args:
-        config, config_path = load_config(args.config)
+        config, config_path = load_validated_config(args.config)
     else:
-        config, config_path = load_config()
+        config, config_path = load_validated_config()
 
     if config is None:
         exit(1)
-    
-    if not validate_config(config):
-        logger.critical('config error')
-        exit(1)
+    if args.action in ['push', 'pull', 'watch', 'retry', 'rsyncd', 'plan', 'daemon']:
+        try:
+            find_rsync(config.get('rsync_path'))
+        except FileNotFoundError:
+            exit(1)
     if args.action == 'list':
         list_syncs(config)
+    if args.action == 'stats':
+        show_stats(args.days, args.limit)
+    if args.action == 'lint':
+        # overlaps is the only check for now
+        lint_overlaps(config)
     if args.action in ['push', 'pull']:
-        syncronize_syncs(args.action, config, args.sync_name, args.host_name)
+        syncronize_syncs(args.action, config, args.sync_name, args.host_name,
+                         args.jobs, getattr(args, 'strategy', None),
+                         getattr(args, 'force', False), args.metrics_file,
+                         getattr(args, 'spread', False), args.longest_first)
+        close_control_masters()
+    if args.action == 'plan':
+        plan_syncs(config, args.method, args.sync_name, args.host_name, args.jobs)
+        close_control_masters()
+    if args.action == 'rsyncd':
+        modules = dict(module.split('=', 1) for module in args.modules if '=' in module)
+        if len(modules) != len(args.modules):
+            logger.error('modules must be in MODULE=PATH form')
+            exit(1)
+        process, port = start_rsync_daemon(modules, args.port, args.read_only)
+        logger.info('rsync daemon listening on 127.0.0.1:%d, press Ctrl-C to stop', port)
+        try:
+            process.wait()
+        except KeyboardInterrupt:
+            process.terminate()
+            process.wait()
+    if args.action == 'retry':
+        retry_failures(config, args.sync_name, args.host_name, args.jobs)
+        close_control_masters()
+    if args.action == 'daemon':
+        if not daemon_syncs(config, config_path, args.jobs):
+            exit(1)
+    if args.action == 'watch':
+        watch_syncs(config, args.sync_name, args.debounce, args.jobs)
+        close_control_masters()
     # if args.action == 'push':
     #     push_sync(config, args.sync_name, args.host_name)
     # if args.action == 'pull':
@@ -1,4 +1,15 @@
+import asyncio
+import errno
+import glob
+import io
+import json
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from copy import copy
 from unittest import TestCase
 from unittest.mock import MagicMock, Mock, mock_open, patch
@@ -383,3 +394,1077 @@ class TestSyncme(TestCase):
             result = syncme.load_config(sample_path)
             self.assertDictEqual(result[0], dict())
             self.assertEqual(result[1], sample_path)
+
+    @patch('syncme.syncronize_host')
+    def test_syncronize_syncs_jobs(self, mock_syncronize_host):
+        """ parallel syncronize_syncs must return same result as serial """
+
+        sample_config = {
+            'jobs': 4,
+            'syncs': [
+                {
+                    'name': 'sync{}'.format(i),
+                    'paths': ['/some/path'],
+                    'hosts': [{'address': 'host{}'.format(j)} for j in range(3)]
+                } for i in range(3)
+            ]
+        }
+        self.assertTrue(syncme.validate_config(sample_config))
+
+        # every push to host1 fails
+        mock_syncronize_host.side_effect = \
+            lambda method, host, *args, **kwargs: \
+            [('/some/path', '/some/path')] if host['name'] == 'host1' else []
+
+        with patch('sys.stdout'), tempfile.TemporaryDirectory() as cache_dir, \
+                patch('syncme.CACHE_DIR', cache_dir):
+            serial = syncme.syncronize_syncs('push', sample_config, jobs=1)
+            parallel = syncme.syncronize_syncs('push', sample_config)
+            self.assertEqual(len(serial), 3)
+            self.assertListEqual(serial, parallel)
+
+            # failed paths saved and only they synced by retry
+            self.assertEqual(len(syncme.get_failures(host_name='host1')), 3)
+            mock_syncronize_host.reset_mock()
+            self.assertEqual(len(syncme.retry_failures(sample_config)), 3)
+            self.assertEqual(mock_syncronize_host.call_count, 3)
+            self.assertSetEqual({call[0][1]['name'] for call in
+                                 mock_syncronize_host.call_args_list}, {'host1'})
+
+            # pull stops after the first successful host of each sync
+            mock_syncronize_host.reset_mock()
+            failed_syncs = syncme.syncronize_syncs('pull', sample_config)
+            self.assertListEqual(failed_syncs, [])
+            self.assertEqual(mock_syncronize_host.call_count, 3)
+
+        # jobs must be a positive integer
+        self.assertFalse(syncme.validate_config({'jobs': 0}))
+
+    @patch('syncme.rsync')
+    def test_sync_engine(self, mock_rsync):
+        """ engine must yield a result of each unit and limit jobs of hosts """
+
+        running = {}
+        most = {}
+        lock = threading.Lock()
+
+        def fake_rsync(**kwargs):
+            host = kwargs['dest_host']
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                most[host] = max(most.get(host, 0), running[host])
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+            kwargs['stats'].update(bytes_sent=100, bytes_received=10)
+            return 23 if host == 'host1' else 0
+        mock_rsync.side_effect = fake_rsync
+
+        sample_config = {
+            'hosts': [{'name': 'host0', 'address': 'host0', 'jobs': 1}],
+            'syncs': [{'name': 'sync{}'.format(i), 'paths': ['/some/path{}'.format(i)],
+                       'hosts': [{'name': 'host0'}, {'address': 'host1'}]}
+                      for i in range(3)],
+        }
+        self.assertTrue(syncme.validate_config(sample_config))
+        events = []
+
+        async def run(engine):
+            return [result async for result in engine.push()]
+        engine = syncme.SyncEngine(sample_config, jobs=4, capture=False,
+                                   on_event=lambda event, data: events.append(event))
+        with tempfile.TemporaryDirectory() as cache_dir, patch('syncme.CACHE_DIR', cache_dir), \
+                patch('syncme.open_state', wraps=syncme.open_state) as mock_open_state:
+            results = asyncio.run(run(engine))
+            # state of all units saved at once
+            self.assertEqual(mock_open_state.call_count, 1)
+            self.assertEqual(len(syncme.get_failures(host_name='host1')), 3)
+            self.assertIsNotNone(syncme.get_last_success('sync0'))
+        self.assertEqual(len(results), 6)
+        self.assertEqual(events.count('unit_started'), 6)
+        self.assertEqual(events.count('unit_finished'), 6)
+        self.assertDictEqual(most, {'host0': 1, 'host1': 3})
+        for result in results:
+            self.assertEqual(result.bytes, 110)
+            self.assertEqual(result.ok, result.hosts == ['host0'])
+            self.assertEqual(result.return_code, 23 if result.hosts == ['host1'] else 0)
+        self.assertFalse(syncme.validate_config(
+            {'hosts': [{'address': 'host0', 'jobs': 0}]}))
+
+    def test_sync_engine_cancel(self):
+        """ cancelling engine must terminate rsync and skip units not started """
+
+        sample_config = {
+            'syncs': [{'name': 'sync{}'.format(i), 'paths': ['/some/path{}'.format(i)],
+                       'hosts': [{'address': 'host1'}]} for i in range(3)],
+        }
+        self.assertTrue(syncme.validate_config(sample_config))
+
+        async def run(engine):
+            results = []
+            async for result in engine.push():
+                results.append(result)
+            return results
+
+        def on_event(event, data):
+            if event == 'unit_started':
+                asyncio.get_event_loop().call_later(0.2, engine.cancel)
+
+        with tempfile.TemporaryDirectory() as work:
+            fake_rsync = os.path.join(work, 'rsync')
+            with open(fake_rsync, 'w') as f:
+                f.write('#!{}\nimport time\ntime.sleep(30)\n'.format(sys.executable))
+            os.chmod(fake_rsync, 0o755)
+            engine = syncme.SyncEngine(sample_config, jobs=1, stats=False, on_event=on_event)
+            started = time.monotonic()
+            with patch('syncme.find_rsync', return_value=fake_rsync), \
+                    patch('syncme.CACHE_DIR', work):
+                results = asyncio.run(run(engine))
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(result.cancelled for result in results))
+        self.assertEqual(results[0].failed_paths, {'host1': [('/some/path0', '/some/path0')]})
+
+    @patch('syncme.syncronize_host', return_value=[])
+    def test_coalesce_overlaps(self, mock_syncronize_host):
+        """ duplicate and nested transfers of syncs must be pushed once """
+
+        with tempfile.TemporaryDirectory() as home, tempfile.TemporaryDirectory() as outside:
+            os.makedirs(os.path.join(home, 'projects'))
+            projects = os.path.join(home, 'projects/')
+            # parent copies only the symlink, not what it points to
+            os.symlink(outside, os.path.join(home, 'linked'))
+            linked = os.path.join(home, 'linked/')
+            sample_config = {
+                'recursive': True,
+                'syncs': [
+                    {'name': 'home', 'paths': [home + '/'],
+                     'hosts': [{'address': 'host1', 'paths': ['/backup/']}]},
+                    {'name': 'projects', 'paths': [projects],
+                     'hosts': [{'address': 'host1', 'paths': ['/backup/projects/']},
+                               {'address': 'host2', 'paths': ['/backup/projects/']}]},
+                    {'name': 'copy', 'paths': [home + '/'],
+                     'hosts': [{'address': 'host1', 'paths': ['/backup']}]},
+                    {'name': 'other', 'paths': [projects],
+                     'hosts': [{'address': 'host1', 'paths': ['/other/']}]},
+                    {'name': 'filtered', 'paths': [projects], 'tags': ['--exclude=*.o'],
+                     'hosts': [{'address': 'host1', 'paths': ['/backup/projects/']}]},
+                    {'name': 'linked', 'paths': [linked],
+                     'hosts': [{'address': 'host1', 'paths': ['/backup/linked/']}]},
+                    {'name': 'fs', 'paths': [home + '/'], 'tags': ['-ax'],
+                     'hosts': [{'address': 'host1', 'paths': ['/fs/']}]},
+                    {'name': 'fs2', 'paths': [projects], 'tags': ['-ax'],
+                     'hosts': [{'address': 'host1', 'paths': ['/fs/projects/']}]},
+                ],
+            }
+            self.assertTrue(syncme.validate_config(sample_config))
+            overlaps = syncme.find_overlaps(sample_config)
+            self.assertListEqual(
+                [(overlap['sync'], overlap['host'], overlap['kind'], overlap['by'][0])
+                 for overlap in overlaps],
+                [('projects', 'host1', 'nested', 'home'),
+                 ('copy', 'host1', 'duplicate', 'home')])
+
+            # recursion of bundled short options found too
+            bundled_config = {
+                'syncs': [
+                    {'name': 'home', 'paths': [home + '/'], 'tags': ['-avz'],
+                     'hosts': [{'address': 'host1', 'paths': ['/backup/']}]},
+                    {'name': 'projects', 'paths': [projects], 'tags': ['-avz'],
+                     'hosts': [{'address': 'host1', 'paths': ['/backup/projects/']}]},
+                ],
+            }
+            self.assertTrue(syncme.validate_config(bundled_config))
+            self.assertListEqual([overlap['sync'] for overlap in syncme.find_overlaps(bundled_config)],
+                                 ['projects'])
+
+            with tempfile.TemporaryDirectory() as cache_dir, \
+                    patch('syncme.CACHE_DIR', cache_dir), \
+                    patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                syncme.lint_overlaps(sample_config)
+                self.assertIn('2 of 9 transfers coalesced', stdout.getvalue())
+                # coalescing is off by default
+                syncme.syncronize_syncs('push', sample_config)
+                self.assertEqual(mock_syncronize_host.call_count, 9)
+                mock_syncronize_host.reset_mock()
+                sample_config['coalesce'] = True
+                syncme.syncronize_syncs('push', sample_config)
+            pushed = [(call[0][1]['name'], call[0][2]) for call in
+                      mock_syncronize_host.call_args_list]
+            self.assertListEqual(pushed, [
+                ('host1', [home + '/']), ('host2', [projects]), ('host1', [projects]),
+                ('host1', [projects]), ('host1', [linked]), ('host1', [home + '/']),
+                ('host1', [projects])])
+
+    def test_sync_scheduler(self):
+        """ scheduler must run syncs in their intervals and merge pending runs """
+
+        sample_config = {
+            'interval': '10s',
+            'syncs': [{'name': 'often', 'paths': ['/a'], 'hosts': [{'address': 'host1'}]},
+                      {'name': 'daily', 'paths': ['/b'], 'interval': '1d', 'jitter': 60,
+                       'hosts': [{'address': 'host1'}]},
+                      {'name': 'manual', 'paths': ['/c'], 'interval': None,
+                       'hosts': [{'address': 'host1'}]}],
+        }
+        self.assertTrue(syncme.validate_config(sample_config))
+        self.assertFalse(syncme.validate_config({'interval': '10x'}))
+        self.assertFalse(syncme.validate_config({'interval': 0}))
+        self.assertEqual(syncme.parse_interval('15m'), 900)
+
+        with tempfile.TemporaryDirectory() as cache_dir, patch('syncme.CACHE_DIR', cache_dir):
+            syncme.set_last_success('daily', 'host1')
+            scheduler = syncme.SyncScheduler(sample_config)
+            self.assertEqual(scheduler.schedule(now=1000), 2)
+        self.assertTrue(sample_config['multiplex'])
+        self.assertListEqual(scheduler.pop_due(now=1000), ['often'])
+        self.assertListEqual(scheduler.pop_due(now=1005), [])
+        # missed runs merged into one
+        self.assertListEqual(scheduler.pop_due(now=1035), ['often'])
+        self.assertEqual(scheduler.next_due(), 1045)
+
+        # a run without stats must save its success for next start of daemon
+        with tempfile.TemporaryDirectory() as cache_dir, patch('syncme.CACHE_DIR', cache_dir), \
+                patch('syncme.syncronize_host', return_value=[]), \
+                patch('syncme.check_control_masters'):
+            asyncio.run(scheduler.run_sync('often'))
+            self.assertIsNotNone(syncme.get_last_success('often'))
+            scheduler.queue = []
+            scheduler.schedule(now=time.time())
+            due = {name: run_time for run_time, _, name in scheduler.queue}
+            self.assertGreater(due['often'], time.time() + 5)
+
+        started = []
+        events = {}
+
+        async def run_sync(name):
+            started.append(name)
+            await events['release'].wait()
+        scheduler.run_sync = run_sync
+
+        async def run():
+            events['release'] = asyncio.Event()
+            for _ in range(3):
+                scheduler.trigger('often')
+            await asyncio.sleep(0.01)
+            self.assertEqual(len(started), 1)
+            self.assertSetEqual(scheduler.pending, {'often'})
+            events['release'].set()
+            while scheduler.running:
+                await asyncio.sleep(0.01)
+        asyncio.run(run())
+        self.assertListEqual(started, ['often', 'often'])
+        self.assertEqual(scheduler.runs, 2)
+
+    @patch('syncme.rsync')
+    def test_syncronize_host_batch(self, mock_rsync):
+        """ paths with same destination must be pushed with one rsync """
+
+        sample_host = {
+            'name': 'example',
+            'address': 'example.com',
+            'user': 'user1',
+            'paths': ['/backup/', '/backup/', '/var/projects'],
+        }
+        sample_paths = ['/home/a', '/home/b', '/home/c']
+
+        mock_rsync.return_value = 0
+        failed_paths = syncme.syncronize_host(
+            'push', sample_host, sample_paths, batch=True)
+        self.assertListEqual(failed_paths, [])
+        self.assertEqual(mock_rsync.call_count, 2)
+        self.assertListEqual(mock_rsync.call_args_list[0][1]['source_path'],
+                             ['/home/a', '/home/b'])
+
+        # if batch fails every path of batch synced separately
+        mock_rsync.reset_mock()
+        mock_rsync.side_effect = lambda **kwargs: \
+            23 if kwargs['source_path'] != '/home/a' else 0
+        failed_paths = syncme.syncronize_host(
+            'push', sample_host, sample_paths, batch=True)
+        self.assertListEqual(failed_paths, [('/home/b', '/backup/'),
+                                            ('/home/c', '/var/projects')])
+        self.assertEqual(mock_rsync.call_count, 4)
+
+    @patch('subprocess.call')
+    def test_control_master(self, mock_call):
+        """ one master connection must be opened per user and address """
+
+        mock_call.return_value = 0
+        ssh_command = syncme.open_control_master('user1', 'example.com')
+        self.assertIn('ControlPath=', ssh_command)
+        self.assertEqual(
+            syncme.open_control_master('user1', 'example.com'), ssh_command)
+        self.assertEqual(mock_call.call_count, 1)
+
+        # if master cannot be opened plain ssh is used
+        mock_call.return_value = 255
+        self.assertIsNone(syncme.open_control_master('user1', 'example.org'))
+
+        mock_call.reset_mock()
+        syncme.close_control_masters()
+        self.assertEqual(mock_call.call_count, 1)
+        self.assertIn('exit', mock_call.call_args[0][0])
+        self.assertDictEqual(syncme._CONTROL_MASTERS, {})
+
+    def test_order_hosts(self):
+        """ hosts must be sorted by latency and unreachable hosts at the end """
+
+        sample_hosts = [{'name': name, 'address': name, 'user': 'user1'}
+                        for name in ('slow', 'dead', 'fast')]
+        latencies = {('user1', 'slow'): 0.3, ('user1', 'fast'): 0.01}
+        result = syncme._order_hosts(sample_hosts, latencies)
+        self.assertListEqual([host['name'] for host in result],
+                             ['fast', 'slow', 'dead'])
+
+        self.assertFalse(syncme.validate_config({'pull_strategy': 'random'}))
+
+    def test_tree_fingerprint(self):
+        """ fingerprint must change when tree changes """
+
+        with tempfile.TemporaryDirectory() as tree:
+            os.makedirs(os.path.join(tree, 'a', 'b'))
+            with open(os.path.join(tree, 'a', 'b', 'file'), 'w') as f:
+                f.write('content')
+
+            fingerprint = syncme.tree_fingerprint(tree)
+            self.assertEqual(fingerprint, syncme.tree_fingerprint(tree))
+            self.assertTrue(fingerprint.startswith('4:'))
+            # options are part of fingerprint
+            self.assertNotEqual(fingerprint, syncme.tree_fingerprint(tree, ['-v']))
+
+            with open(os.path.join(tree, 'a', 'b', 'file'), 'a') as f:
+                f.write('more content')
+            self.assertNotEqual(fingerprint, syncme.tree_fingerprint(tree))
+
+        self.assertIsNone(syncme.tree_fingerprint('/path/does/not/exist'))
+
+    @patch('syncme.rsync')
+    def test_syncronize_host_manifest(self, mock_rsync):
+        """ unchanged paths must not be pushed again """
+
+        mock_rsync.return_value = 0
+        with tempfile.TemporaryDirectory() as tree, \
+                tempfile.TemporaryDirectory() as cache_dir, \
+                patch('syncme.CACHE_DIR', cache_dir):
+            sample_host = {'name': 'example', 'address': 'example.com',
+                           'user': 'user1', 'paths': [tree]}
+
+            for expected_calls in (1, 1):
+                syncme.syncronize_host('push', sample_host, [tree],
+                                       sync_name='default', manifest=True)
+                self.assertEqual(mock_rsync.call_count, expected_calls)
+
+            syncme.syncronize_host('push', sample_host, [tree],
+                                   sync_name='default', manifest=True, force=True)
+            self.assertEqual(mock_rsync.call_count, 2)
+
+            open(os.path.join(tree, 'new_file'), 'w').close()
+            syncme.syncronize_host('push', sample_host, [tree],
+                                   sync_name='default', manifest=True)
+            self.assertEqual(mock_rsync.call_count, 3)
+
+    def test_scan_changes(self):
+        """ only changed, new and deleted entries must be listed """
+
+        def read_list(path):
+            with open(path, 'rb') as f:
+                return sorted(f.read().decode().split('\0')[:-1])
+
+        with tempfile.TemporaryDirectory() as work:
+            tree = os.path.join(work, 'tree')
+            state, new_state, changes = [os.path.join(work, name)
+                                         for name in ('state', 'new_state', 'list')]
+            for directory in ('a/b', 'a.b', 'c'):
+                os.makedirs(os.path.join(tree, directory))
+            for name in ('a/b/1', 'a/2', 'a.b/3', 'c/4'):
+                with open(os.path.join(tree, name), 'w') as f:
+                    f.write(name)
+
+            # without state everything is new
+            result = syncme.scan_changes(tree, state, new_state, changes, 'tree')
+            self.assertTupleEqual(result, (8, 0))
+            self.assertIn('tree/a/b/1', read_list(changes))
+            os.replace(new_state, state)
+
+            result = syncme.scan_changes(tree, state, new_state, changes)
+            self.assertTupleEqual(result, (0, 0))
+
+            with open(os.path.join(tree, 'a/2'), 'w') as f:
+                f.write('changed content')
+            open(os.path.join(tree, 'a/b/new'), 'w').close()
+            shutil.rmtree(os.path.join(tree, 'c'))
+            result = syncme.scan_changes(tree, state, new_state, changes,
+                                         deletions=True)
+            self.assertTupleEqual(result, (2, 2))
+            # files of deleted directory are deleted with it
+            self.assertListEqual(read_list(changes), ['a/2', 'a/b/new', 'c'])
+
+    @patch('time.sleep')
+    @patch('syncme.rsync')
+    def test_syncronize_host_retries(self, mock_rsync, mock_sleep):
+        """ paths must be retried only on errors that may not happen again """
+
+        sample_host = {'name': 'example', 'address': 'example.com',
+                       'user': 'user1', 'paths': ['/x']}
+        mock_rsync.side_effect = [23, 12, 0]
+        failed = syncme.syncronize_host('push', sample_host, ['/a'], retries=3, retry_delay=4)
+        self.assertListEqual(failed, [])
+        self.assertEqual(mock_rsync.call_count, 3)
+        self.assertIn('--partial-dir=.rsync-partial', mock_rsync.call_args[1]['tags'])
+        # delays grow exponentially with jitter
+        self.assertTrue(2 <= mock_sleep.call_args_list[0][0][0] <= 4)
+        self.assertTrue(4 <= mock_sleep.call_args_list[1][0][0] <= 8)
+
+        # syntax errors never retried
+        mock_rsync.reset_mock(side_effect=True)
+        mock_rsync.return_value = 1
+        failed = syncme.syncronize_host('push', sample_host, ['/a'], retries={'/a/': 3})
+        self.assertListEqual(failed, [('/a', '/x')])
+        self.assertEqual(mock_rsync.call_count, 1)
+
+    def test_bandwidth_budget(self):
+        """ running commands must not use more than the bandwidth limits """
+
+        sample_config = {
+            'bandwidth': '4M',
+            'bandwidth_schedule': [{'time': '22:00-06:00', 'bandwidth': 0},
+                                   {'time': '08:00-18:00', 'bandwidth': '25%'}],
+            'hosts': [{'name': 'slow', 'address': 'slow.example.com', 'bandwidth': 512}],
+        }
+        self.assertTrue(syncme.validate_config(sample_config))
+        budget = syncme.bandwidth_budget(sample_config, jobs=4, host_slots={'slow': 1})
+        with patch('time.localtime', return_value=time.struct_time((2020, 1, 1, 20, 0, 0, 0, 1, 0))):
+            shares = [budget.acquire('fast') for _ in range(3)]
+            self.assertListEqual(shares, [1024, 1024, 1024])
+            # host limit is less than what is left of global limit
+            self.assertEqual(budget.acquire('slow'), 512)
+            budget.release('fast', 1024)
+            # share of finished command given to next commands
+            self.assertEqual(budget.acquire('fast'), 1536)
+
+        budget = syncme.bandwidth_budget(sample_config, jobs=1)
+        for hour, expected in ((23, None), (3, None), (10, 1024), (19, 4096)):
+            now = time.struct_time((2020, 1, 1, hour, 0, 0, 0, 1, 0))
+            self.assertEqual(budget.current_limit(now), expected)
+
+        self.assertEqual(syncme.parse_rate('1.5M'), 1536)
+        self.assertIsNone(syncme.bandwidth_budget({'hosts': [], 'syncs': []}))
+        self.assertFalse(syncme.validate_config({'bandwidth': 'fast'}))
+        self.assertFalse(syncme.validate_config(
+            {'bandwidth_schedule': [{'time': '08:00-18:00', 'bandwidth': '20%'}]}))
+
+    def test_compression(self):
+        """ compression must be used only when it makes transfer faster """
+
+        with tempfile.TemporaryDirectory() as tree:
+            with open(os.path.join(tree, 'text.txt'), 'w') as f:
+                f.write('some text that compresses well\n' * 4000)
+            with open(os.path.join(tree, 'random.bin'), 'wb') as f:
+                f.write(os.urandom(64 * 1024))
+            sample = syncme.sample_compression(tree)
+        self.assertListEqual(sample['incompressible'], ['bin'])
+        self.assertLess(sample['levels'][6][0], 0.8)
+        self.assertIsNone(syncme.sample_compression('/path/does/not/exist'))
+
+        sample = {'levels': {1: (0.5, 50e6), 6: (0.4, 20e6), 9: (0.39, 2e6)},
+                  'incompressible': ['bin', 'jpg']}
+        # slow link, compression is faster than link
+        options = syncme.choose_compression(sample, 1e6)
+        self.assertListEqual(options[:2], ['-z', '--compress-level=6'])
+        self.assertTrue(options[2].startswith('--skip-compress=') and
+                        options[2].endswith('/bin'))
+        # fast link, compression is slower than link
+        self.assertListEqual(syncme.choose_compression(sample, 100e6), [])
+        self.assertListEqual(syncme.choose_compression(sample)[:2],
+                             ['-z', '--compress-level=1'])
+        self.assertFalse(syncme.validate_config({'compress': 'sometimes'}))
+
+    @patch('syncme.rsync')
+    def test_relay(self, mock_rsync):
+        """ hosts must be pushed from their parents and from local host if relay fails """
+
+        self.assertListEqual(syncme.relay_parents(7, 'tree', 2), [None, 0, 0, 1, 1, 2, 2])
+        self.assertListEqual(syncme.relay_parents(3, 'chain'), [None, 0, 1])
+
+        def fake_rsync(**kwargs):
+            # relaying to host3 fails
+            if kwargs.get('relay') and kwargs['dest_host'] == 'host3':
+                return 12
+            return 0
+        mock_rsync.side_effect = fake_rsync
+
+        with tempfile.TemporaryDirectory() as tree, \
+                tempfile.TemporaryDirectory() as cache_dir, \
+                patch('syncme.CACHE_DIR', cache_dir), patch('sys.stdout'):
+            sample_config = {
+                'relay': 'tree',
+                'syncs': [{'name': 'default', 'paths': [tree + '/'],
+                           'hosts': [{'address': 'host{}'.format(i), 'user': 'user1'}
+                                     for i in range(5)]}],
+            }
+            self.assertTrue(syncme.validate_config(sample_config))
+            self.assertListEqual(syncme.syncronize_syncs('push', sample_config), [])
+            # hosts of a level may be pushed from local host at same time
+            sync = sample_config['syncs'][0]
+            self.assertEqual(syncme._unit_concurrency(sample_config, sync, sync['hosts'],
+                                                      syncme._relay_unit), 2)
+
+        calls = {call[1]['dest_host']: call[1].get('relay') for call in mock_rsync.call_args_list}
+        self.assertEqual(mock_rsync.call_count, 6)
+        self.assertDictEqual(calls, {'host0': None, 'host1': ('user1', 'host0'),
+                                     'host2': ('user1', 'host0'), 'host3': None,
+                                     'host4': ('user1', 'host1')})
+
+    def test_rsync_relay(self):
+        """ rsync must run on relay host with ssh """
+
+        with patch('subprocess.Popen') as mock_popen:
+            mock_popen.return_value.wait.return_value = 0
+            syncme.rsync(source_path='~/data/', dest_path='/backup/', dest_host='host1',
+                         dest_user='user1', relay=('user1', 'host0'))
+        self.assertListEqual(mock_popen.call_args[0][0], [
+            syncme.SSH, 'user1@host0', 'rsync data/ user1@host1:/backup/'])
+
+    def test_output_stream(self):
+        """ rsync output must be streamed with a prefix and only its tail kept """
+
+        script = (
+            "import sys\n"
+            "for index in range(50):\n"
+            "    sys.stdout.write('file%d\\n' % index)\n"
+            "sys.stdout.write('  1,024  10%  2.00MB/s  0:00:01\\r  2,048  20%  2.00MB/s"
+            "  0:00:01\\r')\n"
+            "sys.stderr.write('rsync error: some files vanished\\n')\n"
+            "sys.exit(24)\n")
+        with tempfile.TemporaryDirectory() as work:
+            fake_rsync = os.path.join(work, 'rsync')
+            with open(fake_rsync, 'w') as f:
+                f.write('#!{}\n{}'.format(sys.executable, script))
+            os.chmod(fake_rsync, 0o755)
+            file = io.StringIO()
+            output = syncme.OutputStream('default', 'host1', tail=5, file=file)
+            path_output = output.for_path('/home/user1/')
+            with patch('syncme.find_rsync', return_value=fake_rsync), \
+                    patch.object(syncme._PROGRESS, 'update') as mock_update:
+                return_code = syncme.rsync(source_path='/home/user1/', dest_host='host1',
+                                           dest_path='/backup/', output=path_output)
+        self.assertEqual(return_code, 24)
+        lines = file.getvalue().splitlines()
+        self.assertEqual(len(lines), 51)
+        self.assertEqual(lines[0], '[default/host1//home/user1/] file0')
+        self.assertIn('[default/host1//home/user1/] rsync error: some files vanished', lines)
+        self.assertEqual(mock_update.call_args[0][1:], (2048, 2 * 1024 * 1024))
+        tail = output.get_tail('/home/user1/')
+        self.assertEqual(len(tail), 5)
+        self.assertEqual(tail[-1], 'rsync error: some files vanished\n')
+
+    def test_push_delta_deleted_tree(self):
+        """ a deleted directory tree must be deleted on remote by delta push """
+
+        fake_rsync = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                  'benchmarks', 'fake_rsync.py')
+        with tempfile.TemporaryDirectory() as work:
+            tree = os.path.join(work, 'tree')
+            os.makedirs(os.path.join(tree, 'x', 'y'))
+            with open(os.path.join(tree, 'x', 'y', 'f'), 'w') as f:
+                f.write('data')
+            remote = os.path.join(work, 'remote')
+            options = {'local_path': tree + '/', 'remote_path': '/dst/', 'host': 'host1',
+                       'user': 'user1', 'tags': ['-a', '--delete']}
+            with patch('syncme.find_rsync', return_value=fake_rsync), \
+                    patch('syncme.CACHE_DIR', os.path.join(work, 'cache')), \
+                    patch.dict(os.environ, {'SYNCME_FAKE_ROOT': remote}):
+                self.assertEqual(syncme.push_delta('key', **options), 0)
+                self.assertTrue(os.path.exists(os.path.join(remote, 'host1', 'dst', 'x', 'y', 'f')))
+                shutil.rmtree(os.path.join(tree, 'x'))
+                with patch('syncme.rsync', wraps=syncme.rsync) as mock_rsync:
+                    self.assertEqual(syncme.push_delta('key', **options), 0)
+                self.assertIn('--force', mock_rsync.call_args[1]['tags'])
+            self.assertFalse(os.path.exists(os.path.join(remote, 'host1', 'dst', 'x')))
+
+            # options that only look like --delete do not delete
+            os.makedirs(os.path.join(tree, 'z'))
+            with open(os.path.join(tree, 'z', 'f'), 'w') as f:
+                f.write('data')
+            options['tags'] = ['-a', '--delay-updates']
+            with patch('syncme.find_rsync', return_value=fake_rsync), \
+                    patch('syncme.CACHE_DIR', os.path.join(work, 'cache')), \
+                    patch.dict(os.environ, {'SYNCME_FAKE_ROOT': remote}):
+                self.assertEqual(syncme.push_delta('key2', **options), 0)
+                os.remove(os.path.join(tree, 'z', 'f'))
+                with open(os.path.join(tree, 'g'), 'w') as f:
+                    f.write('data')
+                with patch('syncme.rsync', wraps=syncme.rsync) as mock_rsync:
+                    self.assertEqual(syncme.push_delta('key2', **options), 0)
+                tags = mock_rsync.call_args[1]['tags']
+                self.assertIn('--delay-updates', tags)
+                self.assertNotIn('--delete-missing-args', tags)
+            self.assertTrue(os.path.exists(os.path.join(remote, 'host1', 'dst', 'z', 'f')))
+            self.assertFalse(syncme._deletes(['--delay-updates']))
+            self.assertTrue(syncme._deletes(['--delete-after']))
+
+        # paths of syncs that are not recursive are pushed normally
+        sample_host = {'name': 'example', 'address': 'example.com', 'user': 'user1',
+                       'paths': ['/dst/']}
+        with patch('syncme.push_delta', return_value=0) as mock_push_delta, \
+                patch('syncme.push', return_value=0) as mock_push:
+            syncme.syncronize_host('push', sample_host, ['/src/'], tags=['-lt'], delta=True)
+            self.assertFalse(mock_push_delta.called)
+            self.assertTrue(mock_push.called)
+            syncme.syncronize_host('push', sample_host, ['/src/'], tags=['-avz'], delta=True)
+            self.assertTrue(mock_push_delta.called)
+
+    def test_rsync_daemon(self):
+        """ hosts with rsyncd transport must be reached with rsync:// urls """
+
+        sample_host = {'name': 'nas', 'address': 'nas.lan', 'user': 'user1',
+                       'transport': 'rsyncd', 'module': 'backup', 'port': 8873,
+                       'password_file': '/etc/syncme.secret'}
+        with patch('subprocess.Popen') as mock_popen, \
+                patch('syncme.find_rsync', return_value='rsync'), \
+                patch('syncme.open_control_master') as mock_master:
+            mock_popen.return_value.wait.return_value = 0
+            sample_host['paths'] = ['/home/user1/']
+            syncme.syncronize_host('push', sample_host, ['/home/user1/'], multiplex=True)
+            self.assertListEqual(mock_popen.call_args[0][0], [
+                'rsync', '/home/user1/', 'rsync://user1@nas.lan:8873/backup/home/user1/',
+                '--password-file=/etc/syncme.secret'])
+            mock_master.assert_not_called()
+
+        self.assertFalse(syncme.validate_config(
+            {'hosts': [{'address': 'nas.lan', 'transport': 'rsyncd'}]}))
+        self.assertFalse(syncme.validate_config(
+            {'hosts': [{'address': 'nas.lan', 'transport': 'ftp'}]}))
+        sample_config = {
+            'hosts': [{'name': 'nas', 'address': 'nas.lan', 'transport': 'rsyncd',
+                       'module': 'backup'}],
+            'syncs': [{'name': 'default', 'paths': ['/a'], 'hosts': [{'name': 'nas'}]}],
+        }
+        self.assertTrue(syncme.validate_config(sample_config))
+
+    @patch('syncme.syncronize_host')
+    def test_pull_spread(self, mock_syncronize_host):
+        """ paths must be pulled from all hosts and paths of a failed host reassigned """
+
+        pulled = []
+
+        def fake_syncronize_host(method, host, sync_paths, *args, **kwargs):
+            if host['name'] == 'bad':
+                return [(sync_paths[0], host['paths'][0])]
+            pulled.append((sync_paths[0], host['name']))
+            return []
+        mock_syncronize_host.side_effect = fake_syncronize_host
+
+        sample_config = {
+            'syncs': [{'name': 'default', 'paths': ['/a', '/b', '/c', '/d'],
+                       'hosts': [{'address': name} for name in ('bad', 'good', 'other')]}],
+        }
+        self.assertTrue(syncme.validate_config(sample_config))
+        latencies = {('user1', name): 0.01 for name in ('bad', 'good', 'other')}
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch('syncme.CACHE_DIR', cache_dir), patch('sys.stdout'), \
+                patch('syncme._current_user', return_value='user1'), \
+                patch('syncme.probe_hosts', return_value=latencies):
+            for host in sample_config['syncs'][0]['hosts']:
+                host['user'] = 'user1'
+            failed_syncs = syncme.syncronize_syncs('pull', sample_config, spread=True)
+        self.assertListEqual(failed_syncs, [])
+        self.assertListEqual(sorted(path for path, host in pulled), ['/a', '/b', '/c', '/d'])
+        self.assertNotIn('bad', {host for path, host in pulled})
+        # bad host used only once
+        self.assertEqual(mock_syncronize_host.call_count, 5)
+
+        # bandwidth shared by rsync commands of all hosts of spread pull
+        budgets = []
+        mock_syncronize_host.side_effect = \
+            lambda *args, **kwargs: budgets.append(kwargs['bandwidth']) or []
+        sample_config['bandwidth'] = '3M'
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch('syncme.CACHE_DIR', cache_dir), patch('sys.stdout'), \
+                patch('syncme.probe_hosts', return_value=latencies):
+            syncme.syncronize_syncs('pull', sample_config, spread=True)
+        with patch('time.localtime', return_value=time.struct_time((2020, 1, 1, 20, 0, 0, 0, 1, 0))):
+            self.assertListEqual([budgets[0].acquire(name) for name in ('bad', 'good', 'other')],
+                                 [1024, 1024, 1024])
+
+    @patch('syncme.rsync')
+    def test_plan_syncs(self, mock_rsync):
+        """ plan must report dry run of each path and be used to order units """
+
+        def fake_rsync(**kwargs):
+            self.assertIn('--dry-run', kwargs['tags'])
+            if kwargs['source_path'] == '/big':
+                kwargs['output'].extend(['>f+++++++++ a\n', '>f.st...... b\n',
+                                         '*deleting   c\n', 'cd+++++++++ d/\n'])
+                kwargs['stats'].update(transferred_size=10 * 1024 * 1024)
+            kwargs['stats']['wall_time'] = 0.5
+            return 0
+        mock_rsync.side_effect = fake_rsync
+
+        sample_config = {
+            'syncs': [{'name': 'small', 'paths': ['/small'], 'hosts': [{'address': 'host1'}]},
+                      {'name': 'big', 'paths': ['/big'], 'hosts': [{'address': 'host1'}]}],
+        }
+        self.assertTrue(syncme.validate_config(sample_config))
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch('syncme.CACHE_DIR', cache_dir), patch('sys.stdout'), \
+                patch('syncme.link_throughput', return_value=1024 * 1024):
+            plan = syncme.plan_syncs(sample_config)
+            self.assertDictEqual(plan[1], {
+                'sync': 'big', 'host': 'host1', 'local_path': '/big', 'files': 2,
+                'deleted': 1, 'bytes': 10 * 1024 * 1024, 'seconds': 10, 'return_code': 0})
+            self.assertEqual(plan[0]['seconds'], 0.5)
+
+            durations = syncme.get_durations('push')
+            self.assertEqual(durations['big', 'host1', '/big'], 10)
+            units = [(sync, sync['hosts']) for sync in sample_config['syncs']]
+            self.assertGreater(syncme._unit_duration(units[1], durations),
+                               syncme._unit_duration(units[0], durations))
+
+            mock_rsync.side_effect = None
+            mock_rsync.return_value = 0
+            failed_syncs = syncme.syncronize_syncs('push', sample_config, jobs=2,
+                                                   longest_first=True)
+        self.assertListEqual(failed_syncs, [])
+
+    def test_split_shards(self):
+        """ entries must be split to shards of about same size """
+
+        sample_sizes = {'a': 10, 'b': 7, 'c': 5, 'd': 4, 'e': 3, 'f': 1}
+        result = syncme.split_shards(sample_sizes, 3)
+        self.assertListEqual(result, [['a'], ['b', 'e'], ['c', 'd', 'f']])
+        self.assertListEqual(syncme.split_shards({'a': 1}, 4), [['a']])
+
+        self.assertFalse(syncme.validate_config({'shards': 0}))
+        self.assertFalse(syncme.validate_config({'shards': {'/a': 'two'}}))
+        self.assertTrue(syncme.validate_config({'shards': {'/a': 2}}))
+
+    @patch('syncme.rsync')
+    def test_syncronize_host_shards(self, mock_rsync):
+        """ a sharded path must be pushed with one rsync for each shard """
+
+        lists = []
+
+        def fake_rsync(**kwargs):
+            list_path = [tag for tag in kwargs['tags'] if tag.startswith('--files-from=')]
+            if list_path:
+                with open(list_path[0].split('=', 1)[1], 'rb') as f:
+                    lists.append(sorted(f.read().decode().split('\0')[:-1]))
+            if kwargs['stats'] is not None:
+                kwargs['stats'].update(bytes_sent=100, total_size=400)
+            return 0
+        mock_rsync.side_effect = fake_rsync
+
+        with tempfile.TemporaryDirectory() as work, \
+                tempfile.TemporaryDirectory() as cache_dir, \
+                patch('syncme.CACHE_DIR', cache_dir):
+            tree = os.path.join(work, 'tree')
+            for name, size in (('big', 300), ('small', 100), ('tiny', 50)):
+                os.makedirs(os.path.join(tree, name))
+                with open(os.path.join(tree, name, 'file'), 'w') as f:
+                    f.write('x' * size)
+            sample_host = {'name': 'example', 'address': 'example.com',
+                           'user': 'user1', 'paths': ['/x']}
+            results = []
+            failed = syncme.syncronize_host('push', sample_host, [tree], recursive=True,
+                                            output=[], results=results, shards={tree: 2})
+            self.assertListEqual(failed, [])
+            self.assertListEqual(sorted(lists), [['tree/big'], ['tree/small', 'tree/tiny']])
+            self.assertEqual(mock_rsync.call_args[1]['source_path'], work + '/')
+            self.assertTrue(mock_rsync.call_args[1]['recursive'])
+            # shards reported as one path
+            self.assertEqual(len(results), 1)
+            self.assertEqual(results[0]['bytes_sent'], 200)
+            self.assertEqual(results[0]['local_path'], tree)
+
+            # recursion of bundled short options (-avz) also sharded, and
+            # deletion pass does not recurse
+            mock_rsync.reset_mock()
+            failed = syncme.syncronize_host('push', sample_host, [tree], tags=['-avz', '--delete'],
+                                            output=[], shards={tree: 2})
+            self.assertListEqual(failed, [])
+            self.assertEqual(mock_rsync.call_count, 3)
+            tags = mock_rsync.call_args[1]['tags']
+            self.assertListEqual(tags, ['-lptgoDvz', '--delete', '--dirs'])
+            self.assertFalse(syncme._is_recursive(tags))
+            self.assertFalse(mock_rsync.call_args[1]['recursive'])
+
+            # no deletion pass without a delete option
+            mock_rsync.reset_mock()
+            failed = syncme.syncronize_host('push', sample_host, [tree],
+                                            tags=['-a', '--delay-updates'], output=[],
+                                            shards={tree: 2})
+            self.assertListEqual(failed, [])
+            self.assertEqual(mock_rsync.call_count, 2)
+
+    def test_select_paths(self):
+        """ selected config must only have changed paths """
+
+        sample_config = {
+            'syncs': [
+                {'name': 'default', 'paths': ['/a', '/b/', '/c'],
+                 'hosts': [{'address': 'example.com', 'paths': ['/x']}]},
+                {'name': 'other', 'paths': ['/d'],
+                 'hosts': [{'address': 'example.com'}]},
+            ]
+        }
+        self.assertTrue(syncme.validate_config(sample_config))
+
+        result = syncme._select_paths(sample_config, {('default', 1), ('default', 2)})
+        self.assertEqual(len(result['syncs']), 1)
+        self.assertListEqual(result['syncs'][0]['paths'], ['/b/', '/c'])
+        self.assertListEqual(result['syncs'][0]['hosts'][0]['paths'], ['/b/', '/c'])
+        # original config must not change
+        self.assertListEqual(sample_config['syncs'][0]['paths'], ['/a', '/b/', '/c'])
+
+    def test_inotify_watcher(self):
+        """ changes in new directories must be reported """
+
+        try:
+            watcher = syncme.InotifyWatcher()
+        except OSError:
+            self.skipTest('inotify is not available')
+        with tempfile.TemporaryDirectory() as tree:
+            watcher.add_tree(tree, 'tag')
+            self.assertSetEqual(watcher.read(0), set())
+            os.mkdir(os.path.join(tree, 'new'))
+            self.assertSetEqual(watcher.read(1), {'tag'})
+            open(os.path.join(tree, 'new', 'file'), 'w').close()
+            self.assertSetEqual(watcher.read(1), {'tag'})
+        watcher.close()
+
+        # a missing path is polled, other paths still watched with inotify
+        with tempfile.TemporaryDirectory() as tree:
+            missing = os.path.join(tree, 'missing')
+            sample_config = {
+                'poll_interval': 0.2,
+                'syncs': [{'name': 'default', 'paths': [missing, tree],
+                           'hosts': [{'address': 'host1'}]}],
+            }
+            self.assertTrue(syncme.validate_config(sample_config))
+            watcher = syncme._watch_paths(sample_config, sample_config['syncs'])
+            self.assertIsInstance(watcher, syncme._MixedWatcher)
+            open(os.path.join(tree, 'file'), 'w').close()
+            self.assertSetEqual(watcher.read(0.1), {('default', 1)})
+            os.mkdir(missing)
+            changed = watcher.read(0.3) | watcher.read(0.3)
+            self.assertIn(('default', 0), changed)
+            watcher.close()
+
+            # inotify closed when watch limit reached
+            with patch.object(syncme.InotifyWatcher, 'add_tree',
+                              side_effect=OSError(errno.ENOSPC, 'limit')), \
+                    patch.object(syncme.InotifyWatcher, 'close') as mock_close:
+                watcher = syncme._watch_paths(sample_config, sample_config['syncs'])
+            self.assertIsInstance(watcher, syncme.PollingWatcher)
+            self.assertTrue(mock_close.called)
+
+    def test_parse_stats(self):
+        """ rsync --stats output must be parsed """
+
+        sample_output = [
+            'Number of files: 1,234 (reg: 1,000, dir: 234)\n',
+            'Number of regular files transferred: 3\n',
+            'Total file size: 12,345 bytes\n',
+            'Literal data: 1.50K bytes\n',
+            'Matched data: 0 bytes\n',
+            'Total bytes sent: 1,500\n',
+            'Total bytes received: 35\n',
+            'sent 1,500 bytes  received 35 bytes  3,070.00 bytes/sec\n',
+            'total size is 12,345  speedup is 8.04\n',
+        ]
+        stats = {}
+        for line in sample_output:
+            syncme.parse_stats(line, stats)
+        self.assertDictEqual(stats, {
+            'files': 1234,
+            'files_transferred': 3,
+            'total_size': 12345,
+            'literal_data': 1536,
+            'matched_data': 0,
+            'bytes_sent': 1500,
+            'bytes_received': 35,
+            'speedup': 8.04,
+        })
+
+    @patch('syncme.rsync')
+    def test_syncronize_host_results(self, mock_rsync):
+        """ statistics of each path must be collected and saved """
+
+        def fake_rsync(**kwargs):
+            kwargs['stats'].update(bytes_sent=100, bytes_received=10, wall_time=2)
+            return 0
+        mock_rsync.side_effect = fake_rsync
+
+        sample_host = {'name': 'example', 'address': 'example.com',
+                       'user': 'user1', 'paths': ['/x', '/y']}
+        results = []
+        syncme.syncronize_host('push', sample_host, ['/a', '/b'],
+                               sync_name='default', results=results)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1]['local_path'], '/b')
+        self.assertEqual(results[1]['host'], 'example')
+        self.assertEqual(results[1]['bytes_sent'], 100)
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch('syncme.CACHE_DIR', cache_dir), patch('sys.stdout'):
+            syncme.save_stats(results)
+            syncme.show_stats()
+
+    def test_write_metrics(self):
+        """ metrics must be written as prometheus textfile or json """
+
+        sample_results = [
+            {'time': 100.0, 'wall_time': 5.0, 'sync': 'default', 'host': 'example',
+             'return_code': 0, 'bytes_sent': 1000, 'bytes_received': 10},
+            {'time': 105.0, 'wall_time': 5.0, 'sync': 'default', 'host': 'example',
+             'return_code': 23, 'bytes_sent': 500, 'bytes_received': 10},
+            {'time': 100.0, 'wall_time': 20.0, 'sync': 'default', 'host': 'netbook',
+             'return_code': 0},
+        ]
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch('syncme.CACHE_DIR', cache_dir):
+            syncme.set_last_success('default', 'netbook')
+
+            metrics_path = os.path.join(cache_dir, 'syncme.prom')
+            syncme.write_metrics(metrics_path, 'push', sample_results, 90.0)
+            with open(metrics_path) as f:
+                content = f.read()
+            self.assertIn('syncme_sync_duration_seconds{method="push",sync="default"} 20.0',
+                          content)
+            self.assertIn('syncme_host_transferred_bytes{host="example",method="push",'
+                          'sync="default"} 1520', content)
+            self.assertIn('syncme_host_exit_code{host="example",method="push",'
+                          'sync="default"} 23', content)
+            self.assertIn('syncme_last_success_timestamp_seconds{host="netbook",'
+                          'sync="default"}', content)
+
+            metrics_path = os.path.join(cache_dir, 'syncme.json')
+            syncme.write_metrics(metrics_path, 'push', sample_results, 90.0)
+            with open(metrics_path) as f:
+                document = json.load(f)
+            example = document['syncs']['default']['hosts']['example']
+            self.assertEqual(example['duration'], 10.0)
+            self.assertEqual(example['failures'], 1)
+            self.assertIn('netbook', document['last_success']['default'])
+
+            # last success of a run is in metrics of same run
+            sample_config = {'syncs': [{'name': 'fresh', 'paths': ['/some/path'],
+                                        'hosts': [{'address': 'host1'}]}]}
+            self.assertTrue(syncme.validate_config(sample_config))
+            with patch('syncme.syncronize_host', return_value=[]), patch('sys.stdout'):
+                syncme.syncronize_syncs('push', sample_config, metrics_file=metrics_path)
+            with open(metrics_path) as f:
+                document = json.load(f)
+            self.assertIn('host1', document['last_success']['fresh'])
+
+    def test_load_validated_config(self):
+        """ validated config must be cached until config file changes """
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch('syncme.CACHE_DIR', cache_dir):
+            config_path = os.path.join(cache_dir, 'syncme.yml')
+            shutil.copy('tests/sample_config.yml', config_path)
+
+            config, path = syncme.load_validated_config(config_path)
+            self.assertEqual(path, config_path)
+            self.assertEqual(config['syncs'][0]['hosts'][1]['address'], 'example.com')
+
+            with patch('syncme.validate_config') as mock_validate_config:
+                cached_config, _ = syncme.load_validated_config(config_path)
+                self.assertFalse(mock_validate_config.called)
+            self.assertEqual(cached_config, config)
+            self.assertIsInstance(cached_config['syncs'], syncme.NamedList)
+            self.assertIsInstance(cached_config['syncs'][0]['hosts'][0], syncme.Host)
+
+            # cache of a class that cannot be imported is a cache miss
+            cache_paths = glob.glob(os.path.join(cache_dir, 'config-*.pickle'))
+            self.assertEqual(len(cache_paths), 1)
+            with open(cache_paths[0], 'wb') as f:
+                f.write(b'c__main__\nNoSuchClass\n)R.')
+            config, _ = syncme.load_validated_config(config_path)
+            self.assertEqual(config, cached_config)
+
+            with open(config_path, 'a') as f:
+                f.write('\njobs: 0\n')
+            config, path = syncme.load_validated_config(config_path)
+            self.assertIsNone(config)
+
+    def test_lazy_imports(self):
+        """ importing syncme must not import heavy modules or need rsync """
+
+        code = ('import sys, syncme; print(" ".join(sorted(m for m in '
+                '("yaml", "subprocess", "sqlite3", "concurrent.futures", "ctypes", '
+                '"json", "pickle", "argparse") if m in sys.modules)))')
+        env = dict(os.environ, PATH='/nonexistent')
+        output = subprocess.check_output([sys.executable, '-c', code], env=env,
+                                         universal_newlines=True)
+        self.assertEqual(output.strip(), '')
+
+    def test_find_rsync(self):
+        """ rsync must be found lazily and cached """
+
+        with patch('syncme.RSYNC', None), patch('shutil.which') as mock_which:
+            mock_which.return_value = '/bin/sh'
+            self.assertEqual(syncme.find_rsync(), '/bin/sh')
+            self.assertEqual(syncme.find_rsync(), '/bin/sh')
+            self.assertEqual(mock_which.call_count, 1)
+            # custom path
+            self.assertEqual(syncme.find_rsync('/bin/true'), '/bin/true')
+
+            mock_which.return_value = None
+            with patch('syncme.RSYNC', None), self.assertRaises(FileNotFoundError):
+                syncme.find_rsync()
+
+        # rsync_path setting used by engine, not only by command line
+        sample_config = {'rsync_path': '/bin/true',
+                         'syncs': [{'name': 'default', 'paths': ['/some/path'],
+                                    'hosts': [{'address': 'host1'}]}]}
+        self.assertTrue(syncme.validate_config(sample_config))
+        with tempfile.TemporaryDirectory() as cache_dir, patch('syncme.CACHE_DIR', cache_dir), \
+                patch('syncme.RSYNC', None), patch('syncme.RSYNC_VERSION', None), \
+                patch('syncme.syncronize_host', return_value=[]), patch('sys.stdout'):
+            syncme.syncronize_syncs('push', sample_config)
+            self.assertEqual(syncme.RSYNC, '/bin/true')
+            sample_config['rsync_path'] = '/no/such/rsync'
+            with self.assertRaises(FileNotFoundError):
+                syncme.syncronize_syncs('push', sample_config)
+
+    def test_config_model(self):
+        """ validated config must use indexed records and round trip to yaml """
+
+        import pickle
+        config = {
+            'hosts': [{'name': 'Example', 'address': 'example.com', 'user': 'u1'}],
+            'syncs': [{'name': 'default', 'paths': ['/a'],
+                       'hosts': [{'name': 'example', 'port': 2222}]}],
+        }
+        self.assertTrue(syncme.validate_config(config))
+        self.assertIsInstance(config['syncs'], syncme.NamedList)
+        host = syncme.get_host(config, 'default', 'example')
+        self.assertIsInstance(host, syncme.Host)
+        # settings are merged from global host and extra settings kept
+        self.assertEqual(host['user'], 'u1')
+        self.assertEqual(host['port'], 2222)
+        self.assertEqual(host, {'name': 'example', 'address': 'example.com',
+                                'user': 'u1', 'port': 2222, 'paths': ['/a']})
+        self.assertEqual(pickle.loads(pickle.dumps(config)), config)
+
+        syncme.add_sync(config, name='other', paths=['/b'], tags=None, recursive=None)
+        syncme.add_host(config, sync_name='other', name='example', paths=None,
+                        user=None, address=None)
+        self.assertEqual(syncme.get_host(config, 'other', 'example')['address'],
+                         'example.com')
+        syncme.remove_host(config, 'other', 'example')
+        self.assertIsNone(syncme.get_host(config, 'other', 'example'))
+        syncme.remove_sync(config, 'default')
+        self.assertIsNone(syncme.get_sync(config, 'default'))
+        self.assertListEqual(syncme.find_syncs(config, 'other'), [config['syncs'][0]])
+
+        with tempfile.TemporaryDirectory() as work:
+            config_path = os.path.join(work, 'syncme.yml')
+            syncme.save_config(config_path, config)
+            loaded_config, _ = syncme.load_config(config_path)
+        self.assertEqual(loaded_config['syncs'][0]['name'], 'other')
+        self.assertIsInstance(loaded_config['syncs'][0], dict)